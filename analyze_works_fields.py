@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Report what each field in the works mapping costs on disk and how often it is queried, and flag fields that are candidates for index: false, doc_values: false or leaving _source"""
+
+import sys, os, time, json
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from settings import ES_URL, WORKS_INDEX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+TEMPLATE_PATH = Path(__file__).parent / "elasticsearch_templates" / "works_template.json"
+
+# target maximum shard size from the README
+MAX_SHARD_BYTES = 40 * 1000 ** 3
+
+# field types that have doc_values unless the mapping turns them off
+DOC_VALUES_TYPES = {
+    "keyword", "long", "integer", "short", "byte", "double", "float", "half_float",
+    "scaled_float", "date", "boolean", "ip", "flattened",
+}
+
+
+def format_size(num_bytes: float) -> str:
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(num_bytes) < 1000:
+            return f"{num_bytes:.0f} {unit}" if unit == "B" else f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1000
+    return f"{num_bytes:.1f} TB"
+
+
+def flatten_mapping(properties: Dict, prefix: str = "") -> Dict[str, Dict]:
+    """Map each leaf field's dotted path to its type, and whether it is indexed and has doc_values."""
+    fields = {}
+    for name, mapping in properties.items():
+        path = f"{prefix}{name}"
+        if "properties" in mapping:
+            fields.update(flatten_mapping(mapping["properties"], prefix=f"{path}."))
+            continue
+        field_type = mapping.get("type", "object")
+        fields[path] = {
+            "type": field_type,
+            "index": mapping.get("index", True),
+            "doc_values": mapping.get("doc_values", field_type in DOC_VALUES_TYPES),
+        }
+        for sub_name, sub_mapping in mapping.get("fields", {}).items():
+            sub_type = sub_mapping.get("type", "object")
+            fields[f"{path}.{sub_name}"] = {
+                "type": sub_type,
+                "index": sub_mapping.get("index", True),
+                "doc_values": sub_mapping.get("doc_values", sub_type in DOC_VALUES_TYPES),
+            }
+    return fields
+
+
+def sum_disk_usage(disk_usage: Dict) -> Dict:
+    """Add up _disk_usage output over all indices.
+
+    Returns {"indices": {index: store bytes}, "fields": {field: {inverted_index, doc_values, points, stored_fields, norms, total}}}
+    """
+    indices = {}
+    fields = defaultdict(lambda: defaultdict(int))
+    for index, usage in disk_usage.items():
+        if index.startswith("_"):
+            continue
+        indices[index] = usage.get("store_size_in_bytes", 0)
+        for field, field_usage in usage.get("fields", {}).items():
+            totals = fields[field]
+            totals["inverted_index"] += field_usage.get("inverted_index", {}).get("total_in_bytes", 0)
+            totals["doc_values"] += field_usage.get("doc_values_in_bytes", 0)
+            totals["points"] += field_usage.get("points_in_bytes", 0)
+            totals["stored_fields"] += field_usage.get("stored_fields_in_bytes", 0)
+            totals["norms"] += field_usage.get("norms_in_bytes", 0)
+            totals["total"] += field_usage.get("total_in_bytes", 0)
+    return {"indices": indices, "fields": fields}
+
+
+def sum_field_usage(field_usage: Dict) -> Dict[str, Dict[str, int]]:
+    """Add up _field_usage_stats output over all indices and shards.
+
+    Returns {field: {"any": n, "inverted_index": n, "doc_values": n, "points": n}}
+    """
+    fields = defaultdict(lambda: defaultdict(int))
+    for index, usage in field_usage.items():
+        if index.startswith("_"):
+            continue
+        for shard in usage.get("shards", []):
+            for field, stats in shard.get("stats", {}).get("fields", {}).items():
+                totals = fields[field]
+                totals["any"] += stats.get("any", 0)
+                totals["inverted_index"] += sum(stats.get("inverted_index", {}).values())
+                totals["doc_values"] += stats.get("doc_values", 0)
+                totals["points"] += stats.get("points", 0)
+    return fields
+
+
+def source_shares(sample_docs: List[Dict]) -> Dict[str, float]:
+    """Share of raw _source bytes taken by each top-level field, from a sample of documents.
+
+    _disk_usage only reports _source as a whole, so this is used to split it between fields.
+    """
+    sizes = defaultdict(int)
+    for doc in sample_docs:
+        for field, value in doc.items():
+            sizes[field] += len(json.dumps(value, separators=(",", ":")).encode("utf-8")) + len(field) + 4
+    total = sum(sizes.values())
+    return {field: size / total for field, size in sizes.items()} if total else {}
+
+
+def analyze(
+    template: Dict,
+    disk_usage: Dict,
+    field_usage: Optional[Dict],
+    sample_docs: Optional[List[Dict]],
+    source_share_threshold: float,
+) -> Dict:
+    mapping = flatten_mapping(template["template"]["mappings"]["properties"])
+    disk = sum_disk_usage(disk_usage)
+    usage = sum_field_usage(field_usage) if field_usage else None
+    source_bytes = disk["fields"].get("_source", {}).get("stored_fields", 0)
+    shares = source_shares(sample_docs) if sample_docs else {}
+
+    rows = []
+    for field in sorted(set(mapping) | {f for f in disk["fields"] if not f.startswith("_")}):
+        bytes_used = disk["fields"].get(field, {})
+        mapped = mapping.get(field)
+        field_usage_stats = usage.get(field, {}) if usage is not None else None
+        row = {
+            "field": field,
+            "type": mapped["type"] if mapped else "dynamic (not in template)",
+            "inverted_index_bytes": bytes_used.get("inverted_index", 0),
+            "doc_values_bytes": bytes_used.get("doc_values", 0),
+            "points_bytes": bytes_used.get("points", 0),
+            "norms_bytes": bytes_used.get("norms", 0),
+            "total_bytes": bytes_used.get("total", 0),
+            "queries": field_usage_stats.get("any", 0) if field_usage_stats is not None else None,
+            "flags": [],
+        }
+        if field_usage_stats is not None:
+            searched = field_usage_stats.get("inverted_index", 0) + field_usage_stats.get("points", 0)
+            if (row["inverted_index_bytes"] or row["points_bytes"]) and not searched:
+                row["flags"].append("index: false")
+            if row["doc_values_bytes"] and not field_usage_stats.get("doc_values", 0):
+                row["flags"].append("doc_values: false")
+        rows.append(row)
+
+    # _source is stored per document, so it is reported per top-level field
+    source_rows = []
+    for field, share in sorted(shares.items(), key=lambda x: -x[1]):
+        source_row = {
+            "field": field,
+            "share": share,
+            "estimated_bytes": share * source_bytes,
+            "flags": [],
+        }
+        if share >= source_share_threshold:
+            source_row["flags"].append("move out of _source")
+        source_rows.append(source_row)
+
+    oversized = {
+        index: size for index, size in disk["indices"].items() if size > MAX_SHARD_BYTES
+    }
+    return {
+        "indices": disk["indices"],
+        "oversized_indices": oversized,
+        "source_bytes": source_bytes,
+        "fields": sorted(rows, key=lambda r: -r["total_bytes"]),
+        "source_fields": source_rows,
+    }
+
+
+def print_report(report: Dict, top: int):
+    total = sum(report["indices"].values())
+    print(f"{len(report['indices'])} indices, {format_size(total)} total")
+    for index, size in sorted(report["oversized_indices"].items()):
+        print(f"  over the 40 GB shard target: {index} ({format_size(size)})")
+    print()
+    print(f"{'field':<50}{'type':<14}{'inverted':>12}{'doc values':>12}{'points':>12}{'total':>12}{'queries':>10}  flags")
+    for row in report["fields"][:top]:
+        queries = row["queries"] if row["queries"] is not None else "-"
+        print(
+            f"{row['field']:<50}{row['type'][:13]:<14}{format_size(row['inverted_index_bytes']):>12}"
+            f"{format_size(row['doc_values_bytes']):>12}{format_size(row['points_bytes']):>12}"
+            f"{format_size(row['total_bytes']):>12}{queries:>10}  {', '.join(row['flags'])}"
+        )
+    if report["source_fields"]:
+        print()
+        print(f"_source: {format_size(report['source_bytes'])}")
+        print(f"{'field':<50}{'share':>8}{'estimated':>12}  flags")
+        for row in report["source_fields"][:top]:
+            print(
+                f"{row['field']:<50}{row['share']:>8.1%}{format_size(row['estimated_bytes']):>12}  {', '.join(row['flags'])}"
+            )
+
+
+def main(args):
+    template = json.loads(Path(args.template).read_text())
+    if args.disk_usage_file:
+        disk_usage = json.loads(Path(args.disk_usage_file).read_text())
+        field_usage = (
+            json.loads(Path(args.field_usage_file).read_text())
+            if args.field_usage_file
+            else None
+        )
+        sample_docs = (
+            [json.loads(line) for line in Path(args.sample_docs_file).read_text().splitlines() if line.strip()]
+            if args.sample_docs_file
+            else None
+        )
+    else:
+        es_client = Elasticsearch(ES_URL, timeout=3600)
+        logger.info(f"running _disk_usage on {args.index}. this reads every shard and can take a long time")
+        disk_usage = es_client.indices.disk_usage(
+            index=args.index, run_expensive_tasks=True
+        )
+        field_usage = es_client.indices.field_usage_stats(index=args.index)
+        response = es_client.search(
+            index=args.index,
+            body={"size": args.sample_size, "query": {"function_score": {"random_score": {}}}},
+        )
+        sample_docs = [hit["_source"] for hit in response["hits"]["hits"]]
+        if args.save_fixtures:
+            fixtures = Path(args.save_fixtures)
+            fixtures.mkdir(parents=True, exist_ok=True)
+            (fixtures / "disk_usage.json").write_text(json.dumps(disk_usage))
+            (fixtures / "field_usage.json").write_text(json.dumps(field_usage))
+            (fixtures / "sample_docs.jsonl").write_text(
+                "\n".join(json.dumps(doc) for doc in sample_docs)
+            )
+            logger.info(f"saved fixtures to {fixtures}")
+
+    report = analyze(
+        template, disk_usage, field_usage, sample_docs, args.source_share_threshold
+    )
+    print_report(report, args.top)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--index",
+        default=WORKS_INDEX,
+        help=f"indices to analyze live (default: {WORKS_INDEX})",
+    )
+    parser.add_argument(
+        "--template",
+        default=str(TEMPLATE_PATH),
+        help="works template (default: elasticsearch_templates/works_template.json)",
+    )
+    parser.add_argument(
+        "--disk-usage-file",
+        help="saved _disk_usage output to analyze instead of querying the cluster",
+    )
+    parser.add_argument("--field-usage-file", help="saved _field_usage_stats output")
+    parser.add_argument(
+        "--sample-docs-file", help="saved sample of _source documents, one per line"
+    )
+    parser.add_argument(
+        "--save-fixtures",
+        metavar="DIR",
+        help="when querying the cluster, save its output here for later runs",
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=1000,
+        help="documents sampled to split _source bytes between fields (default: 1000)",
+    )
+    parser.add_argument(
+        "--source-share-threshold",
+        type=float,
+        default=0.05,
+        help="flag top-level fields taking at least this share of _source (default: 0.05)",
+    )
+    parser.add_argument("--top", type=int, default=50, help="rows to print (default: 50)")
+    parser.add_argument("--output", help="save the full report as json to this path")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
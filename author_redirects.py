@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Build the memory-mapped merged author redirect table (old author id -> the id it was finally merged into) from the merge-authors CSV"""
+
+import sys, os
+from pathlib import Path
+from typing import Tuple, Union
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import numpy as np
+import pandas as pd
+from settings import MERGE_AUTHORS_CSV
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+AUTHOR_ID_PREFIX = "https://openalex.org/A"
+
+# chains are collapsed by pointer jumping, which doubles the length resolved on each pass, so
+# this allows for chains far longer than any real one. whatever is still unresolved is a cycle
+MAX_COLLAPSE_PASSES = 64
+
+
+def parse_author_id(author_id: Union[str, int]) -> int:
+    # "https://openalex.org/A2741809807" -> 2741809807
+    if isinstance(author_id, str):
+        return int(author_id.rsplit("/", 1)[-1].lstrip("A"))
+    return int(author_id)
+
+
+def parse_author_ids(ids: pd.Series) -> np.ndarray:
+    if pd.api.types.is_integer_dtype(ids):
+        return ids.to_numpy(dtype=np.int64)
+    return ids.astype(str).str.extract(r"(\d+)\s*$", expand=False).astype(np.int64).to_numpy()
+
+
+def find_sorted(keys: np.ndarray, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """For each id, its position in the sorted `keys` and whether it is there.
+
+    The ids are searched in sorted order, which walks `keys` front to back instead of jumping
+    around it; with tens of millions of keys that is over 20x faster than searching them as given.
+    """
+    if not len(keys):
+        return np.zeros(len(ids), dtype=np.int64), np.zeros(len(ids), dtype=bool)
+    order = np.argsort(ids)
+    positions = np.empty(len(ids), dtype=np.int64)
+    positions[order] = np.searchsorted(keys, ids[order])
+    positions[positions == len(keys)] = 0
+    return positions, keys[positions] == ids
+
+
+def read_merges(csv_path: str, chunk_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(old ids, merge_into ids) from the first two columns of the merge CSV, in file order."""
+    olds = []
+    targets = []
+    for chunk in pd.read_csv(csv_path, usecols=[0, 1], chunksize=chunk_size):
+        chunk = chunk.dropna()
+        olds.append(parse_author_ids(chunk.iloc[:, 0]))
+        targets.append(parse_author_ids(chunk.iloc[:, 1]))
+        logger.info(f"read {sum(len(o) for o in olds)} rows")
+    return np.concatenate(olds), np.concatenate(targets)
+
+
+def build_table(olds: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    """A (2, n) int64 array: old ids, sorted, over the final id each one was merged into."""
+    keep = olds != targets
+    olds, targets = olds[keep], targets[keep]
+
+    # if an id was merged more than once, the last row in the file wins
+    reversed_olds = olds[::-1]
+    unique_olds, last = np.unique(reversed_olds, return_index=True)
+    if len(unique_olds) < len(olds):
+        logger.warning(f"{len(olds) - len(unique_olds)} rows re-merge an id that was already merged. keeping the last one")
+    olds = unique_olds
+    targets = targets[::-1][last]
+
+    # collapse chains (A1 -> A2 -> A3) so every id points straight at its final target. once an
+    # id's target isn't merged itself it's done, so each pass only looks at the ones that aren't
+    active = np.arange(len(olds))
+    cyclic = np.zeros(len(olds), dtype=bool)
+    passes = 0
+    while len(active):
+        passes += 1
+        i, merged_again = find_sorted(olds, targets[active])
+        active, i = active[merged_again], i[merged_again]
+        if passes > MAX_COLLAPSE_PASSES:
+            cyclic[active] = True
+            break
+        targets[active] = targets[i]
+        # an id that now points at itself was part of a cycle
+        self_merged = olds[active] == targets[active]
+        cyclic[active[self_merged]] = True
+        active = active[~self_merged]
+    if cyclic.any():
+        # (and ids merged into one of them)
+        logger.warning(f"dropping {cyclic.sum()} ids whose merges form a cycle")
+        olds, targets = olds[~cyclic], targets[~cyclic]
+    logger.info(f"collapsed merge chains in {passes} passes")
+    return np.stack([olds, targets])
+
+
+def save_table(table: np.ndarray, path: Union[str, Path]):
+    # write then rename, so readers never map a half-written file
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("wb") as f:
+        np.save(f, table)
+    os.replace(tmp, path)
+
+
+class AuthorRedirects:
+    """Resolves merged author ids to the ids they were finally merged into.
+
+    The table is memory-mapped (16 bytes per merged id) and searched by bisection, so it can be
+    shared between processes and only the pages touched are read. Ids that weren't merged
+    resolve to themselves.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        table = np.load(self.path, mmap_mode="r")
+        self._olds = table[0]
+        self._targets = table[1]
+
+    def __len__(self) -> int:
+        return len(self._olds)
+
+    def __contains__(self, author_id: Union[str, int]) -> bool:
+        i = parse_author_id(author_id)
+        j = np.searchsorted(self._olds, i)
+        return j < len(self._olds) and self._olds[j] == i
+
+    def resolve(self, author_id: Union[str, int]) -> Union[str, int]:
+        """The id this author was merged into, in the same form it was given (int or https://openalex.org/A... url)."""
+        i = parse_author_id(author_id)
+        j = np.searchsorted(self._olds, i)
+        if j < len(self._olds) and self._olds[j] == i:
+            i = int(self._targets[j])
+        return f"{AUTHOR_ID_PREFIX}{i}" if isinstance(author_id, str) else i
+
+    def resolve_many(self, author_ids: np.ndarray) -> np.ndarray:
+        """Resolve an array of numeric author ids at once."""
+        author_ids = np.asarray(author_ids, dtype=np.int64)
+        j, merged = find_sorted(self._olds, author_ids)
+        return np.where(merged, self._targets[j], author_ids) if len(self._olds) else author_ids.copy()
+
+
+def main(args):
+    if args.lookup:
+        redirects = AuthorRedirects(args.output)
+        for author_id in args.lookup:
+            print(f"{author_id} -> {redirects.resolve(author_id)}")
+        return
+
+    olds, targets = read_merges(args.csv, args.chunk_size)
+    table = build_table(olds, targets)
+    save_table(table, args.output)
+    logger.info(
+        f"wrote {table.shape[1]} redirects to {args.output} ({table.nbytes / 1e6:.0f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("output", help="path to the redirect table (.npy)")
+    parser.add_argument(
+        "--csv",
+        default=MERGE_AUTHORS_CSV,
+        help=f"merge CSV of (id, merge_into_id) rows (default: {MERGE_AUTHORS_CSV})",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000000)
+    parser.add_argument(
+        "--lookup",
+        nargs="+",
+        metavar="AUTHOR_ID",
+        help="instead of building, resolve these ids with an existing table",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
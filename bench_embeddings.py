@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Benchmark index size, kNN latency and recall for each embedding encoding in ingest_embeddings.py, against a local elasticsearch (8.6+)"""
+
+import sys, os, time, json
+from pathlib import Path
+from typing import Dict, List
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from ingest_embeddings import (
+    ENCODINGS,
+    encode_embeddings,
+    get_mapping,
+    get_serializer,
+    chunk_size_for,
+)
+from latency_sketch import percentiles
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+def load_vectors(args) -> np.ndarray:
+    if args.vectors_file:
+        # e.g. a sample of real embeddings saved with np.save()
+        vectors = np.load(args.vectors_file).astype(np.float32)
+        return vectors[: args.num_docs]
+    rng = np.random.default_rng(args.seed)
+    return rng.standard_normal((args.num_docs, args.dims), dtype=np.float32)
+
+
+def exact_neighbors(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    # brute force cosine neighbors on the float32 vectors, to measure recall against
+    v = encode_embeddings(vectors, "normalized")
+    q = encode_embeddings(queries, "normalized")
+    scores = q @ v.T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def load_index(es_client: Elasticsearch, index: str, vectors: np.ndarray, encoding: str) -> float:
+    if es_client.indices.exists(index=index):
+        es_client.indices.delete(index=index)
+    es_client.indices.create(
+        index=index,
+        body={
+            "settings": {"number_of_shards": 1, "number_of_replicas": 0},
+            "mappings": get_mapping(vectors.shape[1], encoding),
+        },
+    )
+    encoded = encode_embeddings(vectors, encoding)
+    actions = (
+        {"_index": index, "_id": i, "_source": {"work_id": i, "embedding": embedding}}
+        for i, embedding in enumerate(encoded)
+    )
+    max_chunk_bytes = 20 * 1024 * 1024
+    start = timer()
+    for ok, item in streaming_bulk(
+        es_client,
+        actions,
+        chunk_size=chunk_size_for(vectors.shape[1], encoding, max_chunk_bytes),
+        max_chunk_bytes=max_chunk_bytes,
+    ):
+        pass
+    es_client.indices.refresh(index=index)
+    es_client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    return timer() - start
+
+
+def run_queries(
+    es_client: Elasticsearch, index: str, queries: np.ndarray, encoding: str, args
+) -> Dict:
+    encoded = encode_embeddings(queries, encoding)
+    latencies = []
+    took = []
+    results = []
+    for i, query in enumerate(encoded):
+        body = {
+            "knn": {
+                "field": "embedding",
+                "query_vector": query,
+                "k": args.k,
+                "num_candidates": args.num_candidates,
+            },
+            "_source": False,
+            "size": args.k,
+        }
+        start = timer()
+        response = es_client.search(index=index, body=body, request_cache=False)
+        elapsed_ms = (timer() - start) * 1000
+        if i < args.warmup:
+            continue
+        latencies.append(elapsed_ms)
+        took.append(response["took"])
+        results.append([int(hit["_id"]) for hit in response["hits"]["hits"]])
+    return {"latencies": latencies, "took": took, "results": results}
+
+
+def recall(results: List[List[int]], exact: np.ndarray) -> float:
+    found = sum(len(set(r) & set(e)) for r, e in zip(results, exact.tolist()))
+    return found / exact.size if exact.size else 0
+
+
+def main(args):
+    es_client = Elasticsearch(args.es_url, timeout=120, serializer=get_serializer())
+    vectors = load_vectors(args)
+    rng = np.random.default_rng(args.seed + 1)
+    queries = vectors[rng.choice(len(vectors), size=args.num_queries + args.warmup)]
+    queries = queries + rng.normal(0, 0.1, queries.shape).astype(np.float32)
+    exact = exact_neighbors(vectors, queries[args.warmup:], args.k)
+    logger.info(f"{len(vectors)} vectors, {vectors.shape[1]} dims, {args.num_queries} queries")
+
+    report = {}
+    for encoding in args.encodings:
+        index = f"{args.index_prefix}-{encoding}"
+        load_seconds = load_index(es_client, index, vectors, encoding)
+        stats = es_client.indices.stats(index=index, metric="store")
+        size_bytes = stats["_all"]["primaries"]["store"]["size_in_bytes"]
+        query_results = run_queries(es_client, index, queries, encoding, args)
+        report[encoding] = {
+            "index_size_bytes": size_bytes,
+            "load_seconds": load_seconds,
+            "latency_ms": percentiles(query_results["latencies"]),
+            "took_ms": percentiles(query_results["took"]),
+            f"recall_at_{args.k}": recall(query_results["results"], exact),
+        }
+        logger.info(f"{encoding}: {json.dumps(report[encoding])}")
+        if not args.keep_indices:
+            es_client.indices.delete(index=index)
+
+    print(f"{'encoding':<12}{'size MB':>10}{'load s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'recall':>10}")
+    for encoding, r in report.items():
+        print(
+            f"{encoding:<12}{r['index_size_bytes'] / 1024 / 1024:>10.1f}{r['load_seconds']:>10.1f}"
+            f"{r['latency_ms']['p50']:>10.1f}{r['latency_ms']['p95']:>10.1f}{r['latency_ms']['p99']:>10.1f}"
+            f"{r[f'recall_at_{args.k}']:>10.3f}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--es-url",
+        default="http://localhost:9200",
+        help="local elasticsearch to benchmark against (default: http://localhost:9200)",
+    )
+    parser.add_argument(
+        "--encodings", nargs="+", choices=ENCODINGS, default=ENCODINGS
+    )
+    parser.add_argument(
+        "--vectors-file",
+        help="a .npy file of real embeddings to use instead of random vectors",
+    )
+    parser.add_argument("--num-docs", type=int, default=100000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--num-candidates", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--index-prefix", default="bench-embeddings")
+    parser.add_argument(
+        "--keep-indices", action="store_true", help="don't delete the benchmark indices"
+    )
+    parser.add_argument("--output", help="save the results as json to this path")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
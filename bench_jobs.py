@@ -0,0 +1,767 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Run the batch jobs against local stand-ins for the OpenAlex API, postgres and elasticsearch, record wall time, API requests and peak memory for each, and compare with a saved baseline"""
+
+import sys, os, time, json, random, runpy, shutil, subprocess, tempfile, threading, zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from statistics import median
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import requests
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from sqlalchemy import (
+    create_engine,
+    event,
+    text,
+    MetaData,
+    Table,
+    Column,
+    BigInteger,
+    Integer,
+    DateTime,
+    Text,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import Pool
+from bench_queries import SyntheticCorpus, TEMPLATES_DIR, WORK_TYPES
+from settings import GROUPBY_VALUES_INDEX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+REPO_DIR = Path(__file__).resolve().parent
+PRODUCTION_API_URL = "https://api.openalex.org"
+EMAIL = "dev@ourresearch.org"
+
+ENTITIES = ["works", "authors", "sources", "institutions", "concepts", "publishers", "funders"]
+BOOLEAN_FIELDS = [
+    "is_oa",
+    "has_abstract",
+    "has_pdf_url",
+    "has_raw_affiliation_string",
+    "has_raw_affiliation_strings",
+    "is_corresponding",
+    "has_references",
+    "has_doi",
+]
+
+# both match WORKS_INDEX. duplicates get an older copy in the second one, like a work that
+# changed publication year and was indexed again before the old copy was deleted
+BENCH_WORKS_INDEX = "works-v22-bench"
+BENCH_OLD_WORKS_INDEX = "works-v22-bench-old"
+BENCH_INGEST_INDEX_PREFIX = "bench-ingest-works"
+
+# with sqlite, each schema the jobs use is a separate database file attached under its name
+SQLITE_SCHEMAS = ["mid", "logs"]
+
+
+class BenchJob(NamedTuple):
+    """How to run one job against the stand-ins."""
+
+    script: str
+    needs: Tuple[str, ...]  # any of "api", "db", "postgres", "es"
+    args: Tuple[str, ...] = ()  # "{run_dir}" is replaced with the run's scratch directory
+
+
+JOBS = {
+    "log_queries": BenchJob("log_queries.py", ("api", "db")),
+    "save_groupby_values_to_es": BenchJob("save_groupby_values_to_es.py", ("api", "es")),
+    "save_parsing_data_by_publisher": BenchJob("save_parsing_data_by_publisher.py", ("api", "db")),
+    "remove_duplicates": BenchJob("remove_duplicates.py", ("api", "es")),
+    "test_ingest": BenchJob("test_ingest.py", ("db", "es")),
+    # its query uses postgres row comparisons and make_interval(), so it can't run on sqlite
+    "ingest_works": BenchJob(
+        "ingest_works.py",
+        ("postgres", "es"),
+        (
+            "--state-file",
+            "{run_dir}/watermarks.json",
+            "--safety-lag-seconds",
+            "0",
+            "--index-prefix",
+            BENCH_INGEST_INDEX_PREFIX,
+        ),
+    ),
+}
+
+
+def synthetic_fixtures(seed: int, num_publishers: int) -> Dict:
+    """API fixtures in the format record_fixtures() saves, for when there are no recorded ones."""
+    rng = random.Random(seed)
+    fixtures = {}
+    for entity in ENTITIES:
+        if entity == "works":
+            fields = ["type", "open_access.oa_status", "institutions_distinct_count", *BOOLEAN_FIELDS]
+            fields += [f"work_field_{i}" for i in range(60 - len(fields))]
+        else:
+            fields = BOOLEAN_FIELDS[:2] + [f"{entity[:-1]}_field_{i}" for i in range(13)]
+        group_by = {}
+        for field in fields:
+            if field in BOOLEAN_FIELDS:
+                keys = ["true", "false"]
+            elif field == "type":
+                keys = WORK_TYPES
+            else:
+                # mostly small, with a long tail past the 200 groups the API returns in one page
+                keys = [f"{field}-{i}" for i in range(min(int(rng.paretovariate(0.6)) + 1, 2000))]
+            group_by[field] = {
+                "status": 200,
+                "groups_count": len(keys),
+                "buckets": [
+                    {"key": key, "key_display_name": key.replace("-", " "), "count": rng.randint(1, 10 ** 6)}
+                    for key in keys[:200]
+                ],
+            }
+        fixtures[entity] = {
+            "count": rng.randint(10 ** 5, 10 ** 8),
+            "valid_fields": fields,
+            "group_by": group_by,
+        }
+    # group_bys the API refuses
+    for field in ["work_field_0", "work_field_1"]:
+        fixtures["works"]["group_by"][field] = {"status": 403}
+    fixtures["publishers"]["results"] = [
+        {
+            "id": f"https://openalex.org/P{4310310000 + i}",
+            "display_name": f"Publisher {i}",
+            "works_count": rng.randint(1, 10 ** 6),
+            "cited_by_count": rng.randint(1, 10 ** 7),
+            "ids": {"openalex": f"https://openalex.org/P{4310310000 + i}"},
+            "roles": [],
+        }
+        for i in range(num_publishers)
+    ]
+    return {"entities": fixtures}
+
+
+def record_fixtures(path: str, num_publishers: int):
+    """Save the production API's counts, valid_fields and group_by responses as fixtures."""
+    session = requests.Session()
+
+    def get(url, **params):
+        r = session.get(url, params={**params, "mailto": EMAIL})
+        try:
+            return r.status_code, r.json()
+        except ValueError:
+            return r.status_code, None
+
+    fixtures = {}
+    for entity in ENTITIES:
+        _, page = get(f"{PRODUCTION_API_URL}/{entity}", select="id")
+        _, valid_fields = get(f"{PRODUCTION_API_URL}/{entity}/valid_fields")
+        group_by = {}
+        for field in valid_fields:
+            status, page_with_results = get(f"{PRODUCTION_API_URL}/{entity}", group_by=field)
+            if status == 200 and page_with_results and "group_by" in page_with_results:
+                group_by[field] = {
+                    "status": 200,
+                    "groups_count": page_with_results["meta"].get("groups_count"),
+                    "buckets": page_with_results["group_by"],
+                }
+            else:
+                group_by[field] = {"status": status}
+        fixtures[entity] = {"count": page["meta"]["count"], "valid_fields": valid_fields, "group_by": group_by}
+        logger.info(f"recorded {len(group_by)} group_bys for {entity}")
+    _, page = get(
+        f"{PRODUCTION_API_URL}/publishers",
+        select="id,display_name,works_count,cited_by_count,ids,roles",
+        sort="works_count:desc",
+        **{"per-page": min(num_publishers, 200)},
+    )
+    fixtures["publishers"]["results"] = page["results"][:num_publishers]
+    Path(path).write_text(json.dumps({"entities": fixtures}))
+
+
+class FakeApi:
+    """A local stand-in for api.openalex.org, serving fixtures with injected latency and, optionally, 429s.
+
+    With `throttle_every` set, every `throttle_every`th group_by or filtered count request is answered
+    with a 429. Those are the requests every job retries; valid_fields, plain entity counts and cursor
+    listings are fetched once by some jobs, so they are never throttled. The number of 429s is fixed,
+    but which requests get them depends on thread timing in the concurrent jobs.
+
+    Work ids in `works` listings (what remove_duplicates pages through) are the synthetic ones loaded
+    into elasticsearch.
+    """
+
+    def __init__(self, fixtures: Dict, num_works: int, latency_ms: float, jitter_ms: float, throttle_every: int, seed: int):
+        self.entities = fixtures["entities"]
+        self.num_works = num_works
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_every = throttle_every
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.throttleable = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = 0
+            self.throttleable = 0
+            self.throttled = 0
+
+    def _listing(self, entity: str, fixture: Dict, params: Dict) -> Tuple[int, Dict]:
+        per_page = int(params.get("per-page", params.get("per_page", 25)))
+        cursor = params["cursor"]
+        start = 0 if cursor == "*" else int(cursor)
+        if entity == "works":
+            total = self.num_works
+            results = [{"id": f"https://openalex.org/W{i}"} for i in range(start + 1, min(start + per_page, total) + 1)]
+        else:
+            total = len(fixture.get("results", []))
+            results = fixture.get("results", [])[start : start + per_page]
+            if params.get("select"):
+                select = params["select"].split(",")
+                results = [{k: v for k, v in result.items() if k in select} for result in results]
+        next_cursor = str(start + per_page) if start + per_page < total else None
+        return 200, {"meta": {"count": total, "per_page": per_page, "next_cursor": next_cursor}, "results": results}
+
+    def respond(self, url: str) -> Tuple[int, object]:
+        parts = urlsplit(url)
+        path = parts.path.strip("/").split("/")
+        params = dict(parse_qsl(parts.query))
+        retried = "group_by" in params or (
+            "cursor" not in params and bool(params.get("filter") or params.get("search"))
+        )
+        with self._lock:
+            self.requests += 1
+            throttle = False
+            if self.throttle_every and retried:
+                self.throttleable += 1
+                throttle = self.throttleable % self.throttle_every == 0
+                if throttle:
+                    self.throttled += 1
+            delay = max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms))
+        time.sleep(delay / 1000)
+        if throttle:
+            return 429, {"error": "Rate limit exceeded", "message": "Too many requests"}
+
+        fixture = self.entities.get(path[0])
+        if fixture is None:
+            return 404, {"error": "Not found", "message": f"unknown endpoint {parts.path}"}
+        if len(path) == 2 and path[1] == "valid_fields":
+            return 200, fixture["valid_fields"]
+        if "group_by" in params:
+            recorded = fixture["group_by"].get(params["group_by"])
+            if recorded is None or recorded["status"] != 200:
+                status = recorded["status"] if recorded else 403
+                return status, {"error": "Invalid query parameters error.", "message": f"can't group by {params['group_by']}"}
+            return 200, {
+                "meta": {"count": sum(b["count"] for b in recorded["buckets"]), "groups_count": recorded["groups_count"]},
+                "results": [],
+                "group_by": recorded["buckets"],
+            }
+        if "cursor" in params:
+            return self._listing(path[0], fixture, params)
+        # a stable, made-up count for each filter or search
+        narrowing = params.get("filter", "") + params.get("search", "")
+        count = fixture["count"] * (zlib.crc32(narrowing.encode()) % 1000) // 1000 if narrowing else fixture["count"]
+        return 200, {"meta": {"count": count}, "results": []}
+
+    def start(self) -> str:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                status, body = api.respond(self.path)
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def attach_sqlite_schemas(db_dir: Path):
+    # so schema-qualified names like logs.count_queries work as they do in postgres
+    @event.listens_for(Pool, "connect")
+    def attach(dbapi_connection, connection_record):
+        for schema in SQLITE_SCHEMAS:
+            dbapi_connection.execute(f"ATTACH DATABASE '{db_dir / schema}.db' AS {schema}")
+
+
+def bench_tables() -> MetaData:
+    """The tables the jobs read and write, with the columns their queries use."""
+    metadata = MetaData()
+    Table(
+        "json_works_fulltext_view",
+        metadata,
+        Column("id", BigInteger, primary_key=True),
+        Column("updated", DateTime),
+        Column("json_save", Text),
+        Column("abstract", Text),
+        Column("abstract_inverted_index", Text),
+        Column("fulltext", Text),
+        Column("authors_count", Integer),
+        Column("concepts_count", Integer),
+        schema="mid",
+    )
+    Table(
+        "entity_counts",
+        metadata,
+        Column("query_timestamp", DateTime(timezone=True)),
+        *(Column(entity, BigInteger) for entity in ["works", "authors", "sources", "institutions", "publishers", "funders", "concepts"]),
+        schema="logs",
+    )
+    Table(
+        "count_queries",
+        metadata,
+        Column("query_timestamp", DateTime(timezone=True)),
+        Column("num_results", BigInteger),
+        Column("query_url", Text),
+        schema="logs",
+    )
+    Table(
+        "author_names",
+        metadata,
+        Column("query_timestamp", DateTime(timezone=True)),
+        Column("search_term", Text),
+        Column("num_results", BigInteger),
+        Column("query_url", Text),
+        Column("database", Text),
+        schema="logs",
+    )
+    Table(
+        "institution_scopus_compare",
+        metadata,
+        Column("collection_start", DateTime(timezone=True)),
+        Column("institution_id", BigInteger),
+        Column("ror", Text),
+        Column("display_name", Text),
+        Column("scopus_id", Text),
+        Column("num_works", BigInteger),
+        Column("num_works_article_type", BigInteger),
+        Column("num_works_has_doi", BigInteger),
+        Column("query_timestamp", DateTime(timezone=True)),
+        Column("database", Text),
+        Column("num_works_open_access", BigInteger),
+        schema="logs",
+    )
+    Table(
+        "groupbys",
+        metadata,
+        Column("query_timestamp", DateTime(timezone=True)),
+        Column("query_url", Text),
+        Column("response", Text),
+        schema="logs",
+    )
+    Table(
+        "landing_page_stats_by_publisher",
+        metadata,
+        Column("query_timestamp", DateTime),
+        Column("publisher_id", BigInteger),
+        Column("publisher_display_name", Text),
+        Column("work_type", Text),
+        Column("publication_year_range", Text),
+        *(
+            Column(name, BigInteger)
+            for name in ["works_count", "has_raw_affiliation", "is_corresponding", "has_abstract", "has_pdf_url"]
+        ),
+        Column("timestamp_collection_start", DateTime),
+        Column("is_oa", BigInteger),
+        schema="logs",
+    )
+    return metadata
+
+
+def work_updated(base: datetime, work_id: int, num_works: int) -> datetime:
+    # spread over the 20 hours before `base`, inside test_ingest's window. the milliseconds are
+    # never zero, since test_ingest compares the timestamps as strings cut to milliseconds
+    updated = base - timedelta(hours=20) * (work_id / (num_works + 1))
+    return updated.replace(microsecond=(1 + work_id % 999) * 1000)
+
+
+class Seeder:
+    """Loads the same synthetic works into the database and elasticsearch, with planted problems.
+
+    The first `num_duplicates` works have a second, older copy in elasticsearch; the next
+    `num_mismatched` have a different `updated` there; and the last `num_missing` are only in
+    the database.
+    """
+
+    def __init__(self, args, base: datetime):
+        self.args = args
+        self.base = base
+
+    def works(self):
+        corpus = SyntheticCorpus(self.args.seed)
+        for work_id in range(1, self.args.num_works + 1):
+            yield work_id, corpus.work(work_id), work_updated(self.base, work_id, self.args.num_works)
+
+    def seed_database(self, engine):
+        metadata = bench_tables()
+        if engine.dialect.name == "postgresql":
+            with engine.begin() as conn:
+                for schema in SQLITE_SCHEMAS:
+                    conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {schema}"))
+        metadata.drop_all(engine)
+        metadata.create_all(engine)
+        works_table = metadata.tables["mid.json_works_fulltext_view"]
+        batch = []
+        with engine.begin() as conn:
+            for work_id, work, updated in self.works():
+                batch.append(
+                    {
+                        "id": work_id,
+                        "updated": updated,
+                        "json_save": json.dumps(work),
+                        "abstract": None,
+                        "abstract_inverted_index": json.dumps(work["abstract_inverted_index"]),
+                        "fulltext": None,
+                        "authors_count": len(work["authorships"]),
+                        "concepts_count": len(work["concepts"]),
+                    }
+                )
+                if len(batch) == 1000:
+                    conn.execute(works_table.insert(), batch)
+                    batch = []
+            if batch:
+                conn.execute(works_table.insert(), batch)
+
+    def es_actions(self):
+        args = self.args
+        for work_id, work, updated in self.works():
+            if work_id > args.num_works - args.num_missing:
+                continue
+            if args.num_duplicates < work_id <= args.num_duplicates + args.num_mismatched:
+                updated = updated - timedelta(minutes=1)
+            doc = {
+                **work,
+                "updated": updated.isoformat(timespec="milliseconds") + "Z",
+                "@timestamp": updated.isoformat() + "Z",
+            }
+            yield {"_index": BENCH_WORKS_INDEX, "_id": work["id"], "_source": doc}
+            if work_id <= args.num_duplicates:
+                old_doc = {**doc, "@timestamp": (updated - timedelta(days=1)).isoformat() + "Z"}
+                yield {"_index": BENCH_OLD_WORKS_INDEX, "_id": work["id"], "_source": old_doc}
+
+    def seed_elasticsearch(self, es_client: Elasticsearch):
+        delete_bench_indices(es_client)
+        body = json.loads((TEMPLATES_DIR / "works_template.json").read_text())["template"]
+        properties = body["mappings"]["properties"]
+        # the jobs look works up by id and order copies by @timestamp
+        properties["id"] = {"type": "keyword"}
+        properties["updated"] = {"type": "date"}
+        properties["@timestamp"] = {"type": "date"}
+        for index in [BENCH_WORKS_INDEX, BENCH_OLD_WORKS_INDEX]:
+            es_client.indices.create(index=index, body=body)
+        for ok, item in streaming_bulk(es_client, self.es_actions(), chunk_size=1000):
+            pass
+        # the template's refresh_interval is 1h
+        es_client.indices.refresh(index=f"{BENCH_WORKS_INDEX}*")
+
+
+def delete_bench_indices(es_client: Elasticsearch):
+    es_client.indices.delete(
+        index=f"{BENCH_WORKS_INDEX}*,{BENCH_INGEST_INDEX_PREFIX}-*,{GROUPBY_VALUES_INDEX}",
+        ignore_unavailable=True,
+    )
+
+
+def elasticsearch_available(es_client: Elasticsearch) -> bool:
+    # ping() logs the whole connection error with a traceback. one warning line is enough here
+    es_logger = logging.getLogger("elasticsearch")
+    level = es_logger.level
+    es_logger.setLevel(logging.ERROR)
+    try:
+        return es_client.ping()
+    finally:
+        es_logger.setLevel(level)
+
+
+def exec_job(script: str, argv: List[str]):
+    """Run a job script as __main__ in this process. This is what each job's subprocess runs."""
+    database_url = os.getenv("DATABASE_URL", "")
+    if database_url.startswith("sqlite"):
+        attach_sqlite_schemas(Path(make_url(database_url).database).parent)
+    sys.argv = [script, *argv]
+    runpy.run_path(str(REPO_DIR / script), run_name="__main__")
+
+
+def run_job(name: str, job: BenchJob, env: Dict, run_dir: Path) -> Dict:
+    job_args = [arg.format(run_dir=run_dir) for arg in job.args]
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--exec", job.script, *job_args]
+    log_path = run_dir / f"{name}.log"
+    start = timer()
+    with log_path.open("w") as log_file:
+        proc = subprocess.Popen(cmd, env=env, cwd=REPO_DIR, stdout=log_file, stderr=subprocess.STDOUT)
+        # wait4 gives the peak memory of this child alone
+        _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall_seconds = timer() - start
+    if proc.returncode != 0:
+        tail = log_path.read_text().splitlines()[-20:]
+        logger.error(f"{name} exited with {proc.returncode}. last lines of {log_path}:\n" + "\n".join(tail))
+    result = {
+        "exit_code": proc.returncode,
+        "wall_seconds": wall_seconds,
+        # ru_maxrss is in kilobytes on linux
+        "peak_memory_mb": rusage.ru_maxrss / 1024,
+    }
+    metrics_path = run_dir / "metrics" / f"{Path(job.script).stem}.json"
+    if metrics_path.exists():
+        job_metrics = json.loads(metrics_path.read_text())
+        metrics_path.unlink()
+        result["stages"] = job_metrics["stages"]
+        result["counters"] = {
+            c_name: sum(s["value"] for s in series) for c_name, series in job_metrics["counters"].items()
+        }
+    return result
+
+
+def compare_to_baseline(report: Dict, baseline: Dict, max_regression: float, min_regression_seconds: float) -> List[str]:
+    failures = []
+    same_settings = report["settings"] == baseline.get("settings")
+    if not same_settings:
+        logger.warning("the baseline was run with different settings. only comparing times and memory")
+    for name, result in report["jobs"].items():
+        before = baseline["jobs"].get(name)
+        if before is None or "skipped" in result or "skipped" in before:
+            continue
+        if result["wall_seconds"] > before["wall_seconds"] * (1 + max_regression) and (
+            result["wall_seconds"] - before["wall_seconds"] > min_regression_seconds
+        ):
+            failures.append(f"{name} took {result['wall_seconds']:.1f}s (baseline {before['wall_seconds']:.1f}s)")
+        if result["peak_memory_mb"] > before["peak_memory_mb"] * (1 + max_regression):
+            failures.append(f"{name} peaked at {result['peak_memory_mb']:.0f} MB (baseline {before['peak_memory_mb']:.0f} MB)")
+        if same_settings and result["api_requests"] > before["api_requests"]:
+            failures.append(f"{name} made {result['api_requests']} API requests (baseline {before['api_requests']})")
+    return failures
+
+
+def check_not_production(es_url: str, database_url: Optional[str]):
+    # the harness drops and reloads what it seeds, so never let it near the real thing
+    if es_url == os.getenv("ES_URL_PROD") or (database_url and database_url == os.getenv("DATABASE_URL")):
+        raise ValueError(
+            "--es-url and --database-url must be local stand-ins, not the ES_URL_PROD/DATABASE_URL in this environment"
+        )
+
+
+def main(args) -> int:
+    if args.record_fixtures:
+        record_fixtures(args.record_fixtures, args.num_publishers)
+        logger.info(f"saved fixtures to {args.record_fixtures}")
+        return 0
+    check_not_production(args.es_url, args.database_url)
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix="bench_jobs_"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    (work_dir / "metrics").mkdir(exist_ok=True)
+    if args.database_url:
+        database_url = args.database_url
+    else:
+        database_url = f"sqlite:///{work_dir / 'main.db'}"
+        attach_sqlite_schemas(work_dir)
+    engine = create_engine(database_url)
+    es_client = Elasticsearch(args.es_url, timeout=120)
+    have = {"api", "db"}
+    if engine.dialect.name == "postgresql":
+        have.add("postgres")
+    if elasticsearch_available(es_client):
+        have.add("es")
+    else:
+        logger.warning(f"no elasticsearch at {args.es_url}. skipping the jobs that need it")
+
+    if args.api_fixtures:
+        fixtures = json.loads(Path(args.api_fixtures).read_text())
+    else:
+        fixtures = synthetic_fixtures(args.seed, args.num_publishers)
+    throttle_every = round(1 / args.api_429_rate) if args.api_429_rate else 0
+    api = FakeApi(fixtures, args.num_works, args.api_latency_ms, args.api_jitter_ms, throttle_every, args.seed)
+    api_url = api.start()
+
+    env = {k: v for k, v in os.environ.items() if k not in ("SENTRY_DSN", "PROFILE", "METRICS_TEXTFILE_DIR")}
+    env.update(
+        {
+            "OPENALEX_API_URL": api_url,
+            "DATABASE_URL": database_url,
+            "ES_URL_PROD": args.es_url,
+            "API_KEY": "bench",
+            "METRICS_JSON_DIR": str(work_dir / "metrics"),
+        }
+    )
+    seeder = Seeder(args, base=datetime.utcnow().replace(microsecond=0) - timedelta(hours=3))
+    settings = {
+        key: getattr(args, key)
+        for key in ["seed", "num_works", "num_duplicates", "num_mismatched", "num_missing", "num_publishers", "api_fixtures", "api_429_rate"]
+    }
+    report = {"settings": settings, "jobs": {}}
+    failed = []
+    try:
+        for name in args.jobs:
+            job = JOBS[name]
+            missing = [need for need in job.needs if need not in have]
+            if missing:
+                logger.warning(f"skipping {name}: needs {', '.join(missing)}")
+                report["jobs"][name] = {"skipped": f"needs {', '.join(missing)}"}
+                continue
+            runs = []
+            for _ in range(args.repeat):
+                # every run starts from the same data, since the jobs change it
+                if "db" in job.needs or "postgres" in job.needs:
+                    seeder.seed_database(engine)
+                if "es" in job.needs:
+                    seeder.seed_elasticsearch(es_client)
+                (work_dir / "watermarks.json").unlink(missing_ok=True)
+                api.reset_counts()
+                result = run_job(name, job, env, work_dir)
+                result["api_requests"] = api.requests
+                result["api_throttled"] = api.throttled
+                runs.append(result)
+                logger.info(f"{name}: {json.dumps(result)}")
+            result = dict(runs[-1])
+            result["wall_seconds"] = median(r["wall_seconds"] for r in runs)
+            result["peak_memory_mb"] = max(r["peak_memory_mb"] for r in runs)
+            result["exit_code"] = next((r["exit_code"] for r in runs if r["exit_code"] != 0), 0)
+            if result["exit_code"] != 0:
+                failed.append(name)
+            report["jobs"][name] = result
+    finally:
+        api.stop()
+        if "es" in have and not args.keep_data:
+            delete_bench_indices(es_client)
+        if not args.keep_data and not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    print(f"{'job':<34}{'wall s':>10}{'peak MB':>10}{'API reqs':>10}{'429s':>8}{'exit':>6}")
+    for name, r in report["jobs"].items():
+        if "skipped" in r:
+            print(f"{name:<34}  skipped ({r['skipped']})")
+            continue
+        print(
+            f"{name:<34}{r['wall_seconds']:>10.1f}{r['peak_memory_mb']:>10.0f}{r['api_requests']:>10}"
+            f"{r['api_throttled']:>8}{r['exit_code']:>6}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+    for name in failed:
+        logger.error(f"{name} failed")
+    failures = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        failures = compare_to_baseline(report, baseline, args.max_regression, args.min_regression_seconds)
+        for failure in failures:
+            logger.error(f"regression: {failure}")
+        if not failures:
+            logger.info(f"no regressions against {args.baseline}")
+    return 1 if failed or failures else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--exec":
+        # a job subprocess started by run_job(). the job sets up its own logging
+        exec_job(sys.argv[2], sys.argv[3:])
+        sys.exit(0)
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--jobs", nargs="+", choices=list(JOBS), default=list(JOBS), help="jobs to run (default: all)"
+    )
+    parser.add_argument(
+        "--es-url",
+        default="http://localhost:9200",
+        help="local elasticsearch to seed and run the jobs against (default: http://localhost:9200)",
+    )
+    parser.add_argument(
+        "--database-url",
+        help="local postgres to seed and run the jobs against. its mid and logs tables are dropped and recreated (default: sqlite files in the work dir)",
+    )
+    parser.add_argument("--api-fixtures", help="API responses saved with --record-fixtures (default: synthetic ones)")
+    parser.add_argument(
+        "--record-fixtures",
+        metavar="PATH",
+        help="instead of benchmarking, record counts, valid_fields and group_by responses from the production API to this file",
+    )
+    parser.add_argument("--api-latency-ms", type=float, default=20, help="latency added to every fake API response (default: 20)")
+    parser.add_argument("--api-jitter-ms", type=float, default=10, help="+/- random jitter on that latency (default: 10)")
+    parser.add_argument(
+        "--api-429-rate",
+        type=float,
+        default=0.0,
+        help="fraction of fake API group_by and filtered count requests answered with a 429, to exercise the jobs' retries (default: 0)",
+    )
+    parser.add_argument("--num-works", type=int, default=20000)
+    parser.add_argument("--num-duplicates", type=int, default=200, help="works with a second copy in elasticsearch")
+    parser.add_argument("--num-mismatched", type=int, default=50, help="works whose updated date differs in elasticsearch")
+    parser.add_argument("--num-missing", type=int, default=50, help="works that are only in the database")
+    parser.add_argument("--num-publishers", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=1, help="run each job this many times, and report the median wall time")
+    parser.add_argument("--work-dir", help="keep sqlite files, job logs and metrics here (default: a temporary directory)")
+    parser.add_argument(
+        "--keep-data", action="store_true", help="don't delete the seeded indices and temporary directory"
+    )
+    parser.add_argument("--output", help="save the results as json to this path (use as a baseline later)")
+    parser.add_argument("--baseline", help="fail if any job is slower, uses more memory, or makes more API requests than in this saved output")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="allowed increase in wall time or peak memory against the baseline, as a fraction (default: 0.2)",
+    )
+    parser.add_argument(
+        "--min-regression-seconds",
+        type=float,
+        default=1.0,
+        help="ignore slowdowns smaller than this (default: 1)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    exit_code = main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
+    sys.exit(exit_code)
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Micro-benchmark JsonSanitizer against the logstash-style regex passes + double parse, over a captured sample of json_save rows"""
+
+import sys, os, time, json, re
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from sqlalchemy import create_engine, text
+from json_sanitizer import JsonSanitizer, json_loads
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+def logstash_parse(json_save: str) -> Optional[Dict]:
+    # what the entity pipelines do: two gsub passes on every row, then parse, then on
+    # failure strip backslashes and parse again
+    cleaned = re.sub(r"[\r\n]", "", json_save)
+    cleaned = re.sub(r"[\t]", " ", cleaned)
+    try:
+        return json_loads(cleaned)
+    except ValueError:
+        pass
+    try:
+        return json_loads(re.sub(r"[\\]", "", cleaned))
+    except ValueError:
+        return None
+
+
+def capture_sample(table: str, limit: int, fp: Path):
+    """Save a random sample of json_save values, one json-encoded string per line so embedded newlines survive."""
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    q = f"SELECT json_save FROM {table} TABLESAMPLE SYSTEM (1) WHERE json_save IS NOT NULL LIMIT :limit"
+    with engine.connect() as conn, fp.open("w") as f:
+        for row in conn.execute(text(q), {"limit": limit}):
+            f.write(json.dumps(row[0]) + "\n")
+    logger.info(f"saved {limit} json_save values from {table} to {fp}")
+
+
+def load_sample(fp: Path) -> List[str]:
+    with fp.open() as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def time_parser(parse: Callable[[str], Optional[Dict]], sample: List[str], repeat: int) -> float:
+    """Best of `repeat` runs over the whole sample, in seconds."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = timer()
+        for json_save in sample:
+            parse(json_save)
+        best = min(best, timer() - start)
+    return best
+
+
+def main(args):
+    fp = Path(args.sample_file)
+    if args.capture:
+        capture_sample(args.capture, args.limit, fp)
+    sample = load_sample(fp)
+    logger.info(f"{len(sample)} json_save values, {sum(len(s) for s in sample) / len(sample):.0f} chars on average")
+
+    # check both give the same result before timing anything
+    sanitizer = JsonSanitizer()
+    mismatches = sum(1 for s in sample if sanitizer.parse(s) != logstash_parse(s))
+    if mismatches:
+        logger.error(f"{mismatches} values parsed differently")
+
+    logstash_seconds = time_parser(logstash_parse, sample, args.repeat)
+    sanitizer_seconds = time_parser(JsonSanitizer().parse, sample, args.repeat)
+    print(f"{'parser':<12}{'total s':>10}{'us/doc':>10}")
+    for name, seconds in [("logstash", logstash_seconds), ("sanitizer", sanitizer_seconds)]:
+        print(f"{name:<12}{seconds:>10.3f}{seconds / len(sample) * 1e6:>10.1f}")
+    print(f"speedup: {logstash_seconds / sanitizer_seconds:.2f}x")
+    print(f"outcomes: {sanitizer.stats()}")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "sample_file",
+        help="json_save sample, one json-encoded string per line",
+    )
+    parser.add_argument(
+        "--capture",
+        metavar="TABLE",
+        help="first capture a sample from this table (e.g. mid.json_authors) into sample_file, using DATABASE_URL",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=20000, help="rows to capture (default: 20000)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="timing runs; the best is reported (default: 5)"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Benchmark the query shapes in elasticsearch_templates/bench_queries.json against a synthetic works corpus in a local elasticsearch, and compare with a saved baseline"""
+
+import sys, os, time, json, random, hashlib
+from itertools import accumulate
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from datetime import date, datetime, timedelta
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from latency_sketch import percentiles
+from ingest_embeddings import get_serializer
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+TEMPLATES_DIR = Path(__file__).parent / "elasticsearch_templates"
+
+# values the query shapes filter on. each is put at PLANTED_RANK in its pool, so it's common but
+# not so common that every query matches most of the corpus
+PLANTED_RANK = 10
+PLANTED_ISSN = "2167-8359"
+PLANTED_ROR = "https://ror.org/02y3ad647"
+PLANTED_CONCEPT = "https://openalex.org/C86803240"
+PLANTED_WORD = "kangaroos"
+
+COUNTRY_CODES = ["US", "GB", "CN", "DE", "JP", "FR", "AU", "CA", "IN", "BR", "IT", "ES", "NL", "KR"]
+WORK_TYPES = ["journal-article", "book-chapter", "proceedings-article", "dataset", "book", "dissertation"]
+OA_STATUSES = ["closed", "gold", "green", "hybrid", "bronze"]
+
+
+class SyntheticCorpus:
+    """Generates work documents with the fields in works_template.json.
+
+    Venues, institutions, authors, concepts and title words are drawn from pools with a
+    long-tailed (1/rank) distribution, so terms aggregations see realistic cardinalities.
+    The same seed always gives the same documents.
+    """
+
+    def __init__(self, seed: int, num_venues=2000, num_institutions=5000, num_authors=200000, num_concepts=1000, num_words=5000):
+        self.rng = random.Random(seed)
+        self.venues = [
+            {
+                "id": f"https://openalex.org/V{i}",
+                "issn": f"{self.rng.randint(1000, 9999)}-{self.rng.randint(1000, 9999)}",
+            }
+            for i in range(1, num_venues)
+        ]
+        self.venues.insert(PLANTED_RANK, {"id": "https://openalex.org/V1983995261", "issn": PLANTED_ISSN})
+        self.institutions = [
+            {
+                "id": f"https://openalex.org/I{i}",
+                "ror": f"https://ror.org/0{i:08x}",
+                "country_code": self.rng.choice(COUNTRY_CODES),
+                "display_name": f"Institution {i}",
+                "type": self.rng.choice(["education", "company", "facility", "government"]),
+            }
+            for i in range(1, num_institutions)
+        ]
+        self.institutions.insert(
+            PLANTED_RANK,
+            {"id": "https://openalex.org/I33213144", "ror": PLANTED_ROR, "country_code": "US", "display_name": "University of Florida", "type": "education"},
+        )
+        self.concepts = [f"https://openalex.org/C{i}" for i in range(1, num_concepts)]
+        self.concepts.insert(PLANTED_RANK, PLANTED_CONCEPT)
+        self.words = [
+            "".join(self.rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(self.rng.randint(3, 10)))
+            for _ in range(num_words - 1)
+        ]
+        self.words.insert(PLANTED_RANK, PLANTED_WORD)
+        self.num_authors = num_authors
+        self._weights = {}
+
+    def _pick(self, pool: List, k: int = 1) -> List:
+        if len(pool) not in self._weights:
+            self._weights[len(pool)] = list(accumulate(1 / (rank + 1) for rank in range(len(pool))))
+        return self.rng.choices(pool, cum_weights=self._weights[len(pool)], k=k)
+
+    def work(self, work_id: int) -> Dict:
+        rng = self.rng
+        publication_date = date(1950, 1, 1) + timedelta(days=rng.randint(0, 73 * 365))
+        venue = self._pick(self.venues)[0]
+        is_oa = rng.random() < 0.4
+        oa_status = rng.choice(OA_STATUSES[1:]) if is_oa else "closed"
+        authorships = []
+        for position in range(rng.randint(1, 8)):
+            author_id = rng.randint(1, self.num_authors)
+            institutions = self._pick(self.institutions, k=rng.randint(0, 2))
+            authorships.append(
+                {
+                    "author": {
+                        "id": f"https://openalex.org/A{author_id}",
+                        "display_name": f"Author {author_id}",
+                        "orcid": None,
+                    },
+                    "author_position": "first" if position == 0 else "middle",
+                    "institutions": institutions,
+                }
+            )
+        title = " ".join(self._pick(self.words, k=rng.randint(4, 15))).capitalize()
+        return {
+            "id": f"https://openalex.org/W{work_id}",
+            "doi": f"https://doi.org/10.{rng.randint(1000, 9999)}/{work_id}",
+            "display_name": title,
+            "title": title,
+            "publication_year": publication_date.year,
+            "publication_date": publication_date.isoformat(),
+            "type": rng.choice(WORK_TYPES),
+            "is_paratext": rng.random() < 0.01,
+            "is_retracted": rng.random() < 0.001,
+            "cited_by_count": int(rng.paretovariate(1.2)) - 1,
+            "references_count": rng.randint(0, 80),
+            "host_venue": {
+                "id": venue["id"],
+                "issn": [venue["issn"]],
+                "issn_l": venue["issn"],
+                "display_name": f"Journal {venue['issn']}",
+                "publisher": "Publisher",
+                "type": "journal",
+                "is_oa": is_oa,
+            },
+            "open_access": {"is_oa": is_oa, "oa_status": oa_status, "oa_url": None},
+            "authorships": authorships,
+            "concepts": [
+                {"id": concept, "level": rng.randint(0, 3), "score": round(rng.random(), 3)}
+                for concept in dict.fromkeys(self._pick(self.concepts, k=rng.randint(1, 6)))
+            ],
+            "referenced_works": [
+                f"https://openalex.org/W{rng.randint(1, work_id + 1)}"
+                for _ in range(rng.randint(0, 20))
+            ],
+            "abstract_inverted_index": {word: [i] for i, word in enumerate(self._pick(self.words, k=20))},
+            "updated_date": datetime(2023, 1, 1).isoformat(),
+        }
+
+    def works(self, num_docs: int) -> Iterator[Dict]:
+        for work_id in range(1, num_docs + 1):
+            yield self.work(work_id)
+
+
+def load_corpus(es_client: Elasticsearch, index: str, template: Dict, num_docs: int, seed: int) -> float:
+    if es_client.indices.exists(index=index):
+        es_client.indices.delete(index=index)
+    es_client.indices.create(index=index, body=template["template"])
+    corpus = SyntheticCorpus(seed)
+    actions = (
+        {"_index": index, "_id": work["id"], "_source": work}
+        for work in corpus.works(num_docs)
+    )
+    start = timer()
+    for ok, item in streaming_bulk(es_client, actions, chunk_size=1000):
+        pass
+    # the template's refresh_interval is 1h
+    es_client.indices.refresh(index=index)
+    es_client.indices.forcemerge(index=index, max_num_segments=1, request_timeout=3600)
+    return timer() - start
+
+
+def result_fingerprint(response: Dict) -> str:
+    """Hash of the hit count and aggregation buckets, which are deterministic for a given corpus.
+    Hit order isn't included since ties can be broken differently."""
+    aggs = {
+        name: [(b["key"], b["doc_count"]) for b in agg.get("buckets", [])]
+        for name, agg in response.get("aggregations", {}).items()
+    }
+    summary = {"total": response["hits"]["total"], "aggs": aggs}
+    return hashlib.sha1(json.dumps(summary, sort_keys=True).encode()).hexdigest()
+
+
+def run_shape(es_client: Elasticsearch, index: str, body: Dict, warmup: int, iterations: int) -> Dict:
+    latencies = []
+    took = []
+    for i in range(warmup + iterations):
+        start = timer()
+        response = es_client.search(index=index, body=body, request_cache=False)
+        elapsed_ms = (timer() - start) * 1000
+        if i < warmup:
+            continue
+        latencies.append(elapsed_ms)
+        took.append(response["took"])
+    return {
+        "latency_ms": percentiles(latencies),
+        "took_ms": percentiles(took),
+        "hits": response["hits"]["total"]["value"],
+        "fingerprint": result_fingerprint(response),
+    }
+
+
+def compare_to_baseline(report: Dict, baseline: Dict, max_regression: float, min_regression_ms: float) -> List[str]:
+    """Returns a description of each regression. Latency regresses if it's more than max_regression
+    (a fraction) and min_regression_ms slower than the baseline at p50 or p95."""
+    failures = []
+    same_corpus = report["corpus"] == baseline["corpus"]
+    if not same_corpus:
+        logger.warning(f"baseline corpus {baseline['corpus']} differs from {report['corpus']}. not comparing results")
+    for name, result in report["shapes"].items():
+        base = baseline["shapes"].get(name)
+        if base is None:
+            logger.info(f"{name}: not in the baseline")
+            continue
+        for p in ("p50", "p95"):
+            now_ms = result["latency_ms"][p]
+            base_ms = base["latency_ms"][p]
+            if now_ms > base_ms * (1 + max_regression) and now_ms - base_ms > min_regression_ms:
+                failures.append(f"{name}: {p} {base_ms:.1f} ms -> {now_ms:.1f} ms")
+        if same_corpus and result["fingerprint"] != base["fingerprint"]:
+            failures.append(f"{name}: results changed ({base['hits']} hits -> {result['hits']} hits)")
+    return failures
+
+
+def main(args) -> int:
+    es_client = Elasticsearch(args.es_url, timeout=120, serializer=get_serializer())
+    template = json.loads(Path(args.template).read_text())
+    shapes = json.loads(Path(args.queries).read_text())
+    if args.shapes:
+        shapes = [shape for shape in shapes if shape["name"] in args.shapes]
+
+    if not args.skip_load:
+        load_seconds = load_corpus(es_client, args.index, template, args.num_docs, args.seed)
+        logger.info(f"loaded {args.num_docs} synthetic works in {format_timespan(load_seconds)}")
+
+    report = {"corpus": {"num_docs": args.num_docs, "seed": args.seed}, "shapes": {}}
+    for shape in shapes:
+        report["shapes"][shape["name"]] = run_shape(
+            es_client, args.index, shape["body"], args.warmup, args.iterations
+        )
+        logger.info(f"{shape['name']}: {json.dumps(report['shapes'][shape['name']])}")
+
+    print(f"{'shape':<36}{'hits':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'took p50':>10}")
+    for name, r in report["shapes"].items():
+        print(
+            f"{name:<36}{r['hits']:>10}{r['latency_ms']['p50']:>10.1f}{r['latency_ms']['p95']:>10.1f}"
+            f"{r['latency_ms']['p99']:>10.1f}{r['took_ms']['p50']:>10.1f}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+    if not args.skip_load and not args.keep_index:
+        es_client.indices.delete(index=args.index)
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        failures = compare_to_baseline(report, baseline, args.max_regression, args.min_regression_ms)
+        for failure in failures:
+            logger.error(f"regression: {failure}")
+        if failures:
+            return 1
+        logger.info(f"no regressions against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--es-url",
+        default="http://localhost:9200",
+        help="local elasticsearch to benchmark against (default: http://localhost:9200)",
+    )
+    parser.add_argument("--index", default="bench-works")
+    parser.add_argument(
+        "--template",
+        default=str(TEMPLATES_DIR / "works_template.json"),
+        help="index template to create the benchmark index from (default: elasticsearch_templates/works_template.json)",
+    )
+    parser.add_argument(
+        "--queries",
+        default=str(TEMPLATES_DIR / "bench_queries.json"),
+        help="query shapes to run (default: elasticsearch_templates/bench_queries.json)",
+    )
+    parser.add_argument("--shapes", nargs="+", help="only run these shapes")
+    parser.add_argument("--num-docs", type=int, default=200000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument(
+        "--skip-load",
+        action="store_true",
+        help="query the existing benchmark index instead of loading a new corpus",
+    )
+    parser.add_argument(
+        "--keep-index", action="store_true", help="don't delete the benchmark index"
+    )
+    parser.add_argument("--output", help="save the results as json to this path (use as a baseline later)")
+    parser.add_argument("--baseline", help="fail if results are slower than, or differ from, this saved output")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.2,
+        help="allowed slowdown against the baseline, as a fraction (default: 0.2)",
+    )
+    parser.add_argument(
+        "--min-regression-ms",
+        type=float,
+        default=2.0,
+        help="ignore slowdowns smaller than this, which are noise on fast queries (default: 2)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    exit_code = main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
+    sys.exit(exit_code)
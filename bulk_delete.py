@@ -3,9 +3,12 @@ from elasticsearch import Elasticsearch, helpers
 from elasticsearch.helpers.errors import BulkIndexError
 
 from settings import ES_URL
+import instrumentation
+from instrumentation import metrics
 
 
 if __name__ == "__main__":
+    instrumentation.start("bulk_delete")
     es_client = Elasticsearch(ES_URL, timeout=60)
     chunk_size = 100000
     MERGE_AUTHORS_INDEX = "merge-authors"
@@ -26,4 +29,8 @@ if __name__ == "__main__":
             actions.append(action)
 
         print(f"Count is {count} with last deleted author id {openalex_id}")
-        helpers.bulk(client=es_client, actions=actions, index=AUTHORS_INDEX, ignore_status=404)
+        metrics.count("rows_read", len(actions))
+        with metrics.timer("bulk_request_seconds"):
+            success, errors = helpers.bulk(client=es_client, actions=actions, index=AUTHORS_INDEX, ignore_status=404)
+        metrics.count("bulk_items", success, outcome="ok")
+        metrics.count("bulk_items", len(actions) - success, outcome="not_found")
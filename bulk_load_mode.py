@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Restore index settings left behind by a bulk load that was killed before it could put them back"""
+
+import sys, os, json
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from settings import ES_URL
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# settings we change for the duration of a bulk load. auto_expand_replicas has to be
+# turned off too, or it overrides number_of_replicas (the works template sets it to 0-all)
+BULK_LOAD_SETTINGS = {
+    "index.auto_expand_replicas": "false",
+    "index.number_of_replicas": "0",
+    "index.refresh_interval": "-1",
+    "index.translog.durability": "async",
+}
+
+# the original settings of every index currently in bulk load mode, so they can still be
+# restored (with `python bulk_load_mode.py`) if the process is killed mid-load
+DEFAULT_STATE_FILE = os.getenv("BULK_LOAD_STATE_FILE", "bulk_load_state.json")
+
+
+def get_index_settings(
+    es_client: Elasticsearch, indices: Union[str, List[str]]
+) -> Dict[str, Dict[str, str]]:
+    """Snapshot the settings we are about to change. Settings that are not set on an index are recorded as None."""
+    response = es_client.indices.get_settings(
+        index=indices, name=list(BULK_LOAD_SETTINGS), flat_settings=True
+    )
+    return {
+        index: {name: body["settings"].get(name) for name in BULK_LOAD_SETTINGS}
+        for index, body in response.items()
+    }
+
+
+def read_state(state_file: Union[str, Path]) -> Dict[str, Dict[str, str]]:
+    path = Path(state_file)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def write_state(state_file: Union[str, Path], state: Dict[str, Dict[str, str]]):
+    # write then rename, so a kill mid-write can't lose the snapshot
+    path = Path(state_file)
+    if not state:
+        path.unlink(missing_ok=True)
+        return
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(state, indent=2))
+    os.replace(tmp, path)
+
+
+def restore_settings(
+    es_client: Elasticsearch,
+    original_settings: Dict[str, Dict[str, str]],
+    state_file: Union[str, Path] = DEFAULT_STATE_FILE,
+):
+    """Put back the original settings of each index, and drop the ones restored from the state file.
+
+    Every index is tried, even if an earlier one fails. The failed ones stay in the state file
+    and a RuntimeError listing them is raised at the end.
+    """
+    errors = {}
+    for index, settings in original_settings.items():
+        try:
+            es_client.indices.put_settings(index=index, body=settings)
+        except Exception as e:
+            logger.error(f"failed to restore settings for {index}: {e}")
+            errors[index] = e
+    state = read_state(state_file)
+    for index in original_settings:
+        if index not in errors:
+            state.pop(index, None)
+    write_state(state_file, state)
+    restored = [index for index in original_settings if index not in errors]
+    logger.info(f"restored settings for {len(restored)} indices")
+    if restored:
+        es_client.indices.refresh(index=restored)
+    if errors:
+        raise RuntimeError(
+            f"failed to restore settings for {len(errors)} indices: {', '.join(errors)}. they are still in {state_file}"
+        ) from next(iter(errors.values()))
+
+
+@contextmanager
+def bulk_load_mode(
+    es_client: Elasticsearch,
+    indices: Union[str, List[str]],
+    force_merge: bool = False,
+    max_num_segments: int = 1,
+    state_file: Union[str, Path] = DEFAULT_STATE_FILE,
+):
+    """Tune indices for heavy writes, and put them back the way they were afterwards.
+
+    For the duration of the block: no replicas, no refresh, and async translog. Afterwards the
+    original settings are restored (settings that were not set are reset to the default)
+    and the indices are refreshed, even if the block raises. If force_merge is set, the
+    indices are force-merged once the block has finished without an error.
+
+    The original settings are saved to `state_file` before anything is changed. If the process
+    is killed before it can restore them, run `python bulk_load_mode.py` to put them back. An
+    index already in the state file keeps the settings recorded there, since its current ones
+    are left over from the killed load.
+
+    Usage:
+        with bulk_load_mode(es_client, "merge-authors"):
+            helpers.bulk(es_client, actions, index="merge-authors")
+    """
+    state = read_state(state_file)
+    original_settings = {
+        index: state.get(index, settings)
+        for index, settings in get_index_settings(es_client, indices).items()
+    }
+    write_state(state_file, {**state, **original_settings})
+    logger.info(f"bulk load mode on for {len(original_settings)} indices")
+    try:
+        for index in original_settings:
+            es_client.indices.put_settings(index=index, body=BULK_LOAD_SETTINGS)
+        yield original_settings
+    finally:
+        logger.info("bulk load mode off")
+        restore_settings(es_client, original_settings, state_file)
+    if force_merge:
+        logger.info(f"force merging to {max_num_segments} segments")
+        es_client.indices.forcemerge(
+            index=list(original_settings),
+            max_num_segments=max_num_segments,
+            request_timeout=3600,
+        )
+
+
+def main(args):
+    state = read_state(args.state_file)
+    if args.indices:
+        state = {index: settings for index, settings in state.items() if index in args.indices}
+    if not state:
+        logger.info(f"no indices to restore in {args.state_file}")
+        return
+    for index, settings in state.items():
+        logger.info(f"{index}: {settings}")
+    if args.dry_run:
+        return
+    es_client = Elasticsearch(args.es_url, timeout=60)
+    restore_settings(es_client, state, args.state_file)
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--state-file",
+        default=DEFAULT_STATE_FILE,
+        help=f"where bulk_load_mode saved the original settings (default: {DEFAULT_STATE_FILE})",
+    )
+    parser.add_argument("--indices", nargs="+", help="only restore these indices")
+    parser.add_argument("--es-url", default=ES_URL)
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only show what would be restored"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -1,27 +1,38 @@
 import pandas as pd
 from elasticsearch import Elasticsearch, helpers
 
-from settings import ES_URL
+from bulk_load_mode import bulk_load_mode
+from settings import ES_URL, MERGE_AUTHORS_CSV
+import instrumentation
+from instrumentation import metrics
 
 
 if __name__ == "__main__":
+    instrumentation.start("bulk_merge")
     es_client = Elasticsearch(ES_URL)
     chunk_size = 100000
     MERGE_AUTHORS_INDEX = "merge-authors"
     key = "https://openalex.org/A"
     count = 0
 
-    for chunk in pd.read_csv("s3://openalex-sandbox/merge-authors-2023-03-23.csv.gz", chunksize=chunk_size):
-        document_list = []
-        for index, row in chunk.iterrows():
-            count = count + 1
-            openalex_id = row[0]
-            merge_into_id = row[1]
-            doc = {
-                "id": openalex_id,
-                "merge_into_id": merge_into_id,
-            }
-            document_list.append(doc)
+    # bulk_load_mode needs the index to exist. create it the way the first bulk request would have
+    if not es_client.indices.exists(index=MERGE_AUTHORS_INDEX):
+        es_client.indices.create(index=MERGE_AUTHORS_INDEX)
+    with bulk_load_mode(es_client, MERGE_AUTHORS_INDEX):
+        for chunk in pd.read_csv(MERGE_AUTHORS_CSV, chunksize=chunk_size):
+            document_list = []
+            for index, row in chunk.iterrows():
+                count = count + 1
+                openalex_id = row[0]
+                merge_into_id = row[1]
+                doc = {
+                    "id": openalex_id,
+                    "merge_into_id": merge_into_id,
+                }
+                document_list.append(doc)
 
-        print(f"Count is {count}")
-        helpers.bulk(es_client, document_list, index=MERGE_AUTHORS_INDEX)
+            print(f"Count is {count}")
+            metrics.count("rows_read", len(document_list))
+            with metrics.timer("bulk_request_seconds"):
+                success, errors = helpers.bulk(es_client, document_list, index=MERGE_AUTHORS_INDEX)
+            metrics.count("bulk_items", success, outcome="ok")
@@ -2,6 +2,8 @@ import pandas as pd
 from elasticsearch_dsl import Search, connections
 from elasticsearch import ConflictError
 from settings import ES_URL, WORKS_INDEX
+import instrumentation
+from instrumentation import metrics
 
 
 def remove_duplicates():
@@ -20,10 +22,13 @@ def remove_duplicates():
         s = s.extra(size=3000)
         s = s.source(["id", "updated"])
         s = s.filter("terms", id=ids)
-        response = s.execute()
+        with metrics.timer("es_request_seconds", request="search"):
+            response = s.execute()
+        metrics.count("rows_read", len(ids))
         elastic_ids = [r.id for r in response]
         for openalex_id in ids:
             if elastic_ids.count(openalex_id) > 1:
+                metrics.count("duplicates_found")
                 find_id_and_delete(openalex_id)
         print(count)
 
@@ -44,11 +49,15 @@ def delete_from_elastic(duplicate_id, index):
         s = Search(index=index)
         s = s.filter("term", id=duplicate_id)
         s = s.source(["id", "@timestamp"])
-        s.delete()
+        with metrics.timer("es_request_seconds", request="delete"):
+            s.delete()
+        metrics.count("duplicates_deleted")
         print(f"deleted duplicate id {duplicate_id} from index {index}")
     except ConflictError:
+        metrics.count("delete_conflicts")
         print(f"conflict error while deleting duplicate id {duplicate_id} from index {index}")
 
 
 if __name__ == "__main__":
+    instrumentation.start("bulk_remove_duplicates")
     remove_duplicates()
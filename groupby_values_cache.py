@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from typing import Dict, Optional, Tuple
+from timeit import default_timer as timer
+
+from elasticsearch_dsl import Search
+from elasticsearch.exceptions import NotFoundError
+from settings import GROUPBY_VALUES_INDEX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# after a failed load, wait this long before trying again, doubling on each failure up to the ttl
+RETRY_BACKOFF_SECONDS = 5
+
+
+class GroupbyValuesCache:
+    """Holds the whole groupby_values index in memory, keyed by (entity, group_by).
+
+    The index is loaded with one scroll on first use. After `ttl` seconds, the next lookup
+    starts a refresh in a background thread and keeps serving the stale values until it finishes.
+    Only one load runs at a time: on a cold start, concurrent callers wait for the first one's.
+    If a load fails, the stale values (or nothing, on a cold start) are served and no load is
+    tried again for RETRY_BACKOFF_SECONDS, doubling after each further failure.
+
+    Usage:
+        cache = GroupbyValuesCache(ttl=3600)
+        record = cache.get("works", "type")  # {"values": [...], "buckets": [...]} or None
+    """
+
+    def __init__(self, ttl: float = 3600, using: str = "default"):
+        self.ttl = ttl
+        self.using = using
+        self._data: Dict[Tuple[str, str], Dict] = {}
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        self._failures = 0
+        self._retry_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def _fetch_all(self) -> Dict[Tuple[str, str], Dict]:
+        s = Search(using=self.using, index=GROUPBY_VALUES_INDEX)
+        s = s.source(["entity", "group_by", "values", "buckets"])
+        data = {}
+        try:
+            for hit in s.scan():
+                source = hit.to_dict()
+                data[(source["entity"], source["group_by"])] = {
+                    "values": source.get("values", []),
+                    "buckets": source.get("buckets", []),
+                }
+        except NotFoundError:
+            logger.warning(f"index {GROUPBY_VALUES_INDEX} not found. cache is empty")
+        return data
+
+    def load(self):
+        """Load the index synchronously, replacing the current contents."""
+        start = timer()
+        data = self._fetch_all()
+        with self._lock:
+            self._data = data
+            self._loaded_at = timer()
+            self.refreshes += 1
+        logger.debug(
+            f"loaded {len(data)} groupby_values records in {timer() - start:.2f} seconds"
+        )
+
+    def _load_or_back_off(self):
+        # callers hold _load_lock, so only one load runs at a time
+        try:
+            self.load()
+        except Exception:
+            with self._lock:
+                self.refresh_errors += 1
+                self._failures += 1
+                backoff = min(self.ttl, RETRY_BACKOFF_SECONDS * 2 ** (self._failures - 1))
+                self._retry_at = timer() + backoff
+            logger.exception(
+                f"error loading groupby_values cache. serving stale values, retrying in {backoff:.0f} seconds"
+            )
+        else:
+            with self._lock:
+                self._failures = 0
+                self._retry_at = 0.0
+
+    def _background_refresh(self):
+        try:
+            with self._load_lock:
+                self._load_or_back_off()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _maybe_refresh(self):
+        if timer() < self._retry_at:
+            return
+        if self._loaded_at is None:
+            with self._load_lock:
+                # another caller may have loaded (or failed to) while we waited
+                if self._loaded_at is None and timer() >= self._retry_at:
+                    self._load_or_back_off()
+            return
+        if timer() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def get(self, entity: str, group_by: str) -> Optional[Dict]:
+        """Return {"values": [...], "buckets": [...]} for an (entity, group_by), or None if there is no record."""
+        self._maybe_refresh()
+        with self._lock:
+            record = self._data.get((entity, group_by))
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return record
+
+    def get_values(self, entity: str, group_by: str) -> Optional[list]:
+        record = self.get(entity, group_by)
+        return record["values"] if record is not None else None
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "records": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "refreshes": self.refreshes,
+                "refresh_errors": self.refresh_errors,
+                "age_seconds": timer() - self._loaded_at
+                if self._loaded_at is not None
+                else None,
+            }
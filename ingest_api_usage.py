@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Parse the heroku router log feed and index it to elasticsearch, in place of the logstash_openalex_api_usage pipeline. Optionally roll requests up per minute and keep raw documents only for errors and slow requests"""
+
+import sys, os, time, json, re, hashlib, queue, socketserver, threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from latency_sketch import LatencySketch
+from settings import API_USAGE_ES_URL, API_USAGE_INDEX_PREFIX, API_USAGE_MINUTELY_INDEX_PREFIX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+TEMPLATE_PATH = Path(__file__).parent / "elasticsearch_templates" / "api_usage_rollups_template.json"
+
+# the same fields as the pipeline's grok pattern. router errors (at=error code=H12 desc="...")
+# have two extra fields, which the grok pattern doesn't allow for, so logstash drops them
+ROUTER_LINE = re.compile(
+    r'(?P<priority>\d+) <(?P<facility>\d+)>(?P<version>\d+) (?P<timestamp>\S+) (?P<app>\S+) (?P<process>.*?) - '
+    r'at=(?P<log_level>\w+) (?:code=(?P<code>\w+) desc="(?P<desc>[^"]*)" )?'
+    r'method=(?P<http_method>\w+) path="(?P<request_path>[^"]*)" host=(?P<request_host>\S+) '
+    r'request_id=(?P<request_id>[0-9a-fA-F-]+) fwd="(?P<fwd_ip>[^"]*)" dyno=(?P<dyno>\S*) '
+    r'connect=(?P<connect>\d+)ms service=(?P<service>\d+)ms status=(?P<status>\d+) bytes=(?P<bytes>\d+) '
+    r'protocol=(?P<protocol>\w+)'
+)
+
+# the fields the pipeline keeps (its prune whitelist)
+RAW_FIELDS = ["timestamp", "log_level", "http_method", "request_host", "request_id", "connect", "service", "status", "bytes", "request_path", "code", "desc"]
+QUERY_FIELDS = {"mailto", "api_key", "email"}
+
+# entity ids are the second path segment (/works/W123, /works/https://doi.org/10.1/abc), except
+# on these endpoints, where the second segment is part of the route
+ROUTE_PREFIXES = {"autocomplete", "text"}
+
+# single-entity lookups at the root: /W2741809807, /https://doi.org/10.1/abc, /doi:10.1/abc, /orcid:0000-...
+OPENALEX_ID = re.compile(r"^[WASICPFTVK]\d+$", re.IGNORECASE)
+EXTERNAL_ID_PREFIXES = {"https", "http", "doi", "orcid", "ror", "pmid"}
+
+# (path, route) pairs checked by --check
+NORMALIZE_PATH_EXAMPLES = [
+    ("/", "/"),
+    ("/works", "/works"),
+    ("/works/W2741809807", "/works/:id"),
+    ("/works/https://doi.org/10.1/abc", "/works/:id"),
+    ("/works/W2741809807/ngrams", "/works/:id/ngrams"),
+    ("/autocomplete/works", "/autocomplete/works"),
+    ("/W2741809807", "/:id"),
+    ("/a5023888391", "/:id"),
+    ("/https://doi.org/10.1/abc", "/:id"),
+    ("/doi:10.1/abc", "/:id"),
+    ("/orcid:0000-0002-1825-0097", "/:id"),
+    ("/ror:02mhbdp94", "/:id"),
+]
+
+
+def split_query(query_string: str) -> Dict[str, str]:
+    """mailto, api_key and email from a query string, like the pipeline's kv filter (which splits on & and ?).
+    Only the first value of a repeated key is kept."""
+    fields = {}
+    for pair in query_string.replace("?", "&").split("&"):
+        key, sep, value = pair.partition("=")
+        if sep and key in QUERY_FIELDS and key not in fields:
+            fields[key] = value
+    return fields
+
+
+def normalize_path(path: str) -> str:
+    """The route a path belongs to, with any entity id replaced, e.g. /works/W123 -> /works/:id"""
+    segments = [s for s in path.split("/") if s]
+    if not segments:
+        return "/"
+    if OPENALEX_ID.match(segments[0]) or segments[0].partition(":")[0].lower() in EXTERNAL_ID_PREFIXES:
+        # the rest of the path is part of the id
+        return "/:id"
+    if len(segments) == 1 or segments[0] in ROUTE_PREFIXES:
+        return "/" + "/".join(segments[:2])
+    route = f"/{segments[0]}/:id"
+    if segments[-1] == "ngrams":
+        route += "/ngrams"
+    return route
+
+
+def parse_line(line: str) -> Optional[Dict]:
+    m = ROUTER_LINE.match(line)
+    if m is None:
+        return None
+    record = m.groupdict()
+    path, _, query_string = record["request_path"].partition("?")
+    record["path"] = path
+    if query_string:
+        record.update(split_query(query_string))
+    return record
+
+
+def parse_timestamp(value: str) -> datetime:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+
+
+def raw_doc(record: Dict, ts: datetime) -> Dict:
+    # values stay strings, as logstash indexed them, so the daily indices keep the same mappings
+    doc = {field: record[field] for field in RAW_FIELDS if record.get(field) is not None}
+    for field in QUERY_FIELDS:
+        if field in record:
+            doc[field] = record[field]
+    doc["@timestamp"] = ts.isoformat()
+    return doc
+
+
+class MinuteRollups:
+    """Counts, bytes and service time sketches per (minute, route, status, api_key, mailto).
+
+    A minute is closed once a line more than `delay` newer has been seen. Lines for a minute that
+    has already been closed are counted in `late` and otherwise dropped.
+    """
+
+    def __init__(self, delay: timedelta, relative_accuracy: float):
+        self.delay = delay
+        self.relative_accuracy = relative_accuracy
+        self.open: Dict[datetime, Dict[Tuple, Dict]] = {}
+        self.closed_before: Optional[datetime] = None
+        self.late = 0
+
+    def add(self, record: Dict, ts: datetime):
+        minute = ts.replace(second=0, microsecond=0)
+        if self.closed_before is not None and minute < self.closed_before:
+            self.late += 1
+            return
+        key = (
+            normalize_path(record["path"]),
+            int(record["status"]),
+            record.get("api_key"),
+            record.get("mailto") or record.get("email"),
+        )
+        buckets = self.open.setdefault(minute, {})
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = {"count": 0, "bytes": 0, "sketch": LatencySketch(self.relative_accuracy)}
+        bucket["count"] += 1
+        bucket["bytes"] += int(record["bytes"])
+        bucket["sketch"].add(int(record["service"]))
+
+    def close(self, now: Optional[datetime] = None) -> Iterator[Dict]:
+        """Rollup documents for every minute that is done. With no `now`, closes everything."""
+        for minute in sorted(self.open):
+            if now is not None and minute + timedelta(minutes=1) + self.delay > now:
+                break
+            for (path, status, api_key, mailto), bucket in self.open.pop(minute).items():
+                sketch = bucket["sketch"]
+                yield {
+                    "@timestamp": minute.isoformat(),
+                    "path": path,
+                    "status": status,
+                    "api_key": api_key,
+                    "mailto": mailto,
+                    "count": bucket["count"],
+                    "bytes": bucket["bytes"],
+                    "service_total": sketch.total,
+                    "service_max": sketch.max,
+                    "service_sketch": sketch.to_dict(),
+                }
+            self.closed_before = minute + timedelta(minutes=1)
+
+
+def rollup_action(doc: Dict) -> Dict:
+    # the same lines always give the same ids, so replaying a log file doesn't double count
+    key = "|".join(str(doc[f]) for f in ("@timestamp", "path", "status", "api_key", "mailto"))
+    day = datetime.fromisoformat(doc["@timestamp"])
+    return {
+        "_index": f"{API_USAGE_MINUTELY_INDEX_PREFIX}-{day:%Y.%m.%d}",
+        "_id": hashlib.sha1(key.encode()).hexdigest(),
+        "_source": doc,
+    }
+
+
+def generate_actions(lines: Iterable[Optional[str]], rollups: Optional[MinuteRollups], slow_ms: int, stats: Counter) -> Iterator[Dict]:
+    """Bulk actions for the lines. A None line is an idle tick, when finished minutes can be closed."""
+    latest = None
+    latest_wall = None
+    for line in lines:
+        if line is None:
+            if rollups is not None and latest is not None:
+                # nothing has arrived for a while, so let the clock move the minutes along
+                for doc in rollups.close(latest + (datetime.now(timezone.utc) - latest_wall)):
+                    stats["rollup_docs"] += 1
+                    yield rollup_action(doc)
+            continue
+        stats["lines"] += 1
+        record = parse_line(line)
+        if record is None:
+            stats["unparsed"] += 1
+            if stats["unparsed"] <= 10:
+                logger.warning(f"could not parse: {line[:300]!r}")
+            continue
+        try:
+            ts = parse_timestamp(record["timestamp"])
+        except ValueError:
+            stats["unparsed"] += 1
+            continue
+        if latest is None or ts > latest:
+            latest = ts
+            latest_wall = datetime.now(timezone.utc)
+        keep_raw = rollups is None or int(record["status"]) >= 500 or record["code"] is not None or int(record["service"]) >= slow_ms
+        if keep_raw:
+            stats["raw"] += 1
+            yield {"_index": f"{API_USAGE_INDEX_PREFIX}-{ts:%Y.%m.%d}", "_source": raw_doc(record, ts)}
+        if rollups is not None:
+            rollups.add(record, ts)
+            stats["rolled_up"] += 1
+            for doc in rollups.close(latest):
+                stats["rollup_docs"] += 1
+                yield rollup_action(doc)
+    if rollups is not None:
+        for doc in rollups.close():
+            stats["rollup_docs"] += 1
+            yield rollup_action(doc)
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for raw in self.rfile:
+            self.server.lines.put(raw.decode("utf-8", errors="replace").rstrip("\r\n"))
+
+
+def listen(port: int, idle_seconds: float) -> Iterator[Optional[str]]:
+    """Lines from the heroku log drain (newline-delimited, like the pipeline's tcp input), with a None every idle_seconds of quiet."""
+    server = socketserver.ThreadingTCPServer(("0.0.0.0", port), LineHandler)
+    server.daemon_threads = True
+    server.lines = queue.Queue(maxsize=100000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"listening on port {port}")
+    while True:
+        try:
+            yield server.lines.get(timeout=idle_seconds)
+        except queue.Empty:
+            yield None
+
+
+def read_files(paths) -> Iterator[str]:
+    for path in paths:
+        with (sys.stdin if path == "-" else open(path, errors="replace")) as f:
+            for line in f:
+                yield line.rstrip("\r\n")
+
+
+def check_parser():
+    """Checks normalize_path against NORMALIZE_PATH_EXAMPLES, and that a router line parses."""
+    wrong = [
+        (path, normalize_path(path), route)
+        for path, route in NORMALIZE_PATH_EXAMPLES
+        if normalize_path(path) != route
+    ]
+    for path, got, route in wrong:
+        logger.error(f"normalize_path({path!r}) is {got!r}, expected {route!r}")
+    line = (
+        '123 <158>1 2024-05-01T12:00:00.123456+00:00 host heroku router - at=info method=GET '
+        'path="/W2741809807?mailto=a@b.org" host=api.openalex.org request_id=0a1b2c3d-0000-4000-8000-000000000000 '
+        'fwd="1.2.3.4" dyno=web.1 connect=0ms service=42ms status=200 bytes=1234 protocol=https'
+    )
+    record = parse_line(line)
+    if record is None or record["path"] != "/W2741809807" or record.get("mailto") != "a@b.org":
+        logger.error(f"router line parsed as {record}")
+        wrong.append(line)
+    if wrong:
+        raise RuntimeError(f"parser check: {len(wrong)} failures")
+    logger.info(f"parser check passed: {len(NORMALIZE_PATH_EXAMPLES)} paths and a router line")
+
+
+def main(args):
+    if args.check:
+        check_parser()
+        return
+    es_client = Elasticsearch(API_USAGE_ES_URL, timeout=120)
+    if args.install_template:
+        template = json.loads(TEMPLATE_PATH.read_text())
+        es_client.indices.put_index_template(name="openalex-api-usage-rollups", body=template)
+        logger.info("installed the rollup index template")
+    lines = listen(args.listen, args.idle_seconds) if args.listen else read_files(args.files or ["-"])
+    rollups = (
+        MinuteRollups(timedelta(seconds=args.rollup_delay_seconds), args.relative_accuracy)
+        if args.rollups
+        else None
+    )
+    stats = Counter()
+    start = timer()
+    last_log = start
+    actions = generate_actions(lines, rollups, args.slow_ms, stats)
+    for ok, item in streaming_bulk(
+        es_client,
+        actions,
+        chunk_size=args.chunk_size,
+        raise_on_error=False,
+        max_retries=3,
+    ):
+        if not ok:
+            stats["failed"] += 1
+            if stats["failed"] <= 10:
+                logger.error(f"indexing failed: {item}")
+        if timer() - last_log > args.log_every_seconds:
+            last_log = timer()
+            elapsed = last_log - start
+            logger.info(f"{dict(stats)}, late: {rollups.late if rollups else 0}, {stats['lines'] / elapsed:.0f} lines/s")
+    elapsed = timer() - start
+    logger.info(f"done. {dict(stats)}, late: {rollups.late if rollups else 0}, {stats['lines'] / max(elapsed, 1e-9):.0f} lines/s")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("files", nargs="*", help="log files to read (default: stdin)")
+    parser.add_argument(
+        "--listen",
+        type=int,
+        metavar="PORT",
+        help="receive the log drain on this tcp port instead of reading files (the pipeline uses 8080)",
+    )
+    parser.add_argument(
+        "--rollups",
+        action="store_true",
+        help="index per-minute rollups, and raw documents only for errors and slow requests",
+    )
+    parser.add_argument(
+        "--slow-ms",
+        type=int,
+        default=int(os.getenv("API_USAGE_SLOW_MS", 2000)),
+        help="with --rollups, keep raw documents for requests at least this slow (default: 2000)",
+    )
+    parser.add_argument(
+        "--rollup-delay-seconds",
+        type=float,
+        default=120,
+        help="how long to wait for late lines before a minute is written (default: 120)",
+    )
+    parser.add_argument(
+        "--relative-accuracy",
+        type=float,
+        default=0.01,
+        help="relative error of the latency percentiles in rollups (default: 0.01)",
+    )
+    parser.add_argument(
+        "--idle-seconds",
+        type=float,
+        default=10,
+        help="with --listen, check for finished minutes after this long without a line (default: 10)",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="check the router line parser and route normalization, then exit",
+    )
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--log-every-seconds", type=float, default=60)
+    parser.add_argument(
+        "--install-template",
+        action="store_true",
+        help="first install elasticsearch_templates/api_usage_rollups_template.json",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
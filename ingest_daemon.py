@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Single ingest service for every entity: pulls updated rows from postgres and indexes them into elasticsearch, working first on whichever entity is furthest behind (replaces the per-entity logstash containers)"""
+
+import sys, os, time, json, argparse
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from sqlalchemy import create_engine, text
+from ingest_works import row_to_doc as works_row_to_doc, get_index_suffix
+from ingest_embeddings import parse_embedding, encode_embeddings, get_serializer
+from json_sanitizer import JsonSanitizer
+from watermarks import Watermark, WatermarkStore
+from work_index_map import WorkIndexMap
+from settings import ES_URL, WORKS_WRITE_INDEX_PREFIX, WORK_EMBEDDINGS_INDEX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+
+def entity_row_to_doc(row: Dict, sanitizer: JsonSanitizer) -> Optional[Dict]:
+    # same as the filters in the authors, concepts, funders, institutions, publishers, sources and venues pipelines
+    doc = {"updated": row["updated"]}
+    parsed = sanitizer.parse(row["json_save"]) if row.get("json_save") else None
+    if parsed is not None:
+        doc.update(parsed)
+    doc.pop("version", None)
+    if not doc.get("id"):
+        return None
+    doc["@timestamp"] = datetime.now(timezone.utc).isoformat()
+    doc["@version"] = "1"
+    return doc
+
+
+def works_transform(row: Dict) -> Optional[Dict]:
+    try:
+        doc = works_row_to_doc(row)
+    except ValueError as e:
+        # a row that can't be parsed would fail the same way on every run, so drop it
+        logger.warning(f"works: could not parse json_save for id {row.get('id')} ({e}). skipping")
+        return None
+    if not doc.get("id"):
+        return None
+    return doc
+
+
+def embedding_row_to_doc(row: Dict, encoding: str = "float") -> Optional[Dict]:
+    embedding = np.asarray([parse_embedding(row["embedding"])], dtype=np.float32)
+    return {
+        "work_id": row["work_id"],
+        "embedding": encode_embeddings(embedding, encoding)[0],
+        "created": row["created"],
+        "@timestamp": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+class Pipeline(NamedTuple):
+    """How to ingest one entity."""
+
+    name: str
+    table: str
+    columns: str
+    index: str  # the index, or the index prefix if `route` is set
+    transform: Callable[[Dict], Optional[Dict]]  # row -> document, or None to drop the row
+    updated_column: str = "updated"
+    id_column: str = "id"
+    doc_id_field: str = "id"
+    route: Optional[Callable[[Dict], str]] = None  # document -> index suffix
+    interval_seconds: int = 3600
+    sanitizer: Optional[JsonSanitizer] = None  # for reporting json_save parse outcomes
+
+
+def entity_pipeline(name: str, index: str) -> Pipeline:
+    sanitizer = JsonSanitizer(name)
+    return Pipeline(
+        name=name,
+        table=f"mid.json_{name}",
+        columns="id, json_save, updated",
+        index=index,
+        transform=partial(entity_row_to_doc, sanitizer=sanitizer),
+        sanitizer=sanitizer,
+    )
+
+
+PIPELINES = [
+    entity_pipeline("authors", "authors-v8"),
+    entity_pipeline("concepts", "concepts-v8"),
+    entity_pipeline("funders", "funders-v3"),
+    entity_pipeline("institutions", "institutions-v4"),
+    entity_pipeline("publishers", "publishers-v1"),
+    entity_pipeline("sources", "sources-v1"),
+    entity_pipeline("venues", "venues-v6"),
+    Pipeline(
+        name="works",
+        table="mid.json_works_fulltext_view",
+        columns="id, updated, json_save, abstract, abstract_inverted_index, fulltext, authors_count, concepts_count",
+        index=WORKS_WRITE_INDEX_PREFIX,
+        transform=works_transform,
+        route=lambda doc: get_index_suffix(doc.get("publication_year")),
+    ),
+    Pipeline(
+        name="embeddings",
+        table="mid.work_embedding",
+        columns="work_id, embedding, created",
+        index=WORK_EMBEDDINGS_INDEX,
+        transform=embedding_row_to_doc,
+        updated_column="created",
+        id_column="work_id",
+        doc_id_field="work_id",
+        interval_seconds=600,
+    ),
+]
+
+
+def pipeline_query(pipeline: Pipeline) -> str:
+    return f"""
+    SELECT {pipeline.columns}
+    FROM {pipeline.table}
+    WHERE ({pipeline.updated_column}, {pipeline.id_column}) > (:watermark_updated, :watermark_id)
+    AND {pipeline.updated_column} < now() - make_interval(secs => :safety_lag_seconds)
+    ORDER BY {pipeline.updated_column}, {pipeline.id_column}
+    LIMIT :limit
+    """
+
+
+class IngestDaemon:
+    """Runs every pipeline on one shared postgres connection pool and one elasticsearch client.
+
+    Each run of a pipeline indexes at most `max_docs_per_run` rows, then gives up its worker, so
+    an entity with a large backlog can't starve the others. Pipelines that hit the limit are
+    due again straight away; the rest wait for their interval. When more pipelines are due than
+    there are workers, the ones with the oldest watermark go first.
+    """
+
+    def __init__(self, pipelines: List[Pipeline], args):
+        self.pipelines = {p.name: p for p in pipelines}
+        self.args = args
+        self.engine = create_engine(
+            os.getenv("DATABASE_URL"), pool_size=args.workers, max_overflow=0
+        )
+        self.es_client = Elasticsearch(
+            ES_URL, timeout=60, maxsize=args.workers, serializer=get_serializer()
+        )
+        self.watermarks = WatermarkStore(args.state_file)
+        self.index_maps = {}
+        if args.works_index_map:
+            self.index_maps["works"] = WorkIndexMap(args.works_index_map)
+        for pipeline in pipelines:
+            if self.watermarks.get(pipeline.name) is None:
+                self.watermarks.set(pipeline.name, self.seed_watermark(pipeline))
+        self.last_run = {name: 0.0 for name in self.pipelines}
+        self.behind = {name: True for name in self.pipelines}
+        self.totals = {name: {"indexed": 0, "failed": 0, "moved": 0} for name in self.pipelines}
+
+    def seed_watermark(self, pipeline: Pipeline) -> Watermark:
+        logstash_state_file = None
+        if self.args.logstash_dir:
+            # the embeddings pipeline was logstash_vectors
+            logstash_name = "vectors" if pipeline.name == "embeddings" else pipeline.name
+            logstash_state_file = (
+                Path(self.args.logstash_dir) / f"logstash_{logstash_name}" / "sql_last_value.yml"
+            )
+        return self.watermarks.get_or_seed(pipeline.name, logstash_state_file)
+
+    def lag_seconds(self, pipeline: Pipeline) -> float:
+        # updated timestamps in the database are utc
+        watermark = self.watermarks.get(pipeline.name)
+        return (datetime.utcnow() - watermark.updated).total_seconds()
+
+    def stream_rows(self, pipeline: Pipeline, watermark: Watermark) -> Iterator[Dict]:
+        with self.engine.connect().execution_options(
+            stream_results=True, max_row_buffer=self.args.itersize
+        ) as conn:
+            result = conn.execute(
+                text(pipeline_query(pipeline)),
+                {
+                    "watermark_updated": watermark.updated,
+                    "watermark_id": watermark.id,
+                    "safety_lag_seconds": self.args.safety_lag_seconds,
+                    "limit": self.args.max_docs_per_run,
+                },
+            )
+            for row in result.mappings():
+                yield dict(row)
+
+    def generate_actions(
+        self, pipeline: Pipeline, rows: Iterator[Dict], pending: deque, seen: Dict
+    ) -> Iterator[Dict]:
+        index_map = self.index_maps.get(pipeline.name)
+        for row in rows:
+            seen["rows"] += 1
+            # the watermark to fall back to if anything from this row fails
+            previous = seen["watermark"]
+            seen["watermark"] = Watermark(row[pipeline.updated_column], row[pipeline.id_column])
+            doc = pipeline.transform(row)
+            if doc is None:
+                continue
+            doc_id = doc[pipeline.doc_id_field]
+            if pipeline.route is None:
+                pending.append((None, None, previous))
+                yield {"_index": pipeline.index, "_id": doc_id, "_source": doc}
+                continue
+            suffix = pipeline.route(doc)
+            if index_map is not None:
+                previous_suffix = index_map.get(doc_id)
+                if previous_suffix is not None and previous_suffix != suffix:
+                    # moved to a different index. delete the old copy in the same bulk request
+                    pending.append((doc_id, None, previous))
+                    yield {
+                        "_op_type": "delete",
+                        "_index": f"{pipeline.index}-{previous_suffix}",
+                        "_id": doc_id,
+                    }
+            pending.append((doc_id, suffix, previous))
+            yield {"_index": f"{pipeline.index}-{suffix}", "_id": doc_id, "_source": doc}
+
+    def run_pipeline(self, pipeline: Pipeline) -> Tuple[int, bool]:
+        """Index the next batch of rows for a pipeline. Returns (rows read, whether the batch was full).
+
+        The watermark is saved once the whole batch has been sent, so a crash mid-batch just repeats the batch.
+        If elasticsearch rejects anything, the watermark only moves up to the row before the first failure,
+        so that row is retried on the next run.
+        """
+        watermark = self.watermarks.get(pipeline.name)
+        index_map = self.index_maps.get(pipeline.name)
+        totals = self.totals[pipeline.name]
+        pending = deque()
+        seen = {"rows": 0, "watermark": None}
+        # set to the watermark of the row before the first failed action
+        held_at = None
+        failed_delete_id = None
+        start = timer()
+        for ok, item in streaming_bulk(
+            self.es_client,
+            self.generate_actions(
+                pipeline, self.stream_rows(pipeline, watermark), pending, seen
+            ),
+            chunk_size=self.args.chunk_size,
+            max_chunk_bytes=self.args.max_chunk_bytes,
+            raise_on_error=False,
+        ):
+            doc_id, suffix, previous = pending.popleft()
+            if "delete" in item:
+                # a 404 just means the old copy was already gone
+                if ok or item["delete"].get("status") == 404:
+                    totals["moved"] += 1
+                else:
+                    totals["failed"] += 1
+                    logger.error(f"{pipeline.name}: failed to delete old copy: {item}")
+                    # keep the old suffix in the map so the delete is retried with the row
+                    failed_delete_id = doc_id
+                    if held_at is None:
+                        held_at = previous or watermark
+                continue
+            if ok:
+                totals["indexed"] += 1
+                if index_map is not None and doc_id != failed_delete_id:
+                    index_map.set(doc_id, suffix)
+            else:
+                totals["failed"] += 1
+                logger.error(f"{pipeline.name}: failed to index: {item}")
+                if held_at is None:
+                    held_at = previous or watermark
+        if index_map is not None:
+            index_map.flush()
+        # dropped rows (no id, unparseable json) still move the watermark on, up to the first failure
+        new_watermark = held_at if held_at is not None else seen["watermark"]
+        if new_watermark is not None and new_watermark > watermark:
+            watermark = new_watermark
+            self.watermarks.set(pipeline.name, watermark)
+        if held_at is not None:
+            logger.warning(
+                f"{pipeline.name}: watermark held at {tuple(watermark)} after a failed item. it will be retried on the next run"
+            )
+        num_rows = seen["rows"]
+        elapsed = timer() - start
+        logger.info(
+            f"{pipeline.name}: {num_rows} rows in {format_timespan(elapsed)} ({num_rows / elapsed if elapsed else 0:.0f} rows/s). watermark {tuple(watermark)}"
+        )
+        # don't go straight back to a row that just failed; wait for the pipeline's interval
+        return num_rows, held_at is None and num_rows >= self.args.max_docs_per_run
+
+    def due_pipelines(self, running: set) -> List[Pipeline]:
+        now = time.monotonic()
+        due = [
+            p
+            for name, p in self.pipelines.items()
+            if name not in running
+            and (self.behind[name] or now - self.last_run[name] >= p.interval_seconds)
+        ]
+        # furthest behind first
+        return sorted(due, key=self.lag_seconds, reverse=True)
+
+    def write_status(self):
+        status = {
+            name: {
+                "lag_seconds": self.lag_seconds(p),
+                "behind": self.behind[name],
+                **self.totals[name],
+                "json_save": p.sanitizer.stats() if p.sanitizer else None,
+            }
+            for name, p in self.pipelines.items()
+        }
+        logger.info(
+            "lag: "
+            + ", ".join(f"{name} {format_timespan(s['lag_seconds'])}" for name, s in status.items())
+        )
+        if self.args.status_file:
+            Path(self.args.status_file).write_text(json.dumps(status, indent=2))
+
+    def seconds_until_due(self) -> float:
+        """How long until the next pipeline is due, capped at one tick."""
+        now = time.monotonic()
+        until_due = [
+            0.0 if self.behind[name] else self.last_run[name] + p.interval_seconds - now
+            for name, p in self.pipelines.items()
+        ]
+        return max(0.0, min(until_due + [self.args.tick_seconds]))
+
+    def wait_for_runs(self, running: Dict) -> set:
+        """Wait up to a tick for a running pipeline to finish. Returns the finished futures."""
+        if not running:
+            # wait() returns straight away with no futures, so sleep instead of spinning
+            time.sleep(self.seconds_until_due())
+            return set()
+        done, _ = wait(list(running), timeout=self.args.tick_seconds, return_when=FIRST_COMPLETED)
+        return done
+
+    def run(self):
+        running = {}  # future -> pipeline name
+        last_status = 0.0
+        with ThreadPoolExecutor(max_workers=self.args.workers) as executor:
+            while True:
+                for pipeline in self.due_pipelines(set(running.values())):
+                    if len(running) >= self.args.workers:
+                        break
+                    running[executor.submit(self.run_pipeline, pipeline)] = pipeline.name
+                if self.args.once and not running:
+                    break
+                for future in self.wait_for_runs(running):
+                    name = running.pop(future)
+                    self.last_run[name] = time.monotonic()
+                    try:
+                        _, full_batch = future.result()
+                        self.behind[name] = full_batch
+                    except Exception:
+                        logger.exception(f"{name}: run failed. will retry after its interval")
+                        self.behind[name] = False
+                    if self.args.once and not self.behind[name]:
+                        # in --once mode, each pipeline runs until it has caught up, then stops
+                        self.last_run[name] = float("inf")
+                if time.monotonic() - last_status >= self.args.status_seconds:
+                    self.write_status()
+                    last_status = time.monotonic()
+        self.write_status()
+
+
+def check_idle_tick(tick_seconds: float = 0.2, ticks: int = 3):
+    """Checks that the scheduler sleeps between ticks when nothing is due or running."""
+    daemon = IngestDaemon.__new__(IngestDaemon)  # no database or elasticsearch needed
+    daemon.pipelines = {p.name: p for p in PIPELINES}
+    daemon.args = argparse.Namespace(tick_seconds=tick_seconds)
+    daemon.last_run = {name: time.monotonic() for name in daemon.pipelines}
+    daemon.behind = {name: False for name in daemon.pipelines}
+    start = timer()
+    for _ in range(ticks):
+        if daemon.due_pipelines(set()):
+            raise RuntimeError("idle tick check: no pipeline should be due yet")
+        daemon.wait_for_runs({})
+    elapsed = timer() - start
+    if elapsed < ticks * tick_seconds * 0.9:
+        raise RuntimeError(f"idle tick check: {ticks} idle ticks took {elapsed:.3f}s. the scheduler is spinning")
+    logger.info(f"idle tick check passed: {ticks} idle ticks took {format_timespan(elapsed)}")
+
+
+def main(args):
+    if args.check:
+        check_idle_tick()
+        return
+    pipelines = PIPELINES
+    if args.pipelines:
+        pipelines = [p for p in PIPELINES if p.name in args.pipelines]
+    logger.info(f"running pipelines: {[p.name for p in pipelines]}")
+    IngestDaemon(pipelines, args).run()
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--pipelines",
+        nargs="+",
+        choices=[p.name for p in PIPELINES],
+        help="only run these pipelines (default: all)",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="run each pipeline until it has caught up, then exit (for cron)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("INGEST_WORKERS", 3)),
+        help="pipelines to run at the same time. also the size of the postgres and elasticsearch connection pools (default: 3)",
+    )
+    parser.add_argument(
+        "--state-file",
+        default=os.getenv("INGEST_WATERMARK_FILE", "watermarks.json"),
+        help="watermark store holding each pipeline's last indexed (updated, id) (default: watermarks.json)",
+    )
+    parser.add_argument(
+        "--logstash-dir",
+        help="logstash directory to take starting positions from (each pipeline's sql_last_value.yml) for pipelines with no watermark yet",
+    )
+    parser.add_argument(
+        "--works-index-map",
+        default=os.getenv("WORKS_INGEST_INDEX_MAP"),
+        help="work index map (see work_index_map.py). when set, works that move to a different year index have the old copy deleted",
+    )
+    parser.add_argument(
+        "--status-file",
+        help="write each pipeline's lag and counts to this json file",
+    )
+    parser.add_argument(
+        "--max-docs-per-run",
+        type=int,
+        default=100000,
+        help="rows a pipeline indexes before giving up its worker (default: 100000)",
+    )
+    parser.add_argument(
+        "--safety-lag-seconds",
+        type=float,
+        default=float(os.getenv("INGEST_SAFETY_LAG_SECONDS", 60)),
+        help="leave rows updated more recently than this for the next run, for in-flight transactions (default: 60)",
+    )
+    parser.add_argument("--chunk-size", type=int, default=500, help="docs per bulk request (default: 500)")
+    parser.add_argument(
+        "--max-chunk-bytes",
+        type=int,
+        default=20 * 1024 * 1024,
+        help="maximum bytes per bulk request (default: 20MB)",
+    )
+    parser.add_argument(
+        "--itersize", type=int, default=2000, help="rows fetched from the postgres cursor at a time (default: 2000)"
+    )
+    parser.add_argument(
+        "--tick-seconds", type=float, default=30, help="how often the scheduler looks for due pipelines (default: 30)"
+    )
+    parser.add_argument(
+        "--status-seconds", type=float, default=300, help="how often to log lag for every pipeline (default: 300)"
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="check that the scheduler doesn't spin while idle, then exit (needs no database or elasticsearch)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Stream new work embeddings from postgres into the work-embeddings index, with a choice of vector encoding (replaces the logstash_vectors pipeline)"""
+
+import sys, os, time, json
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterator, List, Any
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
+import numpy as np
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from elasticsearch.serializer import JSONSerializer
+from sqlalchemy import create_engine, text
+from ingest_works import peak_memory_mb
+from watermarks import (
+    Watermark,
+    WatermarkStore,
+    INITIAL_WATERMARK,
+    count_resends_avoided,
+)
+from settings import ES_URL, WORK_EMBEDDINGS_INDEX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+ENCODINGS = ["float", "normalized", "byte"]
+
+EMBEDDINGS_TABLE = "mid.work_embedding"
+PIPELINE = "embeddings"
+
+# resume exactly after the last indexed (created, work_id), and leave rows newer than the
+# safety lag for the next run, in case transactions with earlier timestamps are still in flight
+EMBEDDINGS_QUERY = f"""
+SELECT work_id, embedding, created
+FROM {EMBEDDINGS_TABLE}
+WHERE (created, work_id) > (:watermark_updated, :watermark_id)
+AND created < now() - make_interval(secs => :safety_lag_seconds)
+ORDER BY created, work_id
+"""
+
+
+class OrjsonSerializer(JSONSerializer):
+    # writes numpy arrays directly, with the shortest repr for float32 values,
+    # which keeps bulk payloads much smaller than the float64 reprs from tolist()
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        return orjson.dumps(
+            data, default=self.default, option=orjson.OPT_SERIALIZE_NUMPY
+        ).decode("utf-8")
+
+
+def get_serializer() -> JSONSerializer:
+    if orjson is None:
+        return JSONSerializer()
+    return OrjsonSerializer()
+
+
+def parse_embedding(value: Any) -> List[float]:
+    """Embeddings can come back from the driver as a list, a json string "[...]", or a postgres array string "{...}"."""
+    if isinstance(value, (list, tuple)):
+        return value
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith("{"):
+            value = "[" + value[1:-1] + "]"
+        return json_loads(value)
+    raise ValueError(f"unrecognized embedding type: {type(value)}")
+
+
+def decode_embeddings(values: List[Any]) -> np.ndarray:
+    # one (n, dims) float32 array for the whole batch
+    return np.asarray([parse_embedding(v) for v in values], dtype=np.float32)
+
+
+def encode_embeddings(embeddings: np.ndarray, encoding: str) -> np.ndarray:
+    """Encode a batch of float32 embeddings for indexing.
+
+    float: as is.
+    normalized: scaled to unit length, so the index can use dot_product similarity.
+    byte: normalized, then scaled to int8 for a dense_vector with element_type byte (elasticsearch 8.6+).
+    """
+    if encoding == "float":
+        return embeddings
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    normalized = embeddings / norms
+    if encoding == "normalized":
+        return normalized
+    if encoding == "byte":
+        return np.clip(np.rint(normalized * 127), -128, 127).astype(np.int8)
+    raise ValueError(f"unknown encoding: {encoding}")
+
+
+def get_mapping(dims: int, encoding: str) -> Dict:
+    vector = {"type": "dense_vector", "dims": dims, "index": True}
+    if encoding == "float":
+        vector["similarity"] = "cosine"
+    elif encoding == "normalized":
+        vector["similarity"] = "dot_product"
+    elif encoding == "byte":
+        vector["similarity"] = "cosine"
+        vector["element_type"] = "byte"
+    return {
+        "properties": {
+            "work_id": {"type": "keyword"},
+            "embedding": vector,
+            "created": {"type": "date"},
+        }
+    }
+
+
+def chunk_size_for(dims: int, encoding: str, max_chunk_bytes: int) -> int:
+    # rough size of one serialized document, so requests stay close to max_chunk_bytes
+    bytes_per_value = 5 if encoding == "byte" else 12
+    return max(1, max_chunk_bytes // (dims * bytes_per_value + 200))
+
+
+def stream_batches(
+    engine, watermark: Watermark, safety_lag_seconds: float, batch_size: int
+) -> Iterator[List[Dict]]:
+    # server-side cursor, so we only hold one batch of rows in memory at a time
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=batch_size
+    ) as conn:
+        result = conn.execute(
+            text(EMBEDDINGS_QUERY),
+            {
+                "watermark_updated": watermark.updated,
+                "watermark_id": watermark.id,
+                "safety_lag_seconds": safety_lag_seconds,
+            },
+        )
+        for partition in result.mappings().partitions(batch_size):
+            yield [dict(row) for row in partition]
+
+
+def generate_actions(
+    batches: Iterator[List[Dict]], index: str, encoding: str, pending: deque
+) -> Iterator[Dict]:
+    for batch in batches:
+        embeddings = encode_embeddings(
+            decode_embeddings([row["embedding"] for row in batch]), encoding
+        )
+        timestamp = datetime.now(timezone.utc).isoformat()
+        for row, embedding in zip(batch, embeddings):
+            # track each action's watermark so we only advance it
+            # once elasticsearch has acknowledged the document
+            pending.append(Watermark(row["created"], row["work_id"]))
+            yield {
+                "_index": index,
+                "_id": row["work_id"],
+                "_source": {
+                    "work_id": row["work_id"],
+                    "embedding": embedding,
+                    "created": row["created"],
+                    "@timestamp": timestamp,
+                },
+            }
+
+
+def main(args):
+    es_client = Elasticsearch(ES_URL, timeout=60, serializer=get_serializer())
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    watermarks = WatermarkStore(args.state_file)
+    watermark = watermarks.get_or_seed(PIPELINE, args.logstash_state_file)
+    logger.info(f"starting after (created, work_id) {tuple(watermark)}")
+    if args.count_resends_avoided and watermark != INITIAL_WATERMARK:
+        with engine.connect() as conn:
+            resends_avoided = count_resends_avoided(
+                conn, EMBEDDINGS_TABLE, "created", "work_id", watermark
+            )
+        watermarks.add_resends_avoided(PIPELINE, resends_avoided)
+        logger.info(
+            f"skipping {resends_avoided} already-indexed embeddings the 3 min overlap window would have re-sent"
+        )
+
+    if args.create_index:
+        es_client.indices.create(
+            index=args.index, body={"mappings": get_mapping(args.dims, args.encoding)}
+        )
+        logger.info(f"created {args.index} for {args.dims} dim {args.encoding} vectors")
+
+    chunk_size = chunk_size_for(args.dims, args.encoding, args.max_chunk_bytes)
+    logger.info(f"{args.encoding} encoding. sending up to {chunk_size} docs per bulk request")
+    pending = deque()
+    actions = generate_actions(
+        stream_batches(engine, watermark, args.safety_lag_seconds, args.batch_size),
+        args.index,
+        args.encoding,
+        pending,
+    )
+    start = timer()
+    num_indexed = 0
+    num_failed = 0
+    held_at_failure = False
+    for ok, item in streaming_bulk(
+        es_client,
+        actions,
+        chunk_size=chunk_size,
+        max_chunk_bytes=args.max_chunk_bytes,
+        raise_on_error=False,
+    ):
+        row_watermark = pending.popleft()
+        if ok:
+            num_indexed += 1
+        else:
+            num_failed += 1
+            held_at_failure = True
+            if num_failed <= 10:
+                logger.error(f"failed to index: {item}")
+        # only advance over an unbroken run of acknowledged rows, so the next run
+        # starts again from the first one that failed
+        if not held_at_failure and row_watermark > watermark:
+            watermark = row_watermark
+        if (num_indexed + num_failed) % args.checkpoint_every == 0:
+            watermarks.set(PIPELINE, watermark)
+            elapsed = timer() - start
+            logger.info(
+                f"{num_indexed} indexed, {num_failed} failed, {num_indexed / elapsed:.0f} docs/s, peak memory {peak_memory_mb():.0f} MB"
+            )
+    watermarks.set(PIPELINE, watermark)
+    if held_at_failure:
+        logger.warning(
+            f"watermark held at {tuple(watermark)}, before the first failed document. the rows after it will be re-sent next run"
+        )
+    elapsed = timer() - start
+    logger.info(
+        f"finished. {num_indexed} indexed, {num_failed} failed in {format_timespan(elapsed)} ({num_indexed / elapsed if elapsed else 0:.0f} docs/s). peak memory {peak_memory_mb():.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--state-file",
+        default=os.getenv("INGEST_WATERMARK_FILE", "watermarks.json"),
+        help="watermark store holding the last indexed (created, work_id) (default: watermarks.json)",
+    )
+    parser.add_argument(
+        "--logstash-state-file",
+        help="logstash sql_last_value.yml to start from if the watermark store has no position for embeddings yet",
+    )
+    parser.add_argument(
+        "--safety-lag-seconds",
+        type=float,
+        default=float(os.getenv("INGEST_SAFETY_LAG_SECONDS", 60)),
+        help="leave rows created more recently than this for the next run, for in-flight transactions (default: 60)",
+    )
+    parser.add_argument(
+        "--count-resends-avoided",
+        action="store_true",
+        help="count the embeddings the old 3 min overlap window would have re-sent (one extra count query)",
+    )
+    parser.add_argument(
+        "--index",
+        default=WORK_EMBEDDINGS_INDEX,
+        help=f"index to write to (default: {WORK_EMBEDDINGS_INDEX})",
+    )
+    parser.add_argument(
+        "--encoding",
+        choices=ENCODINGS,
+        default="float",
+        help="vector encoding. must match the index mapping (default: float)",
+    )
+    parser.add_argument(
+        "--dims",
+        type=int,
+        default=int(os.getenv("EMBEDDINGS_DIMS", 1536)),
+        help="embedding dimensions, used to size bulk requests and with --create-index (default: 1536)",
+    )
+    parser.add_argument(
+        "--create-index",
+        action="store_true",
+        help="create the index with a dense_vector mapping for --dims and --encoding first",
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        type=int,
+        default=int(os.getenv("EMBEDDINGS_INGEST_MAX_CHUNK_BYTES", 20 * 1024 * 1024)),
+        help="target bytes per bulk request (default: 20MB)",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=int(os.getenv("EMBEDDINGS_INGEST_BATCH_SIZE", 5000)),
+        help="rows decoded into one array at a time (default: 5000)",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=50000,
+        help="save the tracking value and log progress every n documents (default: 50000)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
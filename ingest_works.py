@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Stream updated works from postgres into the works year indices in elasticsearch (replaces the logstash_works pipeline)"""
+
+import sys, os, time, json, resource
+from collections import deque
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Any
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import parallel_bulk
+from sqlalchemy import create_engine, text
+from bulk_load_mode import bulk_load_mode
+from settings import ES_URL, WORKS_WRITE_INDEX_PREFIX
+from watermarks import (
+    Watermark,
+    WatermarkStore,
+    INITIAL_WATERMARK,
+    count_resends_avoided,
+)
+from work_index_map import WorkIndexMap
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+MAX_AUTHORSHIPS = 100
+
+WORKS_TABLE = "mid.json_works_fulltext_view"
+PIPELINE = "works"
+
+# resume exactly after the last indexed (updated, id), and leave rows newer than the
+# safety lag for the next run, in case transactions with earlier timestamps are still in flight
+WORKS_QUERY = f"""
+SELECT id, updated, json_save, abstract, abstract_inverted_index, fulltext, authors_count, concepts_count
+FROM {WORKS_TABLE}
+WHERE (updated, id) > (:watermark_updated, :watermark_id)
+AND updated < now() - make_interval(secs => :safety_lag_seconds)
+ORDER BY updated, id
+"""
+
+
+def get_index_suffix(publication_year: Any) -> str:
+    # same routing as the logstash_works pipeline
+    if publication_year is None:
+        return "invalid-data"
+    try:
+        year = int(publication_year)
+    except (TypeError, ValueError):
+        return "invalid-data"
+    if year < 1960:
+        return "1959-or-less"
+    elif year < 1970:
+        return "1960s"
+    elif year < 1980:
+        return "1970s"
+    elif year < 1990:
+        return "1980s"
+    elif year < 1995:
+        return "1990-to-1994"
+    elif year < 2000:
+        return "1995-to-1999"
+    elif year > 2025:
+        return "invalid-data"
+    else:
+        return str(year)
+
+
+def truncate_authorships(doc: Dict):
+    # same as the ruby filter in the logstash_works pipeline
+    authorships = doc.get("authorships")
+    if isinstance(authorships, list) and len(authorships) > MAX_AUTHORSHIPS:
+        doc["authorships_full"] = authorships
+        doc["authorships"] = authorships[:MAX_AUTHORSHIPS]
+        doc["authorships_truncated"] = True
+
+
+def row_to_doc(row: Dict) -> Dict:
+    """Build the elasticsearch document for a row, the same way the logstash pipeline does.
+
+    The parsed json_save fields are merged on top of the other columns.
+    """
+    # the numeric id column is only used for the watermark; the document id comes from json_save
+    doc = {k: v for k, v in row.items() if k not in ("json_save", "id")}
+    if row.get("json_save"):
+        doc.update(json_loads(row["json_save"]))
+    if "publication_year" in doc and doc["publication_year"] is not None:
+        try:
+            doc["publication_year"] = int(doc["publication_year"])
+        except (TypeError, ValueError):
+            pass
+    truncate_authorships(doc)
+    doc.pop("version", None)
+    doc["@timestamp"] = datetime.now(timezone.utc).isoformat()
+    doc["@version"] = "1"
+    return doc
+
+
+def stream_rows(
+    engine, watermark: Watermark, safety_lag_seconds: float, itersize: int
+) -> Iterator[Dict]:
+    # server-side cursor, so we only hold `itersize` rows in memory at a time
+    with engine.connect().execution_options(
+        stream_results=True, max_row_buffer=itersize
+    ) as conn:
+        result = conn.execute(
+            text(WORKS_QUERY),
+            {
+                "watermark_updated": watermark.updated,
+                "watermark_id": watermark.id,
+                "safety_lag_seconds": safety_lag_seconds,
+            },
+        )
+        for row in result.mappings():
+            yield dict(row)
+
+
+def generate_actions(
+    rows: Iterator[Dict],
+    index_prefix: str,
+    pending: deque,
+    index_map: Optional[WorkIndexMap] = None,
+) -> Iterator[Dict]:
+    for row in rows:
+        doc = row_to_doc(row)
+        if not doc.get("id"):
+            continue
+        suffix = get_index_suffix(doc.get("publication_year"))
+        if index_map is not None:
+            previous_suffix = index_map.get(doc["id"])
+            if previous_suffix is not None and previous_suffix != suffix:
+                # the work has moved to a different year index. delete the old
+                # copy in the same bulk request so we don't leave a duplicate
+                pending.append((None, doc["id"], None))
+                yield {
+                    "_op_type": "delete",
+                    "_index": f"{index_prefix}-{previous_suffix}",
+                    "_id": doc["id"],
+                }
+        # track each action's watermark so we only advance it
+        # once elasticsearch has acknowledged the document
+        pending.append((Watermark(row["updated"], row["id"]), doc["id"], suffix))
+        yield {
+            "_index": f"{index_prefix}-{suffix}",
+            "_id": doc["id"],
+            "_source": doc,
+        }
+
+
+def peak_memory_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main(args):
+    es_client = Elasticsearch(ES_URL, timeout=60)
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    watermarks = WatermarkStore(args.state_file)
+    watermark = watermarks.get_or_seed(PIPELINE, args.logstash_state_file)
+    logger.info(f"starting after (updated, id) {tuple(watermark)}")
+    if args.count_resends_avoided and watermark != INITIAL_WATERMARK:
+        with engine.connect() as conn:
+            resends_avoided = count_resends_avoided(
+                conn, WORKS_TABLE, "updated", "id", watermark
+            )
+        watermarks.add_resends_avoided(PIPELINE, resends_avoided)
+        logger.info(
+            f"skipping {resends_avoided} already-indexed documents the 3 min overlap window would have re-sent"
+        )
+
+    index_map = WorkIndexMap(args.index_map) if args.index_map else None
+
+    pending = deque()
+    actions = generate_actions(
+        stream_rows(engine, watermark, args.safety_lag_seconds, args.itersize),
+        args.index_prefix,
+        pending,
+        index_map=index_map,
+    )
+    start = timer()
+    num_indexed = 0
+    num_failed = 0
+    num_moved = 0
+    held_at_failure = False
+    failed_delete_id = None
+    if args.bulk_load_mode:
+        load_mode = bulk_load_mode(
+            es_client, f"{args.index_prefix}-*", force_merge=args.force_merge
+        )
+    else:
+        load_mode = nullcontext()
+    with load_mode:
+        # parallel_bulk only pulls from the generator when a worker thread has room
+        # in its queue, so postgres reads are throttled to elasticsearch's pace
+        for ok, item in parallel_bulk(
+            es_client,
+            actions,
+            thread_count=args.threads,
+            queue_size=args.queue_size,
+            chunk_size=args.chunk_size,
+            max_chunk_bytes=args.max_chunk_bytes,
+            raise_on_error=False,
+        ):
+            row_watermark, work_id, suffix = pending.popleft()
+            if "delete" in item:
+                # a 404 just means the old copy was already gone
+                if ok or item["delete"].get("status") == 404:
+                    num_moved += 1
+                else:
+                    num_failed += 1
+                    held_at_failure = True
+                    failed_delete_id = work_id
+                    logger.error(f"failed to delete old copy: {item}")
+                continue
+            if ok:
+                num_indexed += 1
+                # if deleting the old copy failed, leave the map pointing at it, so the
+                # delete is tried again when the row is re-sent
+                if index_map is not None and work_id != failed_delete_id:
+                    index_map.set(work_id, suffix)
+            else:
+                num_failed += 1
+                held_at_failure = True
+                if num_failed <= 10:
+                    logger.error(f"failed to index: {item}")
+            # only advance over an unbroken run of acknowledged rows, so the next run
+            # starts again from the first one that failed
+            if not held_at_failure and row_watermark > watermark:
+                watermark = row_watermark
+            if (num_indexed + num_failed) % args.checkpoint_every == 0:
+                if index_map is not None:
+                    index_map.flush()
+                watermarks.set(PIPELINE, watermark)
+                elapsed = timer() - start
+                logger.info(
+                    f"{num_indexed} indexed, {num_failed} failed, {num_moved} moved between indices, {num_indexed / elapsed:.0f} docs/s, watermark {tuple(watermark)}, peak memory {peak_memory_mb():.0f} MB"
+                )
+    if index_map is not None:
+        index_map.flush()
+    watermarks.set(PIPELINE, watermark)
+    if held_at_failure:
+        logger.warning(
+            f"watermark held at {tuple(watermark)}, before the first failed document. the rows after it will be re-sent next run"
+        )
+    elapsed = timer() - start
+    logger.info(
+        f"finished. {num_indexed} indexed, {num_failed} failed, {num_moved} moved between indices in {format_timespan(elapsed)} ({num_indexed / elapsed if elapsed else 0:.0f} docs/s). peak memory {peak_memory_mb():.0f} MB"
+    )
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--state-file",
+        default=os.getenv("INGEST_WATERMARK_FILE", "watermarks.json"),
+        help="watermark store holding the last indexed (updated, id) (default: watermarks.json)",
+    )
+    parser.add_argument(
+        "--logstash-state-file",
+        help="logstash sql_last_value.yml to start from if the watermark store has no position for works yet",
+    )
+    parser.add_argument(
+        "--safety-lag-seconds",
+        type=float,
+        default=float(os.getenv("INGEST_SAFETY_LAG_SECONDS", 60)),
+        help="leave rows updated more recently than this for the next run, for in-flight transactions (default: 60)",
+    )
+    parser.add_argument(
+        "--count-resends-avoided",
+        action="store_true",
+        help="count the documents the old 3 min overlap window would have re-sent (one extra count query)",
+    )
+    parser.add_argument(
+        "--index-prefix",
+        default=WORKS_WRITE_INDEX_PREFIX,
+        help=f"works index prefix; the year suffix is appended (default: {WORKS_WRITE_INDEX_PREFIX})",
+    )
+    parser.add_argument(
+        "--index-map",
+        default=os.getenv("WORKS_INGEST_INDEX_MAP"),
+        help="path to a work index map (see work_index_map.py). when set, a work whose publication year moves it to a different index has its old copy deleted in the same bulk request",
+    )
+    parser.add_argument(
+        "--bulk-load-mode",
+        action="store_true",
+        help="drop replicas, disable refresh and use async translog on the works indices for the duration of the run. for large catch-up loads",
+    )
+    parser.add_argument(
+        "--force-merge",
+        action="store_true",
+        help="with --bulk-load-mode, force merge the works indices after the run",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=int(os.getenv("WORKS_INGEST_THREADS", 4)),
+        help="number of parallel bulk threads (default: 4)",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=int(os.getenv("WORKS_INGEST_QUEUE_SIZE", 4)),
+        help="number of bulk chunks to buffer ahead of the bulk threads (default: 4)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=int(os.getenv("WORKS_INGEST_CHUNK_SIZE", 500)),
+        help="maximum documents per bulk request (default: 500)",
+    )
+    parser.add_argument(
+        "--max-chunk-bytes",
+        type=int,
+        default=int(os.getenv("WORKS_INGEST_MAX_CHUNK_BYTES", 50 * 1024 * 1024)),
+        help="maximum bytes per bulk request (default: 50MB)",
+    )
+    parser.add_argument(
+        "--itersize",
+        type=int,
+        default=int(os.getenv("WORKS_INGEST_ITERSIZE", 2000)),
+        help="rows fetched from the postgres cursor at a time (default: 2000)",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=50000,
+        help="save the tracking value and log progress every n documents (default: 50000)",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
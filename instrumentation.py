@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+
+import os, sys, json, atexit, threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from timeit import default_timer as timer
+
+from latency_sketch import LatencySketch
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+METRIC_PREFIX = "openalex_job"
+
+# seconds. the Prometheus client's defaults, plus longer ones for bulk requests
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+
+def _label_key(labels: Dict) -> Tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(job: str, label_key: Tuple, **extra) -> str:
+    labels = [("job", job), *label_key, *((k, str(v)) for k, v in extra.items())]
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(HISTOGRAM_BUCKETS)
+        self.sketch = LatencySketch()
+
+    def observe(self, value: float):
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+        self.sketch.add(value)
+
+
+class Metrics:
+    """Counters, stage timers and histograms for one batch job run, written out when the process exits.
+
+    There's one instance per process (`metrics`), so any module can record to it without being
+    passed anything. Everything is thread safe. Names are plain words ("api_requests", "rows_written");
+    they're prefixed and given a job label on output.
+    """
+
+    def __init__(self):
+        self.job = Path(sys.argv[0]).stem or "python"
+        self.started = time.time()
+        self.failed = False
+        self.counters: Dict[str, Dict[Tuple, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: Dict[str, Dict[Tuple, Histogram]] = defaultdict(dict)
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[name][_label_key(labels)] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            histogram = self.histograms[name].get(key)
+            if histogram is None:
+                histogram = self.histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe how long the block takes, in seconds, in the histogram `name`."""
+        start = timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timer() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator version of timer()."""
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the job. Stages can repeat (e.g. once per entity), and their times add up."""
+        start = timer()
+        try:
+            yield
+        finally:
+            elapsed = timer() - start
+            with self._lock:
+                self.stage_seconds[name] += elapsed
+            logger.debug(f"stage {name} took {elapsed:.2f} seconds")
+
+    def duration(self) -> float:
+        return time.time() - self.started
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                "job": self.job,
+                "started": self.started,
+                "duration_seconds": self.duration(),
+                "success": not self.failed,
+                "stages": dict(self.stage_seconds),
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+                    for name, series in self.counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(key),
+                            "count": h.sketch.count,
+                            "sum": h.sketch.total,
+                            "max": h.sketch.max,
+                            **h.sketch.percentiles(),
+                        }
+                        for key, h in series.items()
+                    ]
+                    for name, series in self.histograms.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        """The metrics in the Prometheus text format, for node_exporter's textfile collector."""
+        job = self.job
+        lines = []
+
+        def gauge(name: str, value: float, help_text: str, samples=None):
+            lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} gauge")
+            for labels, v in samples if samples is not None else [(_format_labels(job, ()), value)]:
+                lines.append(f"{METRIC_PREFIX}_{name}{labels} {v}")
+
+        with self._lock:
+            gauge("last_run_timestamp_seconds", self.started, "When the job started")
+            gauge("duration_seconds", self.duration(), "How long the job ran")
+            gauge("success", 0 if self.failed else 1, "1 if the job finished without an unhandled exception")
+            if self.stage_seconds:
+                gauge(
+                    "stage_seconds",
+                    None,
+                    "Time spent in each stage of the job",
+                    [(_format_labels(job, (), stage=stage), v) for stage, v in self.stage_seconds.items()],
+                )
+            for name, series in self.counters.items():
+                metric = f"{METRIC_PREFIX}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                for key, value in series.items():
+                    lines.append(f"{metric}{_format_labels(job, key)} {value}")
+            for name, series in self.histograms.items():
+                metric = f"{METRIC_PREFIX}_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for key, h in series.items():
+                    cumulative = 0
+                    for bound, count in zip(HISTOGRAM_BUCKETS, h.bucket_counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{_format_labels(job, key, le=bound)} {cumulative}")
+                    lines.append(f"{metric}_bucket{_format_labels(job, key, le='+Inf')} {h.sketch.count}")
+                    lines.append(f"{metric}_sum{_format_labels(job, key)} {h.sketch.total}")
+                    lines.append(f"{metric}_count{_format_labels(job, key)} {h.sketch.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        parts = [f"{self.job} ran for {self.duration():.1f} seconds"]
+        with self._lock:
+            if self.stage_seconds:
+                parts.append("stages: " + ", ".join(f"{k} {v:.1f}s" for k, v in self.stage_seconds.items()))
+            for name, series in self.counters.items():
+                parts.append(f"{name}: {sum(series.values()):g}")
+            for name, series in self.histograms.items():
+                for key, h in series.items():
+                    p = h.sketch.percentiles()
+                    label = f"{name}{dict(key) if key else ''}"
+                    parts.append(f"{label}: n={h.sketch.count} p50={p['p50']:.3f}s p95={p['p95']:.3f}s max={h.sketch.max:.3f}s")
+        return "; ".join(parts)
+
+
+metrics = Metrics()
+
+
+def _write_atomic(path: Path, content: str):
+    # node_exporter may read the file at any moment, so it must never see a partial one
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(content)
+    os.replace(tmp, path)
+
+
+def add_arguments(parser):
+    """Add the instrumentation flags to a script's argument parser."""
+    parser.add_argument(
+        "--metrics-dir",
+        default=os.getenv("METRICS_TEXTFILE_DIR"),
+        help="write <job>.prom here at exit, for node_exporter's textfile collector (default: $METRICS_TEXTFILE_DIR)",
+    )
+    parser.add_argument(
+        "--metrics-json",
+        default=os.getenv("METRICS_JSON_DIR"),
+        metavar="DIR",
+        help="write a <job>.json summary here at exit (default: $METRICS_JSON_DIR)",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILERS,
+        default=os.getenv("PROFILE"),
+        help="profile the run, and save the profile next to the metrics (default: $PROFILE)",
+    )
+
+
+def start(job: Optional[str] = None, args=None):
+    """Start recording for this run. Call once, near the top of the script's entry point.
+
+    Settings come from `args` (see add_arguments()) or, for scripts without an argument parser,
+    the same environment variables.
+    """
+    if job:
+        metrics.job = job
+    metrics_dir = getattr(args, "metrics_dir", None) or os.getenv("METRICS_TEXTFILE_DIR")
+    json_dir = getattr(args, "metrics_json", None) or os.getenv("METRICS_JSON_DIR")
+    profiler_name = getattr(args, "profile", None) or os.getenv("PROFILE")
+
+    previous_excepthook = sys.excepthook
+
+    def excepthook(*exc_info):
+        metrics.failed = True
+        previous_excepthook(*exc_info)
+
+    sys.excepthook = excepthook
+
+    profiler = None
+    if profiler_name == "cprofile":
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profiler_name == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            logger.error("pyinstrument is not installed. running without a profiler")
+        else:
+            profiler = Profiler()
+            profiler.start()
+
+    def finish():
+        profile_dir = Path(metrics_dir or json_dir or ".")
+        if profiler is not None:
+            profile_dir.mkdir(parents=True, exist_ok=True)
+        if profiler_name == "cprofile" and profiler is not None:
+            profiler.disable()
+            path = profile_dir / f"{metrics.job}.prof"
+            profiler.dump_stats(str(path))
+            logger.info(f"saved profile to {path}")
+        elif profiler is not None:
+            profiler.stop()
+            path = profile_dir / f"{metrics.job}.html"
+            path.write_text(profiler.output_html())
+            logger.info(f"saved profile to {path}")
+        if metrics_dir:
+            _write_atomic(Path(metrics_dir) / f"{metrics.job}.prom", metrics.to_prometheus())
+        if json_dir:
+            _write_atomic(Path(json_dir) / f"{metrics.job}.json", json.dumps(metrics.to_dict(), indent=2))
+        logger.info(metrics.summary())
+
+    atexit.register(finish)
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Rebuild the suggest index from results_v2 into a fresh index, then point the suggest alias at it (replaces the logstash_suggest pipeline)"""
+
+import sys, os, time, json
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import streaming_bulk
+from sqlalchemy import create_engine, text
+from bulk_load_mode import bulk_load_mode
+from ingest_works import peak_memory_mb
+from reindex_works import swap_alias
+from settings import ES_URL, SUGGEST_ALIAS
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# keyset pagination: each page starts where the last one ended, using the
+# primary key index, instead of sorting and skipping an ever-larger OFFSET
+SUGGEST_FIRST_PAGE_QUERY = """
+SELECT * FROM results_v2
+ORDER BY id
+LIMIT :page_size
+"""
+SUGGEST_QUERY = """
+SELECT * FROM results_v2
+WHERE id > :last_id
+ORDER BY id
+LIMIT :page_size
+"""
+
+
+def iter_rows(engine, page_size: int) -> Iterator[Dict]:
+    # only one page of rows is held in memory at a time
+    last_id = None
+    while True:
+        with engine.connect() as conn:
+            if last_id is None:
+                rows = conn.execute(
+                    text(SUGGEST_FIRST_PAGE_QUERY), {"page_size": page_size}
+                )
+            else:
+                rows = conn.execute(
+                    text(SUGGEST_QUERY), {"last_id": last_id, "page_size": page_size}
+                )
+            page = [dict(row) for row in rows.mappings()]
+        if not page:
+            return
+        yield from page
+        last_id = page[-1]["id"]
+
+
+# index settings worth carrying over from the live suggest index. the rest (uuid, creation
+# date, version, ...) belong to that particular index
+COPIED_SETTINGS = [
+    "number_of_shards",
+    "number_of_replicas",
+    "auto_expand_replicas",
+    "refresh_interval",
+    "max_result_window",
+    "analysis",
+    "similarity",
+    "max_ngram_diff",
+    "max_shingle_diff",
+]
+
+
+def indices_behind(es_client: Elasticsearch, aliases: List[str]) -> Set[str]:
+    indices = set()
+    for alias in aliases:
+        if alias and es_client.indices.exists_alias(name=alias):
+            indices.update(es_client.indices.get_alias(name=alias))
+    return indices
+
+
+def get_index_body(
+    es_client: Elasticsearch, template_path: Optional[str], copy_from: Optional[str]
+) -> Dict:
+    """Settings and mappings for the new index: from a template file, or copied from an existing index (or alias)."""
+    if template_path:
+        return json.loads(Path(template_path).read_text())["template"]
+    if copy_from and es_client.indices.exists(index=copy_from):
+        source_index, mapping = next(iter(es_client.indices.get_mapping(index=copy_from).items()))
+        index_settings = es_client.indices.get_settings(index=source_index)[source_index]["settings"]["index"]
+        logger.info(f"copying settings and mappings from {source_index}")
+        return {
+            "settings": {"index": {k: v for k, v in index_settings.items() if k in COPIED_SETTINGS}},
+            "mappings": mapping["mappings"],
+        }
+    # dynamic mapping would turn completion fields into text, so don't guess
+    raise RuntimeError(
+        f"no template for {copy_from or 'the suggest index'}. pass --template, or --copy-mapping-from an existing suggest index"
+    )
+
+
+def generate_actions(rows: Iterator[Dict], index: str) -> Iterator[Dict]:
+    for row in rows:
+        yield {"_index": index, "_id": row["id"], "_source": row}
+
+
+def main(args):
+    es_client = Elasticsearch(ES_URL, timeout=60)
+    engine = create_engine(os.getenv("DATABASE_URL"))
+    if es_client.indices.exists_alias(name=args.index):
+        raise RuntimeError(f"{args.index} is an alias. give the name of a new index")
+    body = get_index_body(es_client, args.template, args.copy_mapping_from or args.alias)
+    if es_client.indices.exists(index=args.index):
+        if not args.overwrite:
+            raise RuntimeError(
+                f"{args.index} already exists. pass --overwrite to delete it, or choose a new index name"
+            )
+        live = indices_behind(es_client, [args.alias, SUGGEST_ALIAS])
+        if args.index in live:
+            raise RuntimeError(
+                f"{args.index} is behind the {args.alias or SUGGEST_ALIAS} alias. load into a new index and let the alias move to it"
+            )
+        es_client.indices.delete(index=args.index)
+    es_client.indices.create(index=args.index, body=body)
+    logger.info(f"created {args.index}")
+
+    start = timer()
+    num_indexed = 0
+    num_failed = 0
+    # the new index isn't serving traffic until the alias flips, so skip replicas and refreshes while it fills
+    with bulk_load_mode(es_client, args.index, force_merge=True):
+        for ok, item in streaming_bulk(
+            es_client,
+            generate_actions(iter_rows(engine, args.page_size), args.index),
+            chunk_size=args.chunk_size,
+            raise_on_error=False,
+        ):
+            if ok:
+                num_indexed += 1
+            else:
+                num_failed += 1
+                if num_failed <= 10:
+                    logger.error(f"failed to index: {item}")
+            if (num_indexed + num_failed) % 100000 == 0:
+                elapsed = timer() - start
+                logger.info(
+                    f"{num_indexed} indexed, {num_failed} failed, {num_indexed / elapsed:.0f} docs/s, peak memory {peak_memory_mb():.0f} MB"
+                )
+    elapsed = timer() - start
+    logger.info(
+        f"loaded {num_indexed} docs into {args.index} ({num_failed} failed) in {format_timespan(elapsed)}. peak memory {peak_memory_mb():.0f} MB"
+    )
+    if num_failed and not args.allow_failures:
+        raise RuntimeError(
+            f"{num_failed} docs failed to index. not moving alias {args.alias}"
+        )
+    if args.alias:
+        swap_alias(es_client, args.alias, [args.index], exclude=[])
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("index", help="new index to load, e.g. suggest-v3")
+    parser.add_argument(
+        "--alias",
+        default=SUGGEST_ALIAS,
+        help=f"alias to point at the new index once it is loaded. pass an empty string to skip (default: {SUGGEST_ALIAS})",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=50000,
+        help="rows read from postgres per page. this bounds memory use (default: 50000)",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=1000, help="docs per bulk request (default: 1000)"
+    )
+    parser.add_argument(
+        "--template",
+        help="index template json ({\"template\": {\"settings\": ..., \"mappings\": ...}}) to create the index from",
+    )
+    parser.add_argument(
+        "--copy-mapping-from",
+        help="without --template, copy settings and mappings from this index or alias (default: the --alias)",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="delete the index first if it already exists. an index the alias points at is never deleted",
+    )
+    parser.add_argument(
+        "--allow-failures",
+        action="store_true",
+        help="move the alias even if some docs failed to index",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
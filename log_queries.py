@@ -27,13 +27,18 @@ from requests import JSONDecodeError, RequestException
 import backoff
 from sqlalchemy import create_engine, desc, text
 from sqlalchemy.orm import Session
+from settings import OPENALEX_API_URL
+import instrumentation
+from instrumentation import metrics
 
 API_KEY = os.getenv('API_KEY')
 
 
 def get_entity_count(entity: str) -> int:
-    url = f"https://api.openalex.org/{entity}"
-    r = requests.get(url)
+    url = f"{OPENALEX_API_URL}/{entity}"
+    with metrics.timer("api_request_seconds"):
+        r = requests.get(url)
+    metrics.count("api_requests", status=r.status_code)
     return r.json()["meta"]["count"]
 
 
@@ -67,6 +72,7 @@ def get_count_from_api(query_url: str) -> int:
     try:
         num_results = r.json()["meta"]["count"]
     except (RequestException, JSONDecodeError, KeyError, ValueError):
+        metrics.count("api_errors")
         logger.error(
             f"error when trying to make request with url {query_url}"
         )
@@ -103,6 +109,7 @@ def query_count(query_url: str, session: Session, commit=True):
         "query_url": query_url,
     }
     session.execute(text(q), params)
+    metrics.count("rows_written", table="logs.count_queries")
     if commit is True:
         session.commit()
 
@@ -110,16 +117,20 @@ def query_count(query_url: str, session: Session, commit=True):
 @backoff.on_exception(backoff.expo, RequestException, max_time=30)
 @backoff.on_predicate(backoff.expo, lambda x: x.status_code >= 429, max_time=30)
 def make_request(query_url, **kwargs):
-    r = requests.get(query_url, **kwargs)
+    with metrics.timer("api_request_seconds"):
+        r = requests.get(query_url, **kwargs)
+    metrics.count("api_requests", status=r.status_code)
     return r
 
 @backoff.on_exception(backoff.expo, RequestException, max_time=120)
 @backoff.on_predicate(backoff.expo, lambda x: x.status_code >= 429, max_time=120)
 def make_request_long_running(query_url, params=None):
-    if params is None:
-        r = requests.get(query_url)
-    else:
-        r = requests.get(query_url, params=params)
+    with metrics.timer("api_request_seconds"):
+        if params is None:
+            r = requests.get(query_url)
+        else:
+            r = requests.get(query_url, params=params)
+    metrics.count("api_requests", status=r.status_code)
     return r
 
 
@@ -142,19 +153,19 @@ def get_institution_benchmarks(session: Session, commit=True):
             query_timestamp = datetime.now(timezone.utc)
             # get data
             filters = f"institutions.id:{institution_id}"
-            url = f"https://api.openalex.org/works?filter={filters}"
+            url = f"{OPENALEX_API_URL}/works?filter={filters}"
             num_works = get_count_from_api(url)
 
             filters = f"institutions.id:{institution_id},type:journal-article|article"
-            url = f"https://api.openalex.org/works?filter={filters}"
+            url = f"{OPENALEX_API_URL}/works?filter={filters}"
             num_works_article_type = get_count_from_api(url)
 
             filters = f"institutions.id:{institution_id},has_doi:true"
-            url = f"https://api.openalex.org/works?filter={filters}"
+            url = f"{OPENALEX_API_URL}/works?filter={filters}"
             num_works_has_doi = get_count_from_api(url)
 
             filters = f"institutions.id:{institution_id},is_oa:true"
-            url = f"https://api.openalex.org/works?filter={filters}"
+            url = f"{OPENALEX_API_URL}/works?filter={filters}"
             num_works_open_access = get_count_from_api(url)
 
 
@@ -178,6 +189,7 @@ def get_institution_benchmarks(session: Session, commit=True):
                 "num_works_open_access": num_works_open_access,
             }
             session.execute(text(q), params)
+            metrics.count("rows_written", table="logs.institution_scopus_compare")
     if commit is True:
         session.commit()
 
@@ -193,15 +205,17 @@ def make_all_author_name_queries(session: Session, commit=True):
     names = fp.read_text().split("\n")
     for name in names:
         query_url = (
-            f"https://api.openalex.org/authors?search={name}&mailto=dev@ourresearch.org"
+            f"{OPENALEX_API_URL}/authors?search={name}&mailto=dev@ourresearch.org"
         )
         r = make_request(query_url)
         try:
             num_results = r.json()["meta"]["count"]
         except KeyError:
+            metrics.count("api_errors")
             logger.debug(r.status_code, r.text)
             continue
         except JSONDecodeError:
+            metrics.count("api_errors")
             logger.error(f"JSONDecodeError encountered when querying for name {name}")
             continue
         database = "openalex"
@@ -219,6 +233,7 @@ def make_all_author_name_queries(session: Session, commit=True):
             "database": database,
         }
         session.execute(text(q), params)
+        metrics.count("rows_written", table="logs.author_names")
     if commit is True:
         session.commit()
 
@@ -238,14 +253,17 @@ def query_groupby(query_url: str, session: Session, commit=True, api_key=None):
     else:
         r = make_request(query_url)
     if r.status_code == 403:
+        metrics.count("api_forbidden")
         return
     try:
         response = r.json()["group_by"]
     except KeyError:
+        metrics.count("api_errors")
         logger.error("KeyError")
         logger.error(r.status_code, r.text)
         return
     except JSONDecodeError:
+        metrics.count("api_errors")
         logger.error(f"JSONDecodeError encountered when running query {query_url}")
         return
     # insert into db
@@ -260,6 +278,7 @@ def query_groupby(query_url: str, session: Session, commit=True, api_key=None):
         "response": json.dumps(response),
     }
     session.execute(text(q), params)
+    metrics.count("rows_written", table="logs.groupbys")
     if commit is True:
         session.commit()
     return
@@ -270,7 +289,8 @@ def main(args):
     session = Session(engine)
 
     # entity counts queries
-    q_results = entity_counts_queries()
+    with metrics.stage("entity_counts"):
+        q_results = entity_counts_queries()
     params = {
         "query_timestamp": q_results["timestamp"].isoformat(),
         "works": q_results["counts"]["works"],
@@ -286,50 +306,54 @@ def main(args):
         params,
     )
     session.commit()
+    metrics.count("rows_written", table="logs.entity_counts")
 
     # make queries for author_name table
-    make_all_author_name_queries(session=session)
+    with metrics.stage("author_names"):
+        make_all_author_name_queries(session=session)
 
     # make queries for institution_scopus_compare table
-    get_institution_benchmarks(session=session)
+    with metrics.stage("institution_benchmarks"):
+        get_institution_benchmarks(session=session)
 
     # run arbitrary queries and get number of results, to store in logs.count_queries
     # TODO: this could replace entity counts queries above
     count_queries_to_run = [
         # entity counts
-        "https://api.openalex.org/works",
-        "https://api.openalex.org/authors",
-        "https://api.openalex.org/sources",
-        "https://api.openalex.org/institutions",
-        "https://api.openalex.org/publishers",
-        "https://api.openalex.org/funders",
-        "https://api.openalex.org/concepts",
-        "https://api.openalex.org/works?filter=has_doi:true",
-        "https://api.openalex.org/authors?filter=has_orcid:true",
-        "https://api.openalex.org/works?filter=is_oa:true",
-        "https://api.openalex.org/works?filter=has_references:true",
-        "https://api.openalex.org/authors?filter=works_count:0",
-        "https://api.openalex.org/authors?filter=works_count:1",
-        "https://api.openalex.org/authors?filter=works_count:%3E5000",
+        f"{OPENALEX_API_URL}/works",
+        f"{OPENALEX_API_URL}/authors",
+        f"{OPENALEX_API_URL}/sources",
+        f"{OPENALEX_API_URL}/institutions",
+        f"{OPENALEX_API_URL}/publishers",
+        f"{OPENALEX_API_URL}/funders",
+        f"{OPENALEX_API_URL}/concepts",
+        f"{OPENALEX_API_URL}/works?filter=has_doi:true",
+        f"{OPENALEX_API_URL}/authors?filter=has_orcid:true",
+        f"{OPENALEX_API_URL}/works?filter=is_oa:true",
+        f"{OPENALEX_API_URL}/works?filter=has_references:true",
+        f"{OPENALEX_API_URL}/authors?filter=works_count:0",
+        f"{OPENALEX_API_URL}/authors?filter=works_count:1",
+        f"{OPENALEX_API_URL}/authors?filter=works_count:%3E5000",
         # institution parsing
-        "https://api.openalex.org/works?filter=authorships.institutions.id:null,has_doi:true",
-        "https://api.openalex.org/works?filter=has_raw_affiliation_strings:false,has_doi:true",
-        "https://api.openalex.org/works?filter=has_raw_affiliation_strings:true,authorships.institutions.id:null,has_doi:true",
-        "https://api.openalex.org/works?filter=open_access.is_oa:true,open_access.oa_status:closed",
+        f"{OPENALEX_API_URL}/works?filter=authorships.institutions.id:null,has_doi:true",
+        f"{OPENALEX_API_URL}/works?filter=has_raw_affiliation_strings:false,has_doi:true",
+        f"{OPENALEX_API_URL}/works?filter=has_raw_affiliation_strings:true,authorships.institutions.id:null,has_doi:true",
+        f"{OPENALEX_API_URL}/works?filter=open_access.is_oa:true,open_access.oa_status:closed",
         # topics tracking
-        "https://api.openalex.org/sources?filter=topics.id:null",
-        "https://api.openalex.org/authors?filter=topics.id:null",
-        "https://api.openalex.org/institutions?filter=topics.id:null",
+        f"{OPENALEX_API_URL}/sources?filter=topics.id:null",
+        f"{OPENALEX_API_URL}/authors?filter=topics.id:null",
+        f"{OPENALEX_API_URL}/institutions?filter=topics.id:null",
         # APCs
-        "https://api.openalex.org/works?filter=apc_list.value_usd:>0",
-        "https://api.openalex.org/works?filter=apc_paid.value_usd:>0",
+        f"{OPENALEX_API_URL}/works?filter=apc_list.value_usd:>0",
+        f"{OPENALEX_API_URL}/works?filter=apc_paid.value_usd:>0",
         # FWCI
-        "https://api.openalex.org/works?filter=fwci:>0",
-        "https://api.openalex.org/works?filter=fwci:>-1",
-        "https://api.openalex.org/works?filter=citation_normalized_percentile.value:>0",
+        f"{OPENALEX_API_URL}/works?filter=fwci:>0",
+        f"{OPENALEX_API_URL}/works?filter=fwci:>-1",
+        f"{OPENALEX_API_URL}/works?filter=citation_normalized_percentile.value:>0",
     ]
-    for api_query in count_queries_to_run:
-        query_count(api_query, session=session)
+    with metrics.stage("count_queries"):
+        for api_query in count_queries_to_run:
+            query_count(api_query, session=session)
 
     # groupby queries
     entities = [
@@ -341,43 +365,47 @@ def main(args):
         "publishers",
         "funders",
     ]
-    for entity in entities:
-        valid_fields = requests.get(
-            f"https://api.openalex.org/{entity}/valid_fields"
-        ).json()
-        for field in valid_fields:
-            url = f"https://api.openalex.org/{entity}?group_by={field}&mailto=dev@ourresearch.org"
-            query_groupby(url, session=session)
+    with metrics.stage("groupby_queries"):
+        for entity in entities:
+            with metrics.timer("api_request_seconds"):
+                r = requests.get(f"{OPENALEX_API_URL}/{entity}/valid_fields")
+            metrics.count("api_requests", status=r.status_code)
+            valid_fields = r.json()
+            for field in valid_fields:
+                url = f"{OPENALEX_API_URL}/{entity}?group_by={field}&mailto=dev@ourresearch.org"
+                query_groupby(url, session=session)
     # filtered groupby queries
     filtered_groupby_queries_to_run = [
-        "https://api.openalex.org/works?filter=open_access.is_oa:true&group_by=open_access.oa_status",
-        "https://api.openalex.org/works?filter=open_access.is_oa:false&group_by=open_access.oa_status",
-        "https://api.openalex.org/works?filter=apc_list.value_usd:>0&group_by=open_access.oa_status",
-        "https://api.openalex.org/works?filter=apc_paid.value_usd:>0&group_by=open_access.oa_status",
+        f"{OPENALEX_API_URL}/works?filter=open_access.is_oa:true&group_by=open_access.oa_status",
+        f"{OPENALEX_API_URL}/works?filter=open_access.is_oa:false&group_by=open_access.oa_status",
+        f"{OPENALEX_API_URL}/works?filter=apc_list.value_usd:>0&group_by=open_access.oa_status",
+        f"{OPENALEX_API_URL}/works?filter=apc_paid.value_usd:>0&group_by=open_access.oa_status",
         # elsevier delayed oa bronze (ticket 1747)
-        "https://api.openalex.org/works?filter=primary_location.source.host_organization_lineage:P4310320990,primary_location.license:publisher-specific-oa&group_by=open_access.oa_status",
+        f"{OPENALEX_API_URL}/works?filter=primary_location.source.host_organization_lineage:P4310320990,primary_location.license:publisher-specific-oa&group_by=open_access.oa_status",
         # DataCite ingest
-        "https://api.openalex.org/works?filter=indexed_in:datacite&group_by=type",
+        f"{OPENALEX_API_URL}/works?filter=indexed_in:datacite&group_by=type",
         # pubmed work type information
-        "https://api.openalex.org/works?filter=has_pmid:true&group_by=type",
+        f"{OPENALEX_API_URL}/works?filter=has_pmid:true&group_by=type",
         # citations funnel project
-        "https://api.openalex.org/works?filter=referenced_works_count:>0&group_by=type",
-        "https://api.openalex.org/works?filter=mag_only:false,referenced_works_count:>0&group_by=type",
-        "https://api.openalex.org/works?filter=referenced_works_count:>0&group_by=is_oa",
-        "https://api.openalex.org/works?filter=mag_only:false,referenced_works_count:>0&group_by=is_oa",
-        "https://api.openalex.org/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=has_raw_affiliation_strings",
-        "https://api.openalex.org/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=has_references",
-        "https://api.openalex.org/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=institutions_distinct_count",
+        f"{OPENALEX_API_URL}/works?filter=referenced_works_count:>0&group_by=type",
+        f"{OPENALEX_API_URL}/works?filter=mag_only:false,referenced_works_count:>0&group_by=type",
+        f"{OPENALEX_API_URL}/works?filter=referenced_works_count:>0&group_by=is_oa",
+        f"{OPENALEX_API_URL}/works?filter=mag_only:false,referenced_works_count:>0&group_by=is_oa",
+        f"{OPENALEX_API_URL}/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=has_raw_affiliation_strings",
+        f"{OPENALEX_API_URL}/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=has_references",
+        f"{OPENALEX_API_URL}/works?filter=mag_only:false,publication_year:2013-2025,type:article|book-chapter|preprint|dissertation|review|book|letter|other|report|editorial|peer-review|erratum|grant|supplementary-materials|retraction&group_by=institutions_distinct_count",
     ]
-    for api_query in filtered_groupby_queries_to_run:
-        query_groupby(api_query, session=session)
+    with metrics.stage("filtered_groupby_queries"):
+        for api_query in filtered_groupby_queries_to_run:
+            query_groupby(api_query, session=session)
 
     filtered_groupby_queries_to_run_with_api_key = [
         # monitor pdf url backfill
-        "https://api.openalex.org/works?filter=has_doi:true,indexed_in:crossref,is_oa:true,from_created_date:2024-06-26,to_created_date:2024-08-09&group_by=has_pdf_url",
+        f"{OPENALEX_API_URL}/works?filter=has_doi:true,indexed_in:crossref,is_oa:true,from_created_date:2024-06-26,to_created_date:2024-08-09&group_by=has_pdf_url",
     ]
-    for api_query in filtered_groupby_queries_to_run_with_api_key:
-        query_groupby(api_query, session=session, api_key=API_KEY)
+    with metrics.stage("filtered_groupby_queries_with_api_key"):
+        for api_query in filtered_groupby_queries_to_run_with_api_key:
+            query_groupby(api_query, session=session, api_key=API_KEY)
 
     session.close()
 
@@ -399,12 +427,14 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description=DESCRIPTION)
+    instrumentation.add_arguments(parser)
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
+    instrumentation.start("log_queries", args)
     main(args)
     total_end = timer()
     logger.info(
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Copy every works year index into a new index version with sliced _reindex, then atomically point the works alias at the new indices"""
+
+import sys, os, time, json
+from pathlib import Path
+from typing import Dict, List, Optional
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from bulk_load_mode import bulk_load_mode
+from settings import ES_URL, WORKS_ALIAS
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+TEMPLATE_PATH = Path(__file__).parent / "elasticsearch_templates" / "works_template.json"
+
+
+def load_state(fp: Path) -> Dict:
+    # {source index: {"dest": ..., "docs": ..., "seconds": ...}} for each finished index
+    if fp.exists():
+        return json.loads(fp.read_text())
+    return {}
+
+
+def save_state(fp: Path, state: Dict):
+    fp.write_text(json.dumps(state, indent=2))
+
+
+def get_source_indices(es_client: Elasticsearch, source_prefix: str) -> List[str]:
+    indices = es_client.indices.get(index=f"{source_prefix}-*")
+    return sorted(indices.keys())
+
+
+def create_dest_index(es_client: Elasticsearch, dest: str, template: Dict):
+    if es_client.indices.exists(index=dest):
+        logger.info(f"{dest} already exists")
+        return
+    es_client.indices.create(index=dest, body=template["template"])
+    logger.info(f"created {dest}")
+
+
+def get_cluster_load(es_client: Elasticsearch) -> Dict:
+    # the busiest node decides how hard we can push
+    stats = es_client.nodes.stats(metric="os,thread_pool")
+    max_cpu = 0
+    max_write_queue = 0
+    for node in stats["nodes"].values():
+        max_cpu = max(max_cpu, node["os"]["cpu"]["percent"])
+        max_write_queue = max(max_write_queue, node["thread_pool"]["write"]["queue"])
+    return {"cpu": max_cpu, "write_queue": max_write_queue}
+
+
+def adjust_throttle(
+    es_client: Elasticsearch, task_id: str, requests_per_second: float, args
+) -> float:
+    """Lower requests_per_second when the cluster is busy, raise it back towards the maximum when it isn't."""
+    load = get_cluster_load(es_client)
+    new_rps = requests_per_second
+    if load["cpu"] > args.max_cpu or load["write_queue"] > args.max_write_queue:
+        new_rps = max(args.min_requests_per_second, requests_per_second / 2)
+    elif load["cpu"] < args.max_cpu * 0.75 and load["write_queue"] == 0:
+        new_rps = min(args.requests_per_second, requests_per_second * 1.25)
+    if new_rps != requests_per_second:
+        logger.info(
+            f"cluster cpu {load['cpu']}%, write queue {load['write_queue']}. throttling to {new_rps:.0f} docs/s"
+        )
+        es_client.reindex_rethrottle(task_id=task_id, requests_per_second=new_rps)
+    return new_rps
+
+
+def reindex_one(es_client: Elasticsearch, source: str, dest: str, args) -> int:
+    """Run a sliced _reindex from source to dest, logging progress until it finishes. Returns the number of docs copied."""
+    requests_per_second = args.requests_per_second
+    response = es_client.reindex(
+        body={
+            "source": {"index": source, "size": args.batch_size},
+            "dest": {"index": dest},
+        },
+        slices=args.slices,
+        requests_per_second=requests_per_second,
+        wait_for_completion=False,
+    )
+    task_id = response["task"]
+    logger.info(f"reindexing {source} -> {dest} (task {task_id})")
+    start = timer()
+    while True:
+        time.sleep(args.poll_seconds)
+        task = es_client.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        done = status["created"] + status["updated"] + status["deleted"]
+        total = status["total"]
+        elapsed = timer() - start
+        docs_per_second = done / elapsed if elapsed else 0
+        if task["completed"]:
+            break
+        eta = (total - done) / docs_per_second if docs_per_second else None
+        logger.info(
+            f"{source}: {done}/{total} docs ({100 * done / total if total else 0:.1f}%), {docs_per_second:.0f} docs/s, ETA {format_timespan(eta) if eta is not None else 'unknown'}"
+        )
+        requests_per_second = adjust_throttle(
+            es_client, task_id, requests_per_second, args
+        )
+    failures = task.get("response", {}).get("failures", [])
+    if "error" in task or failures:
+        raise RuntimeError(
+            f"reindex of {source} failed: {task.get('error') or failures[:5]}"
+        )
+    logger.info(
+        f"finished {source} -> {dest}: {done} docs in {format_timespan(elapsed)} ({docs_per_second:.0f} docs/s)"
+    )
+    return done
+
+
+def swap_alias(
+    es_client: Elasticsearch, alias: str, new_indices: List[str], exclude: List[str]
+):
+    """Point the alias at new_indices, removing it from whatever it pointed at before, in one atomic request."""
+    actions = []
+    if es_client.indices.exists_alias(name=alias):
+        for index in es_client.indices.get_alias(name=alias):
+            actions.append({"remove": {"index": index, "alias": alias}})
+    added = [
+        index
+        for index in new_indices
+        if not any(index.endswith(suffix) for suffix in exclude)
+    ]
+    for index in added:
+        actions.append({"add": {"index": index, "alias": alias}})
+    es_client.indices.update_aliases(body={"actions": actions})
+    logger.info(f"alias {alias} now points at {len(added)} indices")
+
+
+def main(args):
+    es_client = Elasticsearch(ES_URL, timeout=60)
+    template = json.loads(Path(args.template).read_text())
+    state_fp = Path(args.state_file)
+    state = load_state(state_fp)
+
+    sources = get_source_indices(es_client, args.source_prefix)
+    logger.info(f"{len(sources)} source indices")
+    dests = []
+    for source in sources:
+        dest = args.dest_prefix + source[len(args.source_prefix):]
+        dests.append(dest)
+        if source in state:
+            logger.info(f"{source} already reindexed into {state[source]['dest']}. skipping")
+            continue
+        create_dest_index(es_client, dest, template)
+        start = timer()
+        # the new index isn't serving traffic yet, so skip replicas and refreshes while it fills
+        with bulk_load_mode(es_client, dest, force_merge=args.force_merge):
+            num_docs = reindex_one(es_client, source, dest, args)
+        state[source] = {"dest": dest, "docs": num_docs, "seconds": timer() - start}
+        save_state(state_fp, state)
+
+    if args.alias:
+        swap_alias(es_client, args.alias, dests, exclude=["invalid-data"])
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("source_prefix", help="e.g. works-v18")
+    parser.add_argument("dest_prefix", help="e.g. works-v23")
+    parser.add_argument(
+        "--template",
+        default=str(TEMPLATE_PATH),
+        help="index template used to create the new indices (default: elasticsearch_templates/works_template.json)",
+    )
+    parser.add_argument(
+        "--alias",
+        default=WORKS_ALIAS,
+        help=f"alias to point at the new indices once they are all copied. pass an empty string to skip (default: {WORKS_ALIAS})",
+    )
+    parser.add_argument(
+        "--state-file",
+        default="reindex_state.json",
+        help="records finished indices so an interrupted run resumes with the next index (default: reindex_state.json)",
+    )
+    parser.add_argument(
+        "--slices", default="auto", help="number of _reindex slices per index (default: auto)"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=1000, help="scroll batch size (default: 1000)"
+    )
+    parser.add_argument(
+        "--requests-per-second",
+        type=float,
+        default=20000,
+        help="maximum docs/s per index (default: 20000)",
+    )
+    parser.add_argument(
+        "--min-requests-per-second",
+        type=float,
+        default=1000,
+        help="docs/s floor when throttling for cluster load (default: 1000)",
+    )
+    parser.add_argument(
+        "--max-cpu",
+        type=int,
+        default=80,
+        help="throttle when any node's cpu percent is above this (default: 80)",
+    )
+    parser.add_argument(
+        "--max-write-queue",
+        type=int,
+        default=50,
+        help="throttle when any node's write thread pool queue is above this (default: 50)",
+    )
+    parser.add_argument(
+        "--force-merge",
+        action="store_true",
+        help="force merge each new index to one segment after it is copied",
+    )
+    parser.add_argument(
+        "--poll-seconds", type=int, default=30, help="how often to check progress (default: 30)"
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -7,7 +7,9 @@ from elasticsearch_dsl import Search, connections
 from elasticsearch import ConflictError
 import sentry_sdk
 import requests
-from settings import ES_URL, WORKS_INDEX
+from settings import ES_URL, OPENALEX_API_URL, WORKS_INDEX
+import instrumentation
+from instrumentation import metrics
 
 sentry_sdk.init(dsn=os.environ.get("SENTRY_DSN"))
 
@@ -37,12 +39,14 @@ def remove_duplicates():
     s = s.extra(size=2000)
     s = s.source(["id", "updated"])
     s = s.filter("terms", id=initial_ids)
-    response = s.execute()
+    with metrics.timer("es_request_seconds", request="search"):
+        response = s.execute()
     elastic_ids = [r.id for r in response]
 
     for work_id in initial_ids:
         if elastic_ids.count(work_id) > 1:
             duplicates.append(work_id)
+            metrics.count("duplicates_found")
             find_id_and_delete(work_id)
 
     # loop run
@@ -56,12 +60,14 @@ def remove_duplicates():
         s = s.extra(size=2000)
         s = s.source(["id", "updated"])
         s = s.filter("terms", id=ids)
-        response = s.execute()
+        with metrics.timer("es_request_seconds", request="search"):
+            response = s.execute()
         elastic_ids = [r.id for r in response]
 
         for work_id in ids:
             if elastic_ids.count(work_id) > 1:
                 duplicates.append(work_id)
+                metrics.count("duplicates_found")
                 find_id_and_delete(work_id)
 
     end_time = datetime.utcnow()
@@ -71,9 +77,11 @@ def remove_duplicates():
 
 @backoff.on_exception(backoff.expo, (requests.exceptions.RequestException, requests.exceptions.JSONDecodeError, json.JSONDecodeError), max_tries=5)
 def call_openalex_api(cursor, four_hours_ago, per_page, three_hours_ago):
-    url = f"https://api.openalex.org/works?filter=from_updated_date:{four_hours_ago},to_updated_date:{three_hours_ago}&api_key={API_KEY}&mailto=team@ourresearch.org&select=id&per-page={per_page}&cursor={cursor}"
+    url = f"{OPENALEX_API_URL}/works?filter=from_updated_date:{four_hours_ago},to_updated_date:{three_hours_ago}&api_key={API_KEY}&mailto=team@ourresearch.org&select=id&per-page={per_page}&cursor={cursor}"
     print(url)
-    r = requests.get(url)
+    with metrics.timer("api_request_seconds"):
+        r = requests.get(url)
+    metrics.count("api_requests", status=r.status_code)
     return r
 
 
@@ -91,11 +99,15 @@ def delete_from_elastic(duplicate_id, index):
     try:
         s = Search(index=index)
         s = s.filter("term", id=duplicate_id)
-        s.delete()
+        with metrics.timer("es_request_seconds", request="delete"):
+            s.delete()
+        metrics.count("duplicates_deleted")
         print(f"deleted duplicate id {duplicate_id} from index {index}")
     except ConflictError:
+        metrics.count("delete_conflicts")
         print(f"conflict error while deleting duplicate id {duplicate_id} from index {index}")
 
 
 if __name__ == "__main__":
+    instrumentation.start("remove_duplicates")
     remove_duplicates()
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Replay a sample of recorded API requests from openalex-heroku-logs-* against a target at a chosen speed-up, and compare latencies with the recorded service times"""
+
+import sys, os, time, json, threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import requests
+from requests import RequestException
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan
+from latency_sketch import percentiles
+from settings import API_USAGE_ES_URL, API_USAGE_INDEX_PREFIX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# replayed requests shouldn't run as, or be attributed to, the original users. cursors expire,
+# so paging requests start again from the first page
+DROP_PARAMS = {"api_key", "mailto", "email"}
+
+# a request counts as late if the client sent it this long after it was due, meaning the
+# replay couldn't keep up and the offered load was lower than asked for
+LATE_MS = 100
+
+
+class RecordedRequest(NamedTuple):
+    timestamp: datetime
+    request_path: str
+    service_ms: float
+    status: int
+
+
+def parse_timestamp(value: str) -> datetime:
+    # heroku's router writes e.g. 2023-05-01T12:34:56.123456+00:00; @timestamp ends in Z
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def to_recorded_request(doc: Dict) -> Optional[RecordedRequest]:
+    """A request from a log document (or an exported line), or None if it can't be replayed."""
+    if doc.get("http_method", "GET") != "GET" or not doc.get("request_path"):
+        return None
+    try:
+        return RecordedRequest(
+            timestamp=parse_timestamp(doc.get("timestamp") or doc["@timestamp"]),
+            request_path=doc["request_path"],
+            service_ms=float(doc["service"]),
+            status=int(doc["status"]),
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def scan_day(es_client: Elasticsearch, day: datetime, sample_rate: float, seed: int) -> Iterator[Dict]:
+    index = f"{API_USAGE_INDEX_PREFIX}-{day:%Y.%m.%d}"
+    logger.info(f"sampling {sample_rate:.2%} of {index}")
+    # sample in elasticsearch, so only the sampled documents are read. a seeded random score is
+    # uniform in [0, 1) and the same for a document on every run, so keeping scores >= 1 - rate
+    # gives the same sample each time
+    query = {
+        "function_score": {
+            "query": {"match_all": {}},
+            "random_score": {"seed": seed, "field": "_seq_no"},
+            "boost_mode": "replace",
+            "min_score": 1 - sample_rate,
+        }
+    }
+    for hit in scan(
+        es_client,
+        index=index,
+        query={"query": query},
+        _source=["timestamp", "@timestamp", "http_method", "request_path", "service", "status"],
+        size=5000,
+    ):
+        yield hit["_source"]
+
+
+def read_export(fp: Path) -> Iterator[Dict]:
+    """One log document per line, either the _source or a whole hit."""
+    with fp.open() as f:
+        for line in f:
+            if line.strip():
+                doc = json.loads(line)
+                yield doc.get("_source", doc)
+
+
+def replay_url(target: str, request_path: str, extra_params: Dict[str, str]) -> str:
+    parts = urlsplit(request_path)
+    params = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in DROP_PARAMS]
+    params = [(k, "*") if k == "cursor" else (k, v) for k, v in params]
+    params.extend(extra_params.items())
+    query = f"?{urlencode(params, safe='*,:|')}" if params else ""
+    return f"{target.rstrip('/')}{parts.path}{query}"
+
+
+def endpoint_for(request_path: str) -> str:
+    """Group requests by entity and kind, e.g. "/works group_by" or "/authors get"."""
+    parts = urlsplit(request_path)
+    segments = [s for s in parts.path.split("/") if s]
+    if not segments:
+        return "/"
+    entity = f"/{segments[0]}"
+    if len(segments) > 1:
+        return f"{entity} get"
+    params = dict(parse_qsl(parts.query))
+    for kind in ("group_by", "group-by", "search", "filter"):
+        if kind in params:
+            return f"{entity} {kind.replace('-', '_')}"
+    return f"{entity} list"
+
+
+class Replayer:
+    """Sends each request when it is due (its recorded offset divided by the speed-up), without
+    waiting for earlier responses, so a slow target sees the same arrival rate as a fast one.
+
+    Latency is measured from when the request was due, not from when it was sent, so time spent
+    waiting for a free worker counts against the target instead of being hidden.
+    """
+
+    def __init__(self, target: str, speedup: float, max_concurrency: int, timeout: float, extra_params: Dict[str, str]):
+        self.target = target
+        self.speedup = speedup
+        self.timeout = timeout
+        self.extra_params = extra_params
+        self.executor = ThreadPoolExecutor(max_concurrency)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.results: List[Dict] = []
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _send(self, recorded: RecordedRequest, due: float):
+        sent = timer()
+        url = replay_url(self.target, recorded.request_path, self.extra_params)
+        try:
+            status = self._session().get(url, timeout=self.timeout).status_code
+        except RequestException as e:
+            logger.debug(f"{url}: {e}")
+            status = None
+        done = timer()
+        with self._lock:
+            self.results.append(
+                {
+                    "endpoint": endpoint_for(recorded.request_path),
+                    "recorded_ms": recorded.service_ms,
+                    "recorded_status": recorded.status,
+                    "latency_ms": (done - due) * 1000,
+                    "late_ms": (sent - due) * 1000,
+                    "status": status,
+                }
+            )
+
+    def run(self, recorded: List[RecordedRequest]) -> float:
+        """Replay all the requests, in timestamp order. Returns the elapsed seconds."""
+        first = recorded[0].timestamp
+        start = timer()
+        for i, request in enumerate(recorded):
+            due = start + (request.timestamp - first).total_seconds() / self.speedup
+            wait = due - timer()
+            if wait > 0:
+                time.sleep(wait)
+            self.executor.submit(self._send, request, due)
+            if i and i % 10000 == 0:
+                logger.info(f"sent {i} of {len(recorded)}")
+        self.executor.shutdown(wait=True)
+        return timer() - start
+
+
+def summarize(results: List[Dict]) -> Dict[str, Dict]:
+    """Recorded and replayed latency percentiles per endpoint, for requests that succeeded both times."""
+    by_endpoint = defaultdict(list)
+    for result in results:
+        by_endpoint[result["endpoint"]].append(result)
+        by_endpoint["all"].append(result)
+    summary = {}
+    for endpoint, endpoint_results in by_endpoint.items():
+        ok = [
+            r for r in endpoint_results
+            if r["status"] is not None and r["status"] < 400 and r["recorded_status"] < 400
+        ]
+        summary[endpoint] = {
+            "requests": len(endpoint_results),
+            "errors": sum(1 for r in endpoint_results if r["status"] is None or r["status"] >= 500),
+            "rate_limited": sum(1 for r in endpoint_results if r["status"] == 429),
+            "late": sum(1 for r in endpoint_results if r["late_ms"] > LATE_MS),
+            "recorded_ms": percentiles([r["recorded_ms"] for r in ok]),
+            "replayed_ms": percentiles([r["latency_ms"] for r in ok]),
+        }
+    return summary
+
+
+def print_summary(summary: Dict[str, Dict], top: int):
+    print(
+        f"{'endpoint':<28}{'requests':>10}{'errors':>8}{'429s':>8}"
+        f"{'rec p50':>10}{'rec p95':>10}{'rec p99':>10}{'rep p50':>10}{'rep p95':>10}{'rep p99':>10}"
+    )
+    rows = sorted(summary.items(), key=lambda x: -x[1]["requests"])[:top]
+    for endpoint, s in rows:
+        cells = [s["recorded_ms"][p] for p in ("p50", "p95", "p99")] + [s["replayed_ms"][p] for p in ("p50", "p95", "p99")]
+        cells = "".join(f"{c:>10.0f}" if c is not None else f"{'-':>10}" for c in cells)
+        print(f"{endpoint[:27]:<28}{s['requests']:>10}{s['errors']:>8}{s['rate_limited']:>8}{cells}")
+
+
+def main(args):
+    if args.from_file:
+        docs = read_export(Path(args.from_file))
+    else:
+        es_client = Elasticsearch(API_USAGE_ES_URL, timeout=120)
+        day = datetime.strptime(args.day, "%Y-%m-%d") if args.day else datetime.utcnow() - timedelta(days=1)
+        docs = scan_day(es_client, day, args.sample_rate, args.seed)
+    recorded = [r for r in (to_recorded_request(doc) for doc in docs) if r is not None]
+    recorded.sort(key=lambda r: r.timestamp)
+    if args.start_offset_minutes:
+        window_start = recorded[0].timestamp + timedelta(minutes=args.start_offset_minutes)
+        recorded = [r for r in recorded if r.timestamp >= window_start]
+    if args.duration_minutes:
+        window_end = recorded[0].timestamp + timedelta(minutes=args.duration_minutes)
+        recorded = [r for r in recorded if r.timestamp < window_end]
+    if args.max_requests:
+        recorded = recorded[: args.max_requests]
+    if not recorded:
+        logger.error("no requests to replay")
+        return
+    if args.save_sample:
+        with open(args.save_sample, "w") as f:
+            for r in recorded:
+                f.write(json.dumps({"timestamp": r.timestamp.isoformat(), "request_path": r.request_path, "service": r.service_ms, "status": r.status}) + "\n")
+        logger.info(f"saved {len(recorded)} requests to {args.save_sample}")
+
+    recorded_seconds = (recorded[-1].timestamp - recorded[0].timestamp).total_seconds()
+    logger.info(
+        f"replaying {len(recorded)} requests covering {format_timespan(recorded_seconds)} "
+        f"at {args.speedup}x ({len(recorded) / max(recorded_seconds / args.speedup, 1):.1f} requests/s) against {args.target}"
+    )
+    extra_params = {}
+    if args.api_key:
+        extra_params["api_key"] = args.api_key
+    if args.mailto:
+        extra_params["mailto"] = args.mailto
+    replayer = Replayer(args.target, args.speedup, args.max_concurrency, args.timeout, extra_params)
+    elapsed = replayer.run(recorded)
+    logger.info(f"replay took {format_timespan(elapsed)}")
+
+    summary = summarize(replayer.results)
+    if summary["all"]["late"]:
+        logger.warning(
+            f"{summary['all']['late']} requests were sent more than {LATE_MS} ms late. "
+            "raise --max-concurrency or lower --speedup for the full load"
+        )
+    print_summary(summary, args.top)
+    if args.output:
+        Path(args.output).write_text(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("target", help="base url to replay against, e.g. https://api-staging.openalex.org")
+    parser.add_argument("--day", help="day of logs to sample, YYYY-MM-DD (default: yesterday)")
+    parser.add_argument(
+        "--from-file",
+        help="replay an exported file of log documents (one json per line) instead of querying elasticsearch",
+    )
+    parser.add_argument(
+        "--sample-rate",
+        type=float,
+        default=0.01,
+        help="fraction of the day's requests to replay (default: 0.01)",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=42, help="the same seed samples the same requests from a day (default: 42)"
+    )
+    parser.add_argument(
+        "--start-offset-minutes",
+        type=float,
+        help="skip this many minutes from the start of the sample",
+    )
+    parser.add_argument(
+        "--duration-minutes",
+        type=float,
+        help="only replay this many minutes of recorded traffic",
+    )
+    parser.add_argument("--max-requests", type=int)
+    parser.add_argument(
+        "--speedup",
+        type=float,
+        default=1.0,
+        help="replay this many times faster than recorded (default: 1)",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=200,
+        help="most requests in flight at once (default: 200)",
+    )
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--api-key", default=os.getenv("API_KEY"), help="api_key to send with every request (default: $API_KEY)")
+    parser.add_argument("--mailto", help="mailto to send with every request")
+    parser.add_argument("--save-sample", help="save the requests to replay to this file, to replay them again with --from-file")
+    parser.add_argument("--top", type=int, default=30, help="endpoints to print (default: 30)")
+    parser.add_argument("--output", help="save the summary as json to this path")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Roll finished days of API usage logs up into hourly summaries (counts, bytes and service time percentiles per route, status class and api_key/mailto), and report from them"""
+
+import sys, os, time, json, hashlib
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+from datetime import datetime, timedelta, timezone
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+from elasticsearch import Elasticsearch
+from elasticsearch.helpers import scan, streaming_bulk
+from ingest_api_usage import TEMPLATE_PATH, normalize_path, parse_timestamp
+from latency_sketch import LatencySketch
+from settings import (
+    API_USAGE_ES_URL,
+    API_USAGE_INDEX_PREFIX,
+    API_USAGE_MINUTELY_INDEX_PREFIX,
+    API_USAGE_HOURLY_INDEX_PREFIX,
+)
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# what a summary is keyed by, after the hour
+DIMENSIONS = ("path", "status_class", "api_key", "mailto")
+
+
+def status_class(status) -> str:
+    return f"{int(status) // 100}xx"
+
+
+def start_of_day(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def time_range_query(start: datetime, end: datetime, terms: Optional[Dict] = None) -> Dict:
+    filters = [{"range": {"@timestamp": {"gte": start.isoformat(), "lt": end.isoformat()}}}]
+    for field, value in (terms or {}).items():
+        filters.append({"term": {field: value}})
+    return {"query": {"bool": {"filter": filters}}}
+
+
+class Summaries:
+    """Counts, bytes and a service time sketch per key, built from raw requests, minute rollups
+    or hour rollups, which can be mixed since the sketches merge exactly."""
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.buckets: Dict[Tuple, Dict] = {}
+
+    def _bucket(self, key: Tuple) -> Dict:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = {"count": 0, "bytes": 0, "sketch": LatencySketch(self.relative_accuracy)}
+        return bucket
+
+    def add_request(self, key: Tuple, service_ms: float, num_bytes: int):
+        bucket = self._bucket(key)
+        bucket["count"] += 1
+        bucket["bytes"] += num_bytes
+        bucket["sketch"].add(service_ms)
+
+    def add_rollup(self, key: Tuple, count: int, num_bytes: int, sketch: LatencySketch):
+        bucket = self._bucket(key)
+        bucket["count"] += count
+        bucket["bytes"] += num_bytes
+        bucket["sketch"].merge(sketch)
+
+
+def raw_requests(es_client: Elasticsearch, start: datetime, end: datetime) -> Iterator[Tuple[datetime, Dict, float, int]]:
+    """(timestamp, dimensions, service ms, bytes) for each request logged in [start, end)"""
+    indices = ",".join(
+        f"{API_USAGE_INDEX_PREFIX}-{start + timedelta(days=i):%Y.%m.%d}"
+        for i in range((end - start_of_day(start)).days + 1)
+    )
+    for hit in scan(
+        es_client,
+        index=indices,
+        query=time_range_query(start, end),
+        _source=["timestamp", "@timestamp", "request_path", "service", "status", "bytes", "api_key", "mailto", "email"],
+        size=5000,
+        ignore_unavailable=True,
+    ):
+        doc = hit["_source"]
+        try:
+            ts = parse_timestamp(doc.get("timestamp") or doc["@timestamp"])
+            dimensions = {
+                "path": normalize_path(doc["request_path"].partition("?")[0]),
+                "status_class": status_class(doc["status"]),
+                "api_key": doc.get("api_key"),
+                "mailto": doc.get("mailto") or doc.get("email"),
+            }
+            yield ts, dimensions, float(doc["service"]), int(doc.get("bytes", 0))
+        except (KeyError, ValueError):
+            continue
+
+
+def rollups(es_client: Elasticsearch, index: str, start: datetime, end: datetime, terms: Optional[Dict] = None) -> Iterator[Tuple[datetime, Dict, int, int, LatencySketch]]:
+    """(timestamp, dimensions, count, bytes, sketch) for each minute or hour rollup in [start, end)"""
+    for hit in scan(
+        es_client,
+        index=index,
+        query=time_range_query(start, end, terms),
+        size=5000,
+        ignore_unavailable=True,
+    ):
+        doc = hit["_source"]
+        dimensions = {
+            "path": doc["path"],
+            "status_class": doc["status_class"] if "status_class" in doc else status_class(doc["status"]),
+            "api_key": doc.get("api_key"),
+            "mailto": doc.get("mailto"),
+        }
+        yield parse_timestamp(doc["@timestamp"]), dimensions, doc["count"], doc["bytes"], LatencySketch.from_dict(doc["service_sketch"])
+
+
+def minute_rollups_start(es_client: Elasticsearch, day: datetime) -> Optional[datetime]:
+    """When the minute rollups for a day start, or None if there are none.
+
+    Once ingest_api_usage.py runs with --rollups, the raw index only has errors and slow requests,
+    so from then on the minute rollups are the complete record. Before then (if rollups were turned
+    on partway through the day) only the raw logs are.
+    """
+    index = f"{API_USAGE_MINUTELY_INDEX_PREFIX}-{day:%Y.%m.%d}"
+    if not es_client.indices.exists(index=index):
+        return None
+    response = es_client.search(
+        index=index,
+        body={
+            "size": 0,
+            **time_range_query(day, day + timedelta(days=1)),
+            "aggs": {"start": {"min": {"field": "@timestamp"}}},
+        },
+    )
+    value = response.get("aggregations", {}).get("start", {}).get("value")
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+
+
+def describe_sources(start: datetime, rollups_start: Optional[datetime]) -> str:
+    if rollups_start is None:
+        return "raw logs"
+    if rollups_start <= start:
+        return "minute rollups"
+    return f"raw logs until {rollups_start:%H:%M}, then minute rollups"
+
+
+def summarize_day(es_client: Elasticsearch, day: datetime, relative_accuracy: float) -> Summaries:
+    end = day + timedelta(days=1)
+    summaries = Summaries(relative_accuracy)
+    rollups_start = minute_rollups_start(es_client, day)
+    logger.info(f"summarizing {day:%Y-%m-%d} from {describe_sources(day, rollups_start)}")
+    raw_end = end if rollups_start is None else rollups_start
+    if raw_end > day:
+        for ts, dimensions, service_ms, num_bytes in raw_requests(es_client, day, raw_end):
+            key = (ts.replace(minute=0, second=0, microsecond=0), *(dimensions[d] for d in DIMENSIONS))
+            summaries.add_request(key, service_ms, num_bytes)
+    if rollups_start is not None:
+        index = f"{API_USAGE_MINUTELY_INDEX_PREFIX}-{day:%Y.%m.%d}"
+        for ts, dimensions, count, num_bytes, sketch in rollups(es_client, index, rollups_start, end):
+            key = (ts.replace(minute=0), *(dimensions[d] for d in DIMENSIONS))
+            summaries.add_rollup(key, count, num_bytes, sketch)
+    return summaries
+
+
+def hourly_actions(summaries: Summaries) -> Iterator[Dict]:
+    for (hour, *dimension_values), bucket in summaries.buckets.items():
+        sketch = bucket["sketch"]
+        doc = {
+            "@timestamp": hour.isoformat(),
+            **dict(zip(DIMENSIONS, dimension_values)),
+            "count": bucket["count"],
+            "bytes": bucket["bytes"],
+            "service_total": sketch.total,
+            "service_max": sketch.max,
+            "service_sketch": sketch.to_dict(),
+        }
+        # re-running a day overwrites its summaries instead of adding to them
+        key = "|".join(str(v) for v in (hour.isoformat(), *dimension_values))
+        yield {
+            "_index": f"{API_USAGE_HOURLY_INDEX_PREFIX}-{hour:%Y.%m}",
+            "_id": hashlib.sha1(key.encode()).hexdigest(),
+            "_source": doc,
+        }
+
+
+def rollup_day(es_client: Elasticsearch, day: datetime, relative_accuracy: float) -> int:
+    start = timer()
+    summaries = summarize_day(es_client, day, relative_accuracy)
+    num_requests = sum(b["count"] for b in summaries.buckets.values())
+    failed = 0
+    for ok, item in streaming_bulk(es_client, hourly_actions(summaries), chunk_size=1000, raise_on_error=False):
+        if not ok:
+            failed += 1
+            if failed <= 10:
+                logger.error(f"indexing failed: {item}")
+    logger.info(
+        f"{day:%Y-%m-%d}: {num_requests} requests -> {len(summaries.buckets)} hourly summaries "
+        f"({failed} failed) in {format_timespan(timer() - start)}"
+    )
+    return len(summaries.buckets) - failed
+
+
+def query_usage(
+    es_client: Elasticsearch,
+    start: datetime,
+    end: datetime,
+    group_by: Sequence[str] = ("path",),
+    by_hour: bool = False,
+    terms: Optional[Dict] = None,
+    relative_accuracy: float = 0.01,
+    now: Optional[datetime] = None,
+) -> Dict[Tuple, Dict]:
+    """Usage between start and end (UTC), grouped by any of DIMENSIONS (and the hour, with by_hour),
+    optionally filtered to exact `terms`, e.g. {"api_key": "..."}.
+
+    Days before today are read from the hourly rollups. Today is read from the minute rollups from
+    when they start, and the raw logs before that. Returns {key: {"count", "bytes", "sketch"}}; use
+    bucket["sketch"].percentiles() for p50/p95/p99 service times.
+    """
+    now = now or datetime.now(timezone.utc)
+    today = start_of_day(now)
+    terms = terms or {}
+    summaries = Summaries(relative_accuracy)
+
+    def key_for(ts: datetime, dimensions: Dict) -> Tuple:
+        values = tuple(dimensions[d] for d in group_by)
+        return (ts.replace(minute=0, second=0, microsecond=0), *values) if by_hour else values
+
+    if start < today:
+        for ts, dimensions, count, num_bytes, sketch in rollups(
+            es_client, f"{API_USAGE_HOURLY_INDEX_PREFIX}-*", start, min(end, today), terms
+        ):
+            summaries.add_rollup(key_for(ts, dimensions), count, num_bytes, sketch)
+    if end > today:
+        today_start = max(start, today)
+        rollups_start = minute_rollups_start(es_client, today)
+        logger.info(f"reading today from {describe_sources(today_start, rollups_start)}")
+        raw_end = end if rollups_start is None else min(end, rollups_start)
+        if raw_end > today_start:
+            for ts, dimensions, service_ms, num_bytes in raw_requests(es_client, today_start, raw_end):
+                if all(dimensions[f] == v for f, v in terms.items()):
+                    summaries.add_request(key_for(ts, dimensions), service_ms, num_bytes)
+        if rollups_start is not None and end > rollups_start:
+            index = f"{API_USAGE_MINUTELY_INDEX_PREFIX}-{today:%Y.%m.%d}"
+            minute_terms = {f: v for f, v in terms.items() if f != "status_class"}
+            for ts, dimensions, count, num_bytes, sketch in rollups(
+                es_client, index, max(today_start, rollups_start), end, minute_terms
+            ):
+                if all(dimensions[f] == v for f, v in terms.items()):
+                    summaries.add_rollup(key_for(ts, dimensions), count, num_bytes, sketch)
+    return summaries.buckets
+
+
+def print_report(buckets: Dict[Tuple, Dict], group_by: Sequence[str], top: int):
+    label = " / ".join(group_by)
+    print(f"{label[:47]:<48}{'requests':>12}{'MB':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for key, bucket in sorted(buckets.items(), key=lambda x: -x[1]["count"])[:top]:
+        p = bucket["sketch"].percentiles()
+        name = " / ".join(str(v) for v in key)
+        print(
+            f"{name[:47]:<48}{bucket['count']:>12}{bucket['bytes'] / 1e6:>10.1f}"
+            f"{p['p50']:>10.0f}{p['p95']:>10.0f}{p['p99']:>10.0f}"
+        )
+
+
+def main(args):
+    es_client = Elasticsearch(API_USAGE_ES_URL, timeout=120)
+    if args.install_template:
+        template = json.loads(TEMPLATE_PATH.read_text())
+        es_client.indices.put_index_template(name="openalex-api-usage-rollups", body=template)
+        logger.info("installed the rollup index template")
+
+    today = start_of_day(datetime.now(timezone.utc))
+    if args.report_days:
+        buckets = query_usage(
+            es_client,
+            today - timedelta(days=args.report_days - 1),
+            today + timedelta(days=1),
+            group_by=args.group_by,
+            terms=dict(t.split("=", 1) for t in args.filter or []),
+            relative_accuracy=args.relative_accuracy,
+        )
+        print_report(buckets, args.group_by, args.top)
+        return
+
+    if args.day:
+        days = [datetime.strptime(args.day, "%Y-%m-%d").replace(tzinfo=timezone.utc)]
+    else:
+        # only finished days
+        days = [today - timedelta(days=i) for i in range(args.days, 0, -1)]
+    for day in days:
+        rollup_day(es_client, day, args.relative_accuracy)
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("--day", help="roll up this day, YYYY-MM-DD (UTC)")
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=1,
+        help="roll up this many finished days, ending yesterday (default: 1)",
+    )
+    parser.add_argument(
+        "--relative-accuracy",
+        type=float,
+        default=0.01,
+        help="relative error of the service time percentiles (default: 0.01)",
+    )
+    parser.add_argument(
+        "--install-template",
+        action="store_true",
+        help="first install elasticsearch_templates/api_usage_rollups_template.json",
+    )
+    parser.add_argument(
+        "--report-days",
+        type=int,
+        help="instead of rolling up, report usage over this many days, up to now",
+    )
+    parser.add_argument(
+        "--group-by",
+        nargs="+",
+        choices=DIMENSIONS,
+        default=["path"],
+        help="with --report-days, group by these (default: path)",
+    )
+    parser.add_argument(
+        "--filter",
+        nargs="+",
+        metavar="FIELD=VALUE",
+        help="with --report-days, only count these, e.g. path=/works status_class=2xx",
+    )
+    parser.add_argument("--top", type=int, default=30, help="rows to print (default: 30)")
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )
@@ -2,11 +2,12 @@
 
 DESCRIPTION = """Get the results from all simple groupby queries, then, for results that have fewer than 200 groups, save the possible values to elasticsearch"""
 
-import sys, os, time
+import sys, os, time, json, hashlib
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from datetime import datetime
 from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
     from humanfriendly import format_timespan
@@ -21,7 +22,9 @@ from requests import JSONDecodeError
 import backoff
 from elasticsearch_dsl import Search, connections, Document, Text, Keyword, Object
 from elasticsearch.exceptions import NotFoundError
-from settings import ES_URL, GROUPBY_VALUES_INDEX
+from settings import ES_URL, GROUPBY_VALUES_INDEX, OPENALEX_API_URL
+import instrumentation
+from instrumentation import metrics
 
 import logging
 
@@ -42,26 +45,78 @@ class GroupbyValues(Document):
 
 @backoff.on_predicate(backoff.expo, lambda x: x.status_code >= 429, max_tries=4)
 def make_request(field, endpoint):
-    r = requests.get(
-        f"https://api.openalex.org/{endpoint}?group_by={field}&mailto=dev@ourresearch.org&bypass_cache=true"
-    )
+    with metrics.timer("api_request_seconds"):
+        r = requests.get(
+            f"{OPENALEX_API_URL}/{endpoint}?group_by={field}&mailto=dev@ourresearch.org&bypass_cache=true"
+        )
+    metrics.count("api_requests", status=r.status_code)
     return r
 
 
-def elasticsearch_save_or_update(
-    entity: str, group_by: str, values: List[str], buckets: List[Dict[str, str]]
-):
-    # check if exists
+def content_hash(values: List[str], buckets: List[Dict[str, str]]) -> str:
+    # stable hash of a record's content, used to skip writes for unchanged records
+    payload = json.dumps(
+        {"values": values, "buckets": buckets}, sort_keys=True, separators=(",", ":")
+    )
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def get_existing_records(entity: str) -> Dict[str, Tuple[str, str]]:
+    """Fetch all existing records for an entity in one request.
+
+    Returns a dict mapping group_by -> (record id, content hash)
+    """
     s = Search(index=GROUPBY_VALUES_INDEX)
     s = s.filter("term", entity=entity)
-    s = s.filter("term", group_by=group_by)
+    s = s.source(["group_by", "values", "buckets"])
+    s = s.extra(size=1000)
     try:
         response = s.execute()
     except NotFoundError:
-        response = []
-    if len(response):
+        return {}
+    existing = {}
+    for hit in response:
+        source = hit.to_dict()
+        existing[source["group_by"]] = (
+            hit.meta.id,
+            content_hash(source.get("values", []), source.get("buckets", [])),
+        )
+    return existing
+
+
+def elasticsearch_save_or_update(
+    entity: str,
+    group_by: str,
+    values: List[str],
+    buckets: List[Dict[str, str]],
+    existing: Optional[Dict[str, Tuple[str, str]]] = None,
+) -> bool:
+    """Save or update a record. Returns False if the write was skipped because nothing changed.
+
+    `existing` is the output of get_existing_records() for this entity. If it is None, look up the record individually.
+    """
+    if existing is None:
+        existing = {}
+        # check if exists
+        s = Search(index=GROUPBY_VALUES_INDEX)
+        s = s.filter("term", entity=entity)
+        s = s.filter("term", group_by=group_by)
+        try:
+            response = s.execute()
+        except NotFoundError:
+            response = []
+        if len(response):
+            source = response[0].to_dict()
+            existing[group_by] = (
+                response[0].meta.id,
+                content_hash(source.get("values", []), source.get("buckets", [])),
+            )
+    if group_by in existing:
+        record_id, existing_hash = existing[group_by]
+        if existing_hash == content_hash(values, buckets):
+            # unchanged. skip the write
+            return False
         # it exists. update the values
-        record_id = response[0].meta.id
         g = GroupbyValues.get(record_id)
         g.update(values=values, buckets=buckets)
     else:
@@ -70,11 +125,23 @@ def elasticsearch_save_or_update(
             entity=entity, group_by=group_by, values=values, buckets=buckets
         )
         g.save()
+    return True
+
+
+def fetch_groupby(entity: str, field: str) -> Optional[Dict]:
+    """Request one group_by. Runs in a worker thread.
+
+    Returns the response json, or None if the request was forbidden.
+    Raises JSONDecodeError if the response could not be parsed.
+    """
+    r = make_request(field, endpoint=entity)
+    if r.status_code == 403:
+        return None
+    return r.json()
 
 
 def main(args):
     connections.create_connection(hosts=[ES_URL], timeout=30)
-    i = 0
     # ignore_fields = [
     #     "has_fulltext",
     #     "has_raw_affiliation_string",
@@ -88,23 +155,50 @@ def main(args):
         "publishers",
         "funders",
     ]
-    for entity in entities:
-        errors = []
-        errors_forbidden = []
-        logger.info(f"ENTITY: {entity}")
-        valid_fields = requests.get(
-            f"https://api.openalex.org/{entity}/valid_fields?bypass_cache=true"
-        ).json()
-        logger.info(f"{len(valid_fields)} valid_fields")
-        num_saved_or_updated = 0
-        for field in valid_fields:
+    errors = {entity: [] for entity in entities}
+    errors_forbidden = {entity: [] for entity in entities}
+    existing = {}
+    num_saved_or_updated = {entity: 0 for entity in entities}
+    num_skipped = {entity: 0 for entity in entities}
+    num_pending = {}
+
+    def log_entity_summary(entity):
+        logger.info(
+            f"finished {entity}. saved or updated {num_saved_or_updated[entity]} records in elasticsearch. skipped {num_skipped[entity]} unchanged records"
+        )
+        logger.info(f"ERRORS ENCOUNTERED -- FORBIDDEN: {errors_forbidden[entity]}")
+        logger.info(f"ERRORS ENCOUNTERED -- UNKNOWN: {errors[entity]}")
+        logger.info("----")
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for entity in entities:
+            logger.info(f"ENTITY: {entity}")
+            with metrics.timer("api_request_seconds"):
+                r = requests.get(
+                    f"{OPENALEX_API_URL}/{entity}/valid_fields?bypass_cache=true"
+                )
+            metrics.count("api_requests", status=r.status_code)
+            valid_fields = r.json()
+            logger.info(f"{len(valid_fields)} valid_fields")
+            with metrics.timer("es_request_seconds"):
+                existing[entity] = get_existing_records(entity)
+            num_pending[entity] = len(valid_fields)
+            if not valid_fields:
+                log_entity_summary(entity)
+            for field in valid_fields:
+                future = executor.submit(fetch_groupby, entity, field)
+                futures[future] = (entity, field)
+
+        # save results as they come in
+        for future in as_completed(futures):
+            entity, field = futures[future]
             try:
-                r = make_request(field, endpoint=entity)
-                if r.status_code == 403:
-                    errors_forbidden.append(f"entity: {entity}, field: {field}")
-                    continue
-                response = r.json()
-                if "error" not in response and response["meta"]["groups_count"] < 200:
+                response = future.result()
+                if response is None:
+                    metrics.count("groupbys", entity=entity, outcome="forbidden")
+                    errors_forbidden[entity].append(f"entity: {entity}, field: {field}")
+                elif "error" not in response and response["meta"]["groups_count"] < 200:
                     values = []
                     buckets = []
                     for item in response["group_by"]:
@@ -116,19 +210,27 @@ def main(args):
                                 "key_display_name": item["key_display_name"],
                             })
                     # save to elasticsearch
-                    elasticsearch_save_or_update(
-                        entity=entity, group_by=field, values=values, buckets=buckets
-                    )
-                    num_saved_or_updated += 1
+                    with metrics.timer("es_request_seconds"):
+                        saved = elasticsearch_save_or_update(
+                            entity=entity,
+                            group_by=field,
+                            values=values,
+                            buckets=buckets,
+                            existing=existing[entity],
+                        )
+                    if saved:
+                        metrics.count("groupbys", entity=entity, outcome="saved")
+                        num_saved_or_updated[entity] += 1
+                    else:
+                        metrics.count("groupbys", entity=entity, outcome="unchanged")
+                        num_skipped[entity] += 1
             except JSONDecodeError:
-                errors.append(f"entity: {entity}, field: {field}")
+                metrics.count("groupbys", entity=entity, outcome="error")
+                errors[entity].append(f"entity: {entity}, field: {field}")
 
-        logger.info(
-            f"finished {entity}. saved or updated {num_saved_or_updated} records in elasticsearch"
-        )
-        logger.info(f"ERRORS ENCOUNTERED -- FORBIDDEN: {errors_forbidden}")
-        logger.info(f"ERRORS ENCOUNTERED -- UNKNOWN: {errors}")
-        logger.info("----")
+            num_pending[entity] -= 1
+            if num_pending[entity] == 0:
+                log_entity_summary(entity)
 
 
 if __name__ == "__main__":
@@ -148,12 +250,20 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="maximum number of group_by requests to run concurrently (default: 8)",
+    )
+    instrumentation.add_arguments(parser)
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
+    instrumentation.start("save_groupby_values_to_es", args)
     main(args)
     total_end = timer()
     logger.info(
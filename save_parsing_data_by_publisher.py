@@ -21,6 +21,9 @@ from requests import JSONDecodeError, RequestException
 import backoff
 from sqlalchemy import create_engine, desc, text
 from sqlalchemy.orm import Session
+from settings import OPENALEX_API_URL
+import instrumentation
+from instrumentation import metrics
 
 import logging
 
@@ -33,7 +36,10 @@ EMAIL = "dev@ourresearch.org"
 @backoff.on_exception(backoff.expo, RequestException, max_time=30)
 @backoff.on_predicate(backoff.expo, lambda x: x.status_code >= 429, max_time=30)
 def make_request(url, params):
-    return requests.get(url, params=params)
+    with metrics.timer("api_request_seconds"):
+        r = requests.get(url, params=params)
+    metrics.count("api_requests", status=r.status_code)
+    return r
 
 
 def get_all_publishers(email=None):
@@ -58,7 +64,7 @@ def get_all_publishers(email=None):
     while cursor:
         # set cursor value and request page from OpenAlex
         params["cursor"] = cursor
-        url = f"https://api.openalex.org/{endpoint}"
+        url = f"{OPENALEX_API_URL}/{endpoint}"
         if email:
             params["mailto"] = email
         r = make_request(url, params=params)
@@ -97,7 +103,7 @@ def get_groupby_result(
 ) -> List[Dict]:
     # general method to get the groupby_results
     endpoint = "works"
-    url = f"https://api.openalex.org/{endpoint}"
+    url = f"{OPENALEX_API_URL}/{endpoint}"
     if filters is None:
         filters = {}
     filters["primary_location.source.host_organization"] = publisher_openalex_id
@@ -112,6 +118,7 @@ def get_groupby_result(
         r = make_request(url, params=params)
         return r.json()["group_by"]
     except (RequestException, JSONDecodeError, KeyError):
+        metrics.count("api_errors")
         logger.error(
             f"error when trying to make request with url {url} and params {params}"
         )
@@ -207,6 +214,7 @@ def write_row_to_db(data_dict: Dict[str, Any], session: Session, commit=True):
     VALUES(:query_timestamp, :publisher_id, :publisher_display_name, :work_type, :publication_year_range, :works_count, :has_raw_affiliation, :is_corresponding, :has_abstract, :has_pdf_url, :timestamp_collection_start, :is_oa)
     """
     session.execute(text(q), data_dict)
+    metrics.count("rows_written", table="logs.landing_page_stats_by_publisher")
     if commit is True:
         session.commit()
 
@@ -216,20 +224,24 @@ def main(args):
     engine = create_engine(os.getenv("DATABASE_URL"))
     session = Session(engine)
 
-    publishers = get_all_publishers(email=EMAIL)
+    with metrics.stage("get_publishers"):
+        publishers = get_all_publishers(email=EMAIL)
     logger.info(
         f"there are {len(publishers)} publishers. Collecting stats for these publishers..."
     )
 
     for publisher in publishers:
-        this_publisher_stats = get_data_one_publisher(
-            publisher,
-            timestamp_collection_start=timestamp_collection_start,
-            email=EMAIL,
-        )
-        for row in this_publisher_stats:
-            write_row_to_db(row, session, commit=False)
-        session.commit()
+        with metrics.stage("collect_stats"):
+            this_publisher_stats = get_data_one_publisher(
+                publisher,
+                timestamp_collection_start=timestamp_collection_start,
+                email=EMAIL,
+            )
+        with metrics.stage("write_to_db"):
+            for row in this_publisher_stats:
+                write_row_to_db(row, session, commit=False)
+            session.commit()
+        metrics.count("publishers")
         logger.debug(f"saved data to db for publisher {publisher['id']}")
 
 
@@ -250,12 +262,14 @@ if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description=DESCRIPTION)
+    instrumentation.add_arguments(parser)
     parser.add_argument("--debug", action="store_true", help="output debugging info")
     global args
     args = parser.parse_args()
     if args.debug:
         root_logger.setLevel(logging.DEBUG)
         logger.debug("debug mode is on")
+    instrumentation.start("save_parsing_data_by_publisher", args)
     main(args)
     total_end = timer()
     logger.info(
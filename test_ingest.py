@@ -7,9 +7,12 @@ from sqlalchemy.orm import Session
 
 from models import Work
 from settings import ES_URL, WORKS_INDEX
+import instrumentation
+from instrumentation import metrics
 
 
 if __name__ == "__main__":
+    instrumentation.start("test_ingest")
     engine = create_engine(os.getenv("DATABASE_URL"))
     session = Session(engine)
     connections.create_connection(hosts=[ES_URL], timeout=30)
@@ -26,13 +29,14 @@ if __name__ == "__main__":
     mismatched_dates = []
 
     for i in range(1, int(max_records_to_process / offset)):
-        works_batch = (
-            session.query(Work)
-            .filter(Work.updated.between(one_day_ago, two_hours_ago))
-            .order_by(desc(Work.updated))
-            .slice(limit, offset + 1)
-            .all()
-        )
+        with metrics.timer("db_query_seconds"):
+            works_batch = (
+                session.query(Work)
+                .filter(Work.updated.between(one_day_ago, two_hours_ago))
+                .order_by(desc(Work.updated))
+                .slice(limit, offset + 1)
+                .all()
+            )
         if not works_batch:
             # no more results
             break
@@ -43,7 +47,9 @@ if __name__ == "__main__":
         s = s.extra(size=2000)
         s = s.source(["id", "updated"])
         s = s.filter("terms", id=db_ids)
-        response = s.execute()
+        with metrics.timer("es_request_seconds", request="search"):
+            response = s.execute()
+        metrics.count("rows_read", len(works_batch))
         elastic_ids = [r.id for r in response]
         elastic_dict = {r.id: r.updated for r in response}
 
@@ -54,6 +60,7 @@ if __name__ == "__main__":
             if formatted_id not in elastic_ids:
                 print(f"Work id {work.id} not in elasticsearch")
                 not_in_elastic.append(work.id)
+                metrics.count("works_checked", outcome="not_in_elastic")
             elif elastic_ids.count(formatted_id) > 1:
                 print(
                     f"Work id {work.id} has more than 1 record in elasticsearch. Count is {elastic_ids.count(formatted_id)}"
@@ -61,6 +68,7 @@ if __name__ == "__main__":
                 duplicates.append(
                     f"{work.id} (count {elastic_ids.count(formatted_id)})"
                 )
+                metrics.count("works_checked", outcome="duplicate")
             else:
                 formatted_updated_db = str(work.updated)[:-3]
                 formatted_updated_elastic = (
@@ -70,6 +78,9 @@ if __name__ == "__main__":
                     mismatch_message = f"Work with id {work.id} has dates that do not match. DB: {formatted_updated_db}, Elastic: {formatted_updated_elastic}"
                     print(mismatch_message)
                     mismatched_dates.append(mismatch_message)
+                    metrics.count("works_checked", outcome="mismatched_date")
+                else:
+                    metrics.count("works_checked", outcome="ok")
         print(offset)
     print(
         f"Summary: processed {offset} records.\nduplicates {duplicates}, not in elastic {not_in_elastic}, mismatched updated dates: {mismatched_dates}"
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os, json, threading
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Union
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import text
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# the logstash pipelines re-read this much on every run to be safe
+LOGSTASH_OVERLAP = timedelta(minutes=3)
+
+
+class Watermark(NamedTuple):
+    """Keyset position of the last row an ingester has indexed: rows come after it if (updated, id) > (watermark.updated, watermark.id)"""
+
+    updated: datetime
+    id: Any
+
+
+# start of time, for pipelines with no saved position. ids are all positive
+INITIAL_WATERMARK = Watermark(datetime(1970, 1, 1), 0)
+
+
+def read_logstash_last_value(fp: Path) -> datetime:
+    """Read the tracking value from a file in the logstash sql_last_value.yml format, e.g.:
+
+        --- 2022-05-12 03:26:16.049990000 Z
+    """
+    line = fp.read_text().strip()
+    value = line.lstrip("-").strip().rstrip("Z").strip()
+    # python only supports microseconds
+    if "." in value:
+        value_seconds, fraction = value.split(".")
+        value = f"{value_seconds}.{fraction[:6]}"
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+class WatermarkStore:
+    """Saves each pipeline's (updated, id) position to a json file, along with how many re-sent documents it has avoided.
+
+    {"works": {"updated": "2024-05-01T03:26:16.049990", "id": 4391231234, "resends_avoided": 123456}}
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._data: Dict[str, Dict] = {}
+        # pipelines may share a store across threads (see ingest_daemon.py)
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self._data = json.loads(self.path.read_text())
+
+    def get(self, pipeline: str) -> Optional[Watermark]:
+        entry = self._data.get(pipeline)
+        if entry is None:
+            return None
+        return Watermark(datetime.fromisoformat(entry["updated"]), entry["id"])
+
+    def get_or_seed(
+        self, pipeline: str, logstash_state_file: Optional[Union[str, Path]] = None
+    ) -> Watermark:
+        """The saved watermark for a pipeline. If there isn't one, start from the logstash
+        sql_last_value.yml (minus the overlap logstash would have re-read), or from the beginning."""
+        watermark = self.get(pipeline)
+        if watermark is not None:
+            return watermark
+        if logstash_state_file and Path(logstash_state_file).exists():
+            last_value = read_logstash_last_value(Path(logstash_state_file))
+            logger.info(f"no watermark for {pipeline}. starting from logstash's {last_value}")
+            return Watermark(last_value - LOGSTASH_OVERLAP, INITIAL_WATERMARK.id)
+        return INITIAL_WATERMARK
+
+    def set(self, pipeline: str, watermark: Watermark):
+        with self._lock:
+            entry = self._data.setdefault(pipeline, {})
+            entry["updated"] = watermark.updated.isoformat()
+            # numeric id columns come back from the driver as Decimal
+            entry["id"] = int(watermark.id) if isinstance(watermark.id, Decimal) else watermark.id
+            self._save()
+
+    def add_resends_avoided(self, pipeline: str, count: int):
+        with self._lock:
+            entry = self._data.setdefault(pipeline, {})
+            entry["resends_avoided"] = entry.get("resends_avoided", 0) + count
+            self._save()
+
+    def _save(self):
+        # write then rename, so a crash never leaves a half-written file
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp.write_text(json.dumps(self._data, indent=2, default=str))
+        os.replace(tmp, self.path)
+
+
+def count_resends_avoided(
+    conn, table: str, updated_column: str, id_column: str, watermark: Watermark
+) -> int:
+    """Count the rows at or before the watermark that the logstash overlap window would have sent again."""
+    q = f"""
+    SELECT count(*) FROM {table}
+    WHERE {updated_column} >= :overlap_start
+    AND ({updated_column}, {id_column}) <= (:watermark_updated, :watermark_id)
+    """
+    return conn.execute(
+        text(q),
+        {
+            "overlap_start": watermark.updated - LOGSTASH_OVERLAP,
+            "watermark_updated": watermark.updated,
+            "watermark_id": watermark.id,
+        },
+    ).scalar()
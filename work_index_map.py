@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+DESCRIPTION = """Build the memory-mapped work id -> works index suffix map used by ingest_works.py to delete a work's old copy when its publication year moves it to a different index"""
+
+import sys, os
+from pathlib import Path
+from typing import Optional, Union
+from datetime import datetime
+from timeit import default_timer as timer
+
+try:
+    from humanfriendly import format_timespan
+except ImportError:
+
+    def format_timespan(seconds):
+        return "{:.2f} seconds".format(seconds)
+
+
+import numpy as np
+from elasticsearch_dsl import Search, connections
+from settings import ES_URL, WORKS_WRITE_INDEX_PREFIX
+
+import logging
+
+root_logger = logging.getLogger()
+logger = root_logger.getChild(__name__)
+
+# every suffix get_index_suffix() in ingest_works.py can return. the position in this
+# list is what gets stored in the map, so only ever append to it
+INDEX_SUFFIXES = (
+    ["1959-or-less", "1960s", "1970s", "1980s", "1990-to-1994", "1995-to-1999"]
+    + [str(year) for year in range(2000, 2026)]
+    + ["invalid-data"]
+)
+SUFFIX_CODES = {suffix: i + 1 for i, suffix in enumerate(INDEX_SUFFIXES)}  # 0 means unknown
+
+# work ids are currently a bit over 4.4 billion. the file is sparse, so
+# only the pages holding ids we have actually seen take up disk space
+DEFAULT_SIZE = 5_000_000_000
+
+
+def parse_work_id(work_id: Union[str, int]) -> int:
+    # "https://openalex.org/W2741809807" -> 2741809807
+    if isinstance(work_id, str):
+        return int(work_id.rsplit("/", 1)[-1].lstrip("W"))
+    return int(work_id)
+
+
+class WorkIndexMap:
+    """One byte per numeric work id, holding the code of the index suffix the work was last written to.
+
+    Backed by a memory-mapped file, so it survives restarts and only the pages in use are held in memory.
+    """
+
+    def __init__(self, path: Union[str, Path], size: int = DEFAULT_SIZE):
+        self.path = Path(path)
+        if not self.path.exists():
+            with self.path.open("wb") as f:
+                f.truncate(size)
+        self._open()
+
+    def _open(self):
+        self._array = np.memmap(self.path, dtype=np.uint8, mode="r+")
+
+    def _grow(self, min_size: int):
+        new_size = max(min_size, int(len(self._array) * 1.25))
+        self._array.flush()
+        del self._array
+        with self.path.open("r+b") as f:
+            f.truncate(new_size)
+        self._open()
+
+    def get(self, work_id: Union[str, int]) -> Optional[str]:
+        i = parse_work_id(work_id)
+        if i >= len(self._array):
+            return None
+        code = self._array[i]
+        return INDEX_SUFFIXES[code - 1] if code else None
+
+    def set(self, work_id: Union[str, int], suffix: str):
+        i = parse_work_id(work_id)
+        if i >= len(self._array):
+            self._grow(i + 1)
+        self._array[i] = SUFFIX_CODES[suffix]
+
+    def flush(self):
+        self._array.flush()
+
+
+def main(args):
+    connections.create_connection(hosts=[ES_URL], timeout=60)
+    index_map = WorkIndexMap(args.path)
+    prefix = f"{args.index_prefix}-"
+    s = Search(index=f"{prefix}*")
+    s = s.source(False)
+    s = s.params(size=5000)
+    count = 0
+    # works in indices get_index_suffix() never routes to (a new year, a stray index) are skipped
+    unknown = {}
+    for hit in s.scan():
+        suffix = hit.meta.index[len(prefix):]
+        if suffix not in SUFFIX_CODES:
+            if suffix not in unknown:
+                logger.warning(f"skipping works in {hit.meta.index}: {suffix} is not in INDEX_SUFFIXES")
+            unknown[suffix] = unknown.get(suffix, 0) + 1
+            continue
+        index_map.set(hit.meta.id, suffix)
+        count += 1
+        if count % 1000000 == 0:
+            logger.info(f"{count} works mapped")
+    index_map.flush()
+    logger.info(f"finished. mapped {count} works to {args.path}")
+    if unknown:
+        logger.warning(f"skipped {sum(unknown.values())} works in indices with unknown suffixes: {unknown}")
+
+
+if __name__ == "__main__":
+    total_start = timer()
+    handler = logging.StreamHandler()
+    handler.setFormatter(
+        logging.Formatter(
+            fmt="%(asctime)s %(name)s.%(lineno)d %(levelname)s : %(message)s",
+            datefmt="%H:%M:%S",
+        )
+    )
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    logger.info(" ".join(sys.argv))
+    logger.info("{:%Y-%m-%d %H:%M:%S}".format(datetime.now()))
+    logger.info("pid: {}".format(os.getpid()))
+    import argparse
+
+    parser = argparse.ArgumentParser(description=DESCRIPTION)
+    parser.add_argument("path", help="path to the map file (created if it does not exist)")
+    parser.add_argument(
+        "--index-prefix",
+        default=WORKS_WRITE_INDEX_PREFIX,
+        help=f"works index prefix to scan (default: {WORKS_WRITE_INDEX_PREFIX})",
+    )
+    parser.add_argument("--debug", action="store_true", help="output debugging info")
+    global args
+    args = parser.parse_args()
+    if args.debug:
+        root_logger.setLevel(logging.DEBUG)
+        logger.debug("debug mode is on")
+    main(args)
+    total_end = timer()
+    logger.info(
+        "all finished. total time: {}".format(format_timespan(total_end - total_start))
+    )